@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the throughput of the storage backends.
+
+Usage::
+
+    python benchmarks/storage_backends.py [--keys 10000] [--redis redis://localhost:6379]
+
+The Redis backend is only benchmarked when a Redis URL is given.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from machine.storage.backends.append_only import AppendOnlyFileStorage  # noqa: E402
+from machine.storage.backends.memory import MemoryStorage  # noqa: E402
+from machine.storage.backends.sqlite import SQLiteStorage  # noqa: E402
+
+
+async def timed(name, n, coro):
+    start = time.perf_counter()
+    await coro
+    elapsed = time.perf_counter() - start
+    print(f"  {name:<24} {elapsed:8.3f}s {n / elapsed:12.0f} ops/s")
+
+
+async def bench(name, storage, n):
+    print(f"{name}:")
+    await storage.connect()
+    value = b"x" * 128
+
+    async def sets():
+        for i in range(n):
+            await storage.set(f"Bench:key{i}", value)
+
+    async def set_many():
+        await storage.set_many({f"Bench:batch{i}": value for i in range(n)})
+
+    async def gets():
+        for i in range(n):
+            await storage.get(f"Bench:key{i}")
+
+    async def incrs():
+        for _ in range(n):
+            await storage.incr("Bench:counter")
+
+    async def find_keys():
+        for i in range(100):
+            await storage.find_keys(f"Bench:key{i}*")
+
+    async def iter_items():
+        async for _ in storage.iter_items("Bench:*", count=1000):
+            pass
+
+    try:
+        await timed("set", n, sets())
+        await timed("set_many", n, set_many())
+        await timed("get", n, gets())
+        await timed("incr", n, incrs())
+        await timed("find_keys (prefix)", 100, find_keys())
+        await timed("iter_items", 2 * n, iter_items())
+    finally:
+        # Called inside the temporary directory blocks of main, so files are flushed and closed
+        # before the directory is removed
+        await storage.close()
+
+
+async def main(args):
+    await bench("MemoryStorage", MemoryStorage({}), args.keys)
+    with tempfile.TemporaryDirectory() as tmp:
+        settings = {"SQLITE_PATH": os.path.join(tmp, "bench.db")}
+        await bench("SQLiteStorage", SQLiteStorage(settings), args.keys)
+    with tempfile.TemporaryDirectory() as tmp:
+        settings = {"AOF_STORAGE_PATH": tmp}
+        await bench("AppendOnlyFileStorage", AppendOnlyFileStorage(settings), args.keys)
+    if args.redis:
+        from machine.storage.backends.redis import RedisStorage
+
+        settings = {"REDIS_URL": args.redis, "REDIS_KEY_PREFIX": "SMBENCH"}
+        await bench("RedisStorage", RedisStorage(settings), args.keys)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--keys", type=int, default=10000)
+    parser.add_argument("--redis", default=os.environ.get("REDIS_URL"))
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
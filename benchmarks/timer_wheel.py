@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the cost of keeping many pending timers on the timer wheel, on the event loop and as
+scheduler jobs.
+
+Usage::
+
+    python benchmarks/timer_wheel.py [--timers 100000] [--jobs 10000] [--horizon 1]
+
+Every timer is added with a random delay of up to ``--horizon`` seconds, then half of them are
+cancelled and the rest run. Adding a scheduler job takes time linear in the number of pending
+jobs, so the scheduler only gets the first ``--jobs`` timers.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler  # noqa: E402
+
+from machine.utils.timer_wheel import TimerWheel  # noqa: E402
+
+
+def report(name, n, elapsed):
+    print(f"  {name:<24} {elapsed:8.3f}s {n / elapsed:12.0f} ops/s")
+
+
+async def bench(name, add, cancel, delays, wait):
+    print(f"{name}:")
+    fired = []
+    tracemalloc.start()
+    start = time.perf_counter()
+    timers = [add(delay, fired.append) for delay in delays]
+    report("add", len(delays), time.perf_counter() - start)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"  {'memory':<24} {peak / len(delays):8.0f} bytes/timer")
+
+    start = time.perf_counter()
+    for timer in timers[::2]:
+        cancel(timer)
+    report("cancel", len(timers[::2]), time.perf_counter() - start)
+
+    await wait(fired, len(timers[1::2]))
+
+
+async def main(args):
+    loop = asyncio.get_event_loop()
+    delays = [random.uniform(0, args.horizon) for _ in range(args.timers)]
+
+    async def wait_until_fired(fired, n):
+        start = time.perf_counter()
+        while len(fired) < n:
+            await asyncio.sleep(0.01)
+        print(f"  {'all fired after':<24} {time.perf_counter() - start:8.3f}s")
+
+    wheel = TimerWheel(tick=0.01, loop=loop)
+    await bench(
+        "TimerWheel",
+        lambda delay, fn: wheel.call_later(delay, fn, delay),
+        lambda timer: timer.cancel(),
+        delays,
+        wait_until_fired,
+    )
+    await bench(
+        "loop.call_later",
+        lambda delay, fn: loop.call_later(delay, fn, delay),
+        lambda handle: handle.cancel(),
+        delays,
+        wait_until_fired,
+    )
+
+    scheduler = AsyncIOScheduler(event_loop=loop, timezone="UTC")
+    scheduler.start()
+    now = datetime.now()
+
+    async def wait_for_jobs(fired, n):
+        start = time.perf_counter()
+        while scheduler.get_jobs():
+            await asyncio.sleep(0.01)
+        print(f"  {'all fired after':<24} {time.perf_counter() - start:8.3f}s")
+
+    await bench(
+        "AsyncIOScheduler jobs",
+        lambda delay, fn: scheduler.add_job(
+            fn,
+            trigger="date",
+            run_date=now + timedelta(seconds=args.horizon + delay),
+            args=[delay],
+            misfire_grace_time=None,
+        ),
+        lambda job: job.remove(),
+        delays[: args.jobs],
+        wait_for_jobs,
+    )
+    scheduler.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--timers", type=int, default=100000)
+    parser.add_argument("--jobs", type=int, default=10000)
+    parser.add_argument("--horizon", type=float, default=1)
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import ast
+import asyncio
+import os
+import sys
+
+from loguru import logger
+
+from machine.settings import import_settings
+from machine.storage.migration import migrate
+from machine.utils.module_loading import import_string
+
+
+def _parse_setting(setting):
+    name, _, value = setting.partition("=")
+    try:
+        value = ast.literal_eval(value)
+    except (SyntaxError, ValueError):
+        pass
+    return name, value
+
+
+def _build_backend(backend, settings, overrides):
+    backend_settings = settings.copy()
+    for setting in overrides:
+        name, value = _parse_setting(setting)
+        backend_settings[name] = value
+    _, cls = import_string(backend)[0]
+    return cls(backend_settings)
+
+
+async def _migrate(source, target, args):
+    await asyncio.gather(source.connect(), target.connect())
+    patterns = args.patterns or []
+    patterns.extend(f"{namespace}:*" for namespace in args.namespaces or [])
+    try:
+        return await migrate(
+            source,
+            target,
+            patterns=patterns or ["*"],
+            batch_size=args.batch_size,
+            checkpoint=args.checkpoint,
+        )
+    finally:
+        await asyncio.gather(source.close(), target.close())
+
+
+def main(argv=None):
+    # When running this function as console entry point, the current working dir is not in the
+    # Python path, so we have to add it
+    sys.path.insert(0, os.getcwd())
+
+    parser = argparse.ArgumentParser(
+        description="Copy data, including expiration, from one storage backend to another. "
+        "Both backends are configured by local_settings.py, settings can be overridden "
+        "per backend."
+    )
+    parser.add_argument("source", help="fully qualified class of the backend to copy from")
+    parser.add_argument("target", help="fully qualified class of the backend to copy to")
+    parser.add_argument(
+        "--source-setting",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="override a setting for the source backend, eg. REDIS_URL=redis://old:6379",
+    )
+    parser.add_argument(
+        "--target-setting",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="override a setting for the target backend",
+    )
+    parser.add_argument(
+        "--namespace",
+        action="append",
+        dest="namespaces",
+        help="only copy the data of this plugin, eg. my_plugins.stats:StatsPlugin",
+    )
+    parser.add_argument(
+        "--pattern", action="append", dest="patterns", help="only copy keys matching this pattern"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=500, help="number of keys to copy at once"
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="file to keep track of progress in, so an interrupted migration can be resumed",
+    )
+    args = parser.parse_args(argv)
+
+    settings, _ = import_settings()
+    source = _build_backend(args.source, settings, args.source_setting)
+    target = _build_backend(args.target, settings, args.target_setting)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    result = loop.run_until_complete(_migrate(source, target, args))
+    loop.close()
+
+    if result["skipped"]:
+        logger.error(f"{result['skipped']} keys could not be copied")
+        sys.exit(1)
+    sys.exit(0)
@@ -4,21 +4,26 @@ import asyncio
 import inspect
 import signal
 import sys
+import time
 from functools import partial
-from typing import Mapping, Optional
+from typing import List, Mapping, Optional, Tuple
 
 import dill
-from aiohttp.web import Application, AppRunner, TCPSite
+from aiohttp.web import Application, AppRunner, TCPSite, json_response
 from loguru import logger
 
+from machine import jobs
 from machine.dispatch import EventDispatcher
+from machine.leader import LeaderElection
 from machine.plugins.base import MachineBasePlugin
 from machine.settings import import_settings
 from machine.singletons import Slack, Scheduler, Storage
 from machine.slack import MessagingClient
 from machine.storage import PluginStorage
 from machine.utils import collections, find_shortest_indent, log_propagate
+from machine.utils.metrics import DURATION_BUCKETS, registry
 from machine.utils.module_loading import import_string
+from machine.utils.timer_wheel import timer_wheel
 
 __all__ = ["Machine", "start"]
 
@@ -28,21 +33,22 @@ def start(loop: asyncio.AbstractEventLoop, settings: Optional[dict] = None):
         create and run a `Machine` instance to completion.
     """
 
+    bot = Machine(loop=loop, settings=settings)
+
     # Handle INT and TERM by gracefully halting the event loop
     for s in (signal.SIGINT, signal.SIGTERM):
-        loop.add_signal_handler(s, partial(_prepare_to_stop, loop))
+        loop.add_signal_handler(s, partial(_prepare_to_stop, loop, bot))
 
-    bot = Machine(loop=loop, settings=settings)
     loop.run_until_complete(bot.run())
 
     # Once `prepare_to_stop` returns, `loop` is guaranteed
     # to be stopped.
-    _prepare_to_stop(loop)
+    _prepare_to_stop(loop, bot)
 
     loop.close()
 
 
-def _prepare_to_stop(loop: asyncio.AbstractEventLoop):
+def _prepare_to_stop(loop: asyncio.AbstractEventLoop, bot: Optional["Machine"] = None):
     # Calling `cancel` on each task in the active loop causes
     # a `CancelledError` to be thrown into each wrapped coroutine during
     # the next iteration, which _should_ halt execution of the coroutine
@@ -53,12 +59,17 @@ def _prepare_to_stop(loop: asyncio.AbstractEventLoop):
     # Using `ensure_future` on the `stop` coroutine here ensures that
     # the `stop` coroutine is the last thing to run after each cancelled
     # task has its `CancelledError` emitted.
-    asyncio.ensure_future(_stop(), loop=loop)
+    asyncio.ensure_future(_stop(bot), loop=loop)
     loop.run_forever()
 
 
-async def _stop():
+async def _stop(bot: Optional["Machine"] = None):
     loop = asyncio.get_event_loop()
+    if bot is not None:
+        try:
+            await bot.close()
+        except Exception:
+            logger.exception("Error while shutting down Slack Machine")
     logger.info("Thanks for playing!")
 
     loop.stop()
@@ -68,11 +79,15 @@ class Machine:
     _client: Slack
     _dispatcher: EventDispatcher
     _loop: asyncio.AbstractEventLoop
+    _scheduler: Scheduler
     _settings: collections.CaseInsensitiveDict
     _storage: Storage
 
     _help: Mapping[str, dict] = {"human": {}, "robot": {}}
     _http_app: Optional[Application] = None
+    _leader_election: Optional[LeaderElection] = None
+    _plugins: List[Tuple[str, MachineBasePlugin]]
+    _warm_ups: List[asyncio.Task]
     _plugin_actions: Mapping[str, dict] = {
         "process": {},
         "listen_to": {},
@@ -102,6 +117,15 @@ class Machine:
             sys.exit(1)
 
         self._client = Slack(settings=self._settings, loop=self._loop)
+        MessagingClient.schedule_message_threshold = self._settings.get(
+            "SLACK_SCHEDULE_MESSAGE_THRESHOLD"
+        )
+        MessagingClient.timer_wheel_horizon = self._settings.get("SCHEDULER_TIMER_WHEEL_HORIZON")
+        MessagingClient.batch_scheduled_messages = self._settings.get(
+            "SLACK_BATCH_SCHEDULED_MESSAGES", False
+        )
+        MessagingClient.batch_rate_limit = self._settings.get("SLACK_BATCH_RATE_LIMIT", 20)
+        MessagingClient.batch_concurrency = self._settings.get("SLACK_BATCH_CONCURRENCY", 10)
 
         logger.info(
             "Initializing storage using backend: {}".format(
@@ -113,12 +137,28 @@ class Machine:
 
         self._loop.run_until_complete(self._storage.connect())
 
+        # Plugins add their scheduled functions while they are loaded, the scheduler is only
+        # started when Slack Machine runs
+        self._scheduler = Scheduler(settings=self._settings, loop=self._loop)
+        leader_election = self._settings.get("SCHEDULER_LEADER_ELECTION", False)
+        if leader_election and not self._scheduler.shared_jobstore:
+            # Followers never run jobs, so the jobs they add would never run at all
+            logger.error(
+                "SCHEDULER_LEADER_ELECTION needs a jobstore that all instances share, set "
+                "REDIS_URL and don't use the sqlite SCHEDULER_JOBSTORE"
+            )
+            sys.exit(1)
+
         if not self._settings.get("DISABLE_HTTP", False):
             self._http_app = Application()
+            self._http_app.router.add_get("/metrics/storage", self._storage_metrics)
+            self._http_app.router.add_get("/metrics/scheduler", self._scheduler_metrics)
         else:
             self._http_app = None
 
         logger.debug("Loading plugins...")
+        self._plugins = []
+        self._warm_ups = []
         self.load_plugins()
         logger.debug(
             f"The following plugin actions were registered: {self._plugin_actions}"
@@ -131,7 +171,11 @@ class Machine:
             for class_name, cls in import_string(plugin):
                 if issubclass(cls, MachineBasePlugin) and cls is not MachineBasePlugin:
                     logger.debug("Found a Machine plugin: {}".format(plugin))
-                    storage = PluginStorage(class_name)
+                    storage = PluginStorage(
+                        class_name,
+                        quota=self._settings.get("STORAGE_QUOTAS", {}).get(class_name),
+                        slow_threshold=self._settings.get("STORAGE_SLOW_OPERATION_THRESHOLD"),
+                    )
                     instance = cls(self._settings, MessagingClient(), storage)
 
                     missing_settings = self._register_plugin(class_name, instance)
@@ -144,24 +188,97 @@ class Machine:
                         )
                         del instance
                     else:
-                        if inspect.iscoroutinefunction(instance.init):
-                            self._loop.run_until_complete(instance.init(self._http_app))
-                        else:
-                            instance.init(self._http_app)
-
-                        logger.info(f"Loaded plugin: {class_name}")
+                        self._plugins.append((class_name, instance))
 
+        self._init_plugins(self._plugins)
         self._loop.run_until_complete(
             self._storage.set("manual", dill.dumps(self._help))
         )
 
+    def _init_plugins(self, plugins):
+        # Synchronous init functions can't run while the loop is running, because they might run
+        # coroutines themselves. They run one by one first, then all async init functions at once.
+        for class_name, instance in plugins:
+            if not inspect.iscoroutinefunction(instance.init):
+                start = time.monotonic()
+                instance.init(self._http_app)
+                self._plugin_loaded(class_name, time.monotonic() - start)
+
+        async def init(class_name, instance):
+            timeout = self._settings.get("PLUGIN_INIT_TIMEOUTS", {}).get(
+                class_name, self._settings.get("PLUGIN_INIT_TIMEOUT")
+            )
+            start = time.monotonic()
+            try:
+                await asyncio.wait_for(instance.init(self._http_app), timeout)
+            except asyncio.TimeoutError:
+                logger.error(
+                    f"{class_name}: initialization was cancelled after {timeout}s. This plugin "
+                    "is loaded, but might not work properly!"
+                )
+                return
+            self._plugin_loaded(class_name, time.monotonic() - start)
+
+        results = self._loop.run_until_complete(
+            asyncio.gather(
+                *(
+                    init(class_name, instance)
+                    for class_name, instance in plugins
+                    if inspect.iscoroutinefunction(instance.init)
+                ),
+                return_exceptions=True,
+            )
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    @staticmethod
+    def _plugin_loaded(class_name, duration):
+        histogram = registry.histogram("plugin_init_seconds", DURATION_BUCKETS, plugin=class_name)
+        histogram.observe(duration)
+        logger.info(f"Loaded plugin: {class_name} (initialized in {duration:.2f}s)")
+
+    def _start_warm_ups(self):
+        async def warm_up(class_name, instance):
+            start = time.monotonic()
+            try:
+                if inspect.iscoroutinefunction(instance.warm_up):
+                    await instance.warm_up()
+                else:
+                    await self._loop.run_in_executor(None, instance.warm_up)
+            except Exception:
+                logger.exception(f"{class_name}: warm-up failed")
+                return
+            logger.info(f"{class_name}: warm-up finished in {time.monotonic() - start:.2f}s")
+
+        for class_name, instance in self._plugins:
+            # Only plugins that implement warm_up are warmed up
+            if type(instance).warm_up is not MachineBasePlugin.warm_up:
+                self._warm_ups.append(asyncio.ensure_future(warm_up(class_name, instance)))
+
     async def run(self):
         logger.info("Starting Slack Machine")
         self._dispatcher.start()
 
-        Scheduler(settings=self._settings, loop=self._loop).start()
+        scheduler = self._scheduler
+        if self._settings.get("SCHEDULER_LEADER_ELECTION", False):
+            # Only the leader runs scheduled jobs, the other replicas keep their scheduler paused
+            scheduler.start(paused=True)
+            self._leader_election = LeaderElection(
+                "machine:scheduler-leader",
+                ttl=self._settings.get("SCHEDULER_LEADER_LEASE_TTL", 15),
+                on_elected=self._resume_scheduler,
+                on_demoted=scheduler.pause,
+            )
+            await self._leader_election.start()
+        else:
+            scheduler.start()
         logger.info("Scheduler started!")
 
+        # Warm-ups run in the background, so the bot connects without waiting for them
+        self._start_warm_ups()
+
         keepaliver: Optional[asyncio.Task] = None
         runner: Optional[AppRunner] = None
         try:
@@ -184,6 +301,62 @@ class Machine:
             if runner is not None:
                 await runner.cleanup()
 
+    def _resume_scheduler(self):
+        asyncio.ensure_future(self._refresh_and_resume_scheduler())
+
+    async def _refresh_and_resume_scheduler(self):
+        # Jobs that other instances added since the jobs were last loaded would only be loaded at
+        # the next refresh, possibly too late to run, so they are loaded before any job runs
+        try:
+            await self._scheduler.refresh()
+        except Exception:
+            logger.exception("Failed to load scheduler jobs before running them")
+        # Leadership could have been lost while the jobs were loaded
+        if self._leader_election.is_leader:
+            self._scheduler.resume()
+
+    async def close(self):
+        """ Release resources held by Slack Machine, like buffered storage writes,
+            before it shuts down. Every step is taken even if an earlier step fails, so
+            buffered writes are not lost because of an unrelated error.
+        """
+
+        for warm_up in self._warm_ups:
+            warm_up.cancel()
+
+        if self._leader_election is not None:
+            await self._shutdown_step("stop the leader election", self._leader_election.stop)
+
+        logger.debug("Writing pending scheduler changes...")
+        await self._shutdown_step("write pending scheduler changes", self._scheduler.close)
+        await self._shutdown_step("cancel the timer wheel", self._cancel_timer_wheel)
+
+        logger.debug("Closing storage...")
+        await self._shutdown_step("close storage", self._storage.close)
+
+    @staticmethod
+    async def _shutdown_step(description, fn):
+        try:
+            result = fn()
+            if inspect.isawaitable(result):
+                await result
+        except Exception:
+            logger.exception(f"Failed to {description} while shutting down")
+
+    @staticmethod
+    def _cancel_timer_wheel():
+        dropped = timer_wheel.cancel_all()
+        if dropped:
+            logger.warning(f"{dropped} messages that were scheduled shortly ahead were not sent")
+
+    async def _storage_metrics(self, request):
+        return json_response(
+            {"operations": registry.snapshot("storage_"), "backend": self._storage.stats()}
+        )
+
+    async def _scheduler_metrics(self, request):
+        return json_response(Scheduler.get_stats())
+
     async def _start_http_server(self) -> Optional[AppRunner]:
         if self._http_app is not None:
             http_host = self._settings.get("HTTP_SERVER_HOST", "127.0.0.1")
@@ -215,6 +388,8 @@ class Machine:
         if missing_settings:
             return missing_settings
 
+        jobs.register_plugin(plugin_class, cls_instance)
+
         if hasattr(cls_instance, "catch_all"):
             self._plugin_actions["catch_all"][plugin_class] = {
                 "class": cls_instance,
@@ -277,13 +452,25 @@ class Machine:
                         self._parse_robot_help(regex, action)
                     )
             elif action == "schedule":
+                trigger_args = dict(config)
+                # Options that are not set are left to the scheduler's defaults
+                job_options = {
+                    option: trigger_args.pop(option, None)
+                    for option in ("coalesce", "misfire_grace_time", "max_instances")
+                }
+                job_options = {k: v for k, v in job_options.items() if v is not None}
+                if trigger_args.get("jitter") is None:
+                    # Spread the start of jobs with the same schedule, so they don't all hit Slack
+                    # and storage at the same moment
+                    trigger_args["jitter"] = self._settings.get("SCHEDULER_CRON_JITTER")
                 Scheduler.get_instance().add_job(
-                    fq_fn_name,
+                    "machine.jobs:run_plugin_method",
                     trigger="cron",
-                    args=[cls_instance],
+                    args=[plugin_class, fn_name],
                     id=fq_fn_name,
                     replace_existing=True,
-                    **config,
+                    **trigger_args,
+                    **job_options,
                 )
 
     @staticmethod
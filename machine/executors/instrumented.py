@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import time
+from datetime import datetime, timezone
+
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_MISSED
+from apscheduler.executors.asyncio import AsyncIOExecutor
+from apscheduler.executors.base import MaxInstancesReachedError
+
+from machine.utils.metrics import COUNT_BUCKETS, DURATION_BUCKETS, registry
+
+
+def _job_label(job):
+    # Jobs of @schedule functions are labelled by the plugin function, other jobs (eg. scheduled
+    # messages) by the function they call, so there is one label per kind of job
+    if job.func_ref == "machine.jobs:run_plugin_method" and len(job.args) >= 2:
+        return "{}.{}".format(*job.args[:2])
+    return job.func_ref or job.name
+
+
+class InstrumentedAsyncIOExecutor(AsyncIOExecutor):
+    """Runs jobs like the ``AsyncIOExecutor``, and records metrics of the runs
+
+    The following metrics are recorded in the :py:data:`~machine.utils.metrics.registry`, all
+    labelled by ``job``:
+
+    * ``scheduler_lateness_seconds``: time between when a run was scheduled and when it started.
+      Growing lateness of all jobs means the event loop is too busy to run jobs in time
+    * ``scheduler_run_seconds``: duration of runs
+    * ``scheduler_runs``: number of runs by ``outcome``, which is ``success`` or ``error`` for
+      runs that happened, ``missed`` for runs that started too late (see ``misfire_grace_time``)
+      and ``max_instances`` for runs that were skipped because the job was still running
+
+    Besides that, ``scheduler_running_jobs`` records the number of runs in progress, every time a
+    run starts.
+    """
+
+    def __init__(self, metrics=registry):
+        super().__init__()
+        self._metrics = metrics
+        # Label and start of the runs in progress, by job id and scheduled run time
+        self._runs = {}
+
+    def submit_job(self, job, run_times):
+        label = _job_label(job)
+        try:
+            super().submit_job(job, run_times)
+        except MaxInstancesReachedError:
+            self._metrics.counter("scheduler_runs", job=label, outcome="max_instances").inc()
+            raise
+
+        now = datetime.now(timezone.utc)
+        start = time.monotonic()
+        lateness = self._metrics.histogram(
+            "scheduler_lateness_seconds", DURATION_BUCKETS, job=label
+        )
+        for run_time in run_times:
+            lateness.observe(max((now - run_time).total_seconds(), 0))
+            self._runs[(job.id, run_time)] = (label, start)
+        running = sum(self._instances.values())
+        self._metrics.histogram("scheduler_running_jobs", COUNT_BUCKETS).observe(running)
+
+    def _run_job_success(self, job_id, events):
+        end = time.monotonic()
+        for event in events:
+            label, start = self._runs.pop((job_id, event.scheduled_run_time), (job_id, end))
+            if event.code == EVENT_JOB_MISSED:
+                outcome = "missed"
+            else:
+                outcome = "error" if event.code == EVENT_JOB_ERROR else "success"
+                self._metrics.histogram(
+                    "scheduler_run_seconds", DURATION_BUCKETS, job=label
+                ).observe(end - start)
+            self._metrics.counter("scheduler_runs", job=label, outcome=outcome).inc()
+        super()._run_job_success(job_id, events)
+
+    def _run_job_error(self, job_id, exc, traceback=None):
+        # The run failed outside of the job function, eg. because it was cancelled
+        for key in [key for key in self._runs if key[0] == job_id]:
+            label, _ = self._runs.pop(key)
+            self._metrics.counter("scheduler_runs", job=label, outcome="error").inc()
+        super()._run_job_error(job_id, exc, traceback)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import inspect
+from functools import partial
+
+from loguru import logger
+
+from machine.slack import MessagingClient
+
+# Jobs are pickled by the scheduler's jobstore. Instead of scheduling plugin instances or clients,
+# jobs refer to the functions in this module by name (eg. "machine.jobs:run_plugin_method") with
+# plain arguments, and the live objects are looked up when the job runs. This keeps stored jobs
+# small, and they keep working after a restart or a deploy that changes the plugin classes.
+_plugins = {}
+
+
+def register_plugin(name, instance):
+    """Make a plugin instance available to scheduled jobs under its fully qualified name"""
+    _plugins[name] = instance
+
+
+def get_plugin(name):
+    """Look up a plugin instance by its fully qualified name
+
+    :raises LookupError: if no plugin with that name is loaded
+    """
+    try:
+        return _plugins[name]
+    except KeyError:
+        raise LookupError(f"Plugin {name} is not loaded") from None
+
+
+async def run_plugin_method(plugin, method, *args, **kwargs):
+    """Call a method of a loaded plugin
+
+    Coroutine functions are awaited, other functions are called in the default executor, like
+    the scheduler does for jobs that are regular functions.
+
+    :param plugin: fully qualified name of the plugin class, eg. ``"my_plugins:MyPlugin"``
+    :param method: name of the method to call
+    """
+    try:
+        fn = getattr(get_plugin(plugin), method)
+    except (LookupError, AttributeError):
+        # The plugin was disabled or the method removed since the job was scheduled
+        logger.warning(f"Skipping scheduled job, {plugin}.{method} does not exist anymore")
+        return None
+    if inspect.iscoroutinefunction(fn):
+        return await fn(*args, **kwargs)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, partial(fn, *args, **kwargs))
+
+
+async def send_dm(user_id, text, **kwargs):
+    """Send a direct message, see :py:meth:`machine.slack.MessagingClient.send_dm`"""
+    return await MessagingClient().send_dm(user_id, text, **kwargs)
+
+
+async def send_batch(messages):
+    """Send a batch of messages, see :py:meth:`machine.slack.MessagingClient.send_batch`"""
+    return await MessagingClient().send_batch(messages)
+
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import pickle
+from collections import deque
+
+from apscheduler.job import Job
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.util import datetime_to_utc_timestamp
+from loguru import logger
+
+PUT = "put"
+REMOVE = "remove"
+CLEAR = "clear"
+
+
+class BufferedJobStore(MemoryJobStore):
+    """Base class for jobstores that keep jobs in an external store, without blocking the loop
+
+    APScheduler calls jobstores synchronously from the event loop, so these jobstores serve all
+    reads from an in-memory copy of the jobs. Changes are applied to the in-memory copy right away
+    and written to the external store in the background, in order, by a single task. Writes that
+    fail are retried until they succeed.
+
+    The jobs are loaded when the scheduler starts, and if ``refresh_interval`` is set, reloaded
+    every ``refresh_interval`` seconds to pick up jobs that were added by other processes.
+
+    Subclasses implement :py:meth:`_read_states` and :py:meth:`_write_change`.
+    """
+
+    def __init__(self, refresh_interval=0, pickle_protocol=pickle.HIGHEST_PROTOCOL):
+        super().__init__()
+        self.refresh_interval = refresh_interval
+        self.pickle_protocol = pickle_protocol
+        # Changes that have not been written yet, oldest first
+        self._pending = deque()
+        self._changed = asyncio.Event()
+        # Keeps writes from completing while the jobs are reloaded, or they could be missed
+        self._lock = asyncio.Lock()
+        self._writer = None
+        self._refresher = None
+
+    def start(self, scheduler, alias):
+        super().start(scheduler, alias)
+        self._writer = asyncio.ensure_future(self._write_periodically())
+        self._refresher = asyncio.ensure_future(self._refresh_periodically())
+
+    def shutdown(self):
+        for task in (self._writer, self._refresher):
+            if task is not None:
+                task.cancel()
+        self._writer = self._refresher = None
+        if self._pending:
+            logger.warning(f"{len(self._pending)} job changes were not written to the jobstore")
+
+    def add_job(self, job):
+        super().add_job(job)
+        self._enqueue(PUT, job.id, job)
+
+    def update_job(self, job):
+        super().update_job(job)
+        self._enqueue(PUT, job.id, job)
+
+    def remove_job(self, job_id):
+        super().remove_job(job_id)
+        self._enqueue(REMOVE, job_id)
+
+    def remove_all_jobs(self):
+        super().remove_all_jobs()
+        self._enqueue(CLEAR)
+
+    def _enqueue(self, action, job_id=None, job=None):
+        # The job is serialized right away, because the job object can change before it's written
+        if job is None:
+            state = timestamp = None
+        else:
+            state = pickle.dumps(job.__getstate__(), self.pickle_protocol)
+            timestamp = datetime_to_utc_timestamp(job.next_run_time)
+        self._pending.append((action, job_id, job, state, timestamp))
+        self._changed.set()
+
+    async def flush(self):
+        """Write all pending changes"""
+        async with self._lock:
+            while self._pending:
+                action, job_id, _, state, timestamp = self._pending[0]
+                await self._write_change(action, job_id, state, timestamp)
+                self._pending.popleft()
+
+    async def _write_periodically(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to write scheduler jobs, retrying in 1s")
+                await asyncio.sleep(1)
+                self._changed.set()
+
+    async def refresh(self):
+        """Replace the in-memory jobs with the stored jobs
+
+        Changes that have not been written yet are applied on top, so they are not lost.
+        """
+        async with self._lock:
+            self._load(await self._read_states())
+        if self._scheduler is not None and self._scheduler.running:
+            # A loaded job might be due earlier than the scheduler expects
+            self._scheduler.wakeup()
+
+    def _load(self, states):
+        jobs = {}
+        for job_id, state in states.items():
+            job_id = job_id.decode("utf-8") if isinstance(job_id, bytes) else job_id
+            try:
+                jobs[job_id] = self._reconstitute_job(state)
+            except Exception:
+                logger.exception(f"Unable to restore job {job_id}, removing it")
+                self._enqueue(REMOVE, job_id)
+
+        for action, job_id, job, _, _ in self._pending:
+            if action == PUT:
+                jobs[job_id] = job
+            elif action == REMOVE:
+                jobs.pop(job_id, None)
+            else:
+                jobs.clear()
+
+        MemoryJobStore.remove_all_jobs(self)
+        for job in jobs.values():
+            MemoryJobStore.add_job(self, job)
+
+    async def _refresh_periodically(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Failed to load scheduler jobs, retrying in 1s")
+                await asyncio.sleep(1)
+                continue
+            if not self.refresh_interval:
+                return
+            await asyncio.sleep(self.refresh_interval)
+
+    def _reconstitute_job(self, state):
+        job = Job.__new__(Job)
+        job.__setstate__(pickle.loads(state))
+        job._scheduler = self._scheduler
+        job._jobstore_alias = self._alias
+        return job
+
+    async def _read_states(self):
+        """Return the pickled states of all stored jobs, by job id"""
+        raise NotImplementedError
+
+    async def _write_change(self, action, job_id, state, timestamp):
+        """Store a change
+
+        :param action: ``PUT`` to add or replace a job, ``REMOVE`` to remove a job or ``CLEAR``
+            to remove all jobs
+        :param job_id: id of the job, unless all jobs are removed
+        :param state: pickled state of the job that is put
+        :param timestamp: next run time of the job that is put, as a UTC timestamp, or ``None``
+            if the job is paused
+        """
+        raise NotImplementedError
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import pickle
+
+from machine.jobstores.base import PUT, REMOVE, BufferedJobStore
+
+
+class AsyncRedisJobStore(BufferedJobStore):
+    """Jobstore that keeps jobs in Redis, using the connection pool of the Redis storage backend
+
+    Reads are served from memory and changes are written in the background, see
+    :py:class:`~machine.jobstores.base.BufferedJobStore`. Writes that fail (eg. during a Redis
+    outage) are retried until they succeed. The jobs are reloaded every ``refresh_interval``
+    seconds to pick up jobs that were added by other Slack Machine processes. Jobs are stored under
+    the same keys and in the same format as APScheduler's own ``RedisJobStore``, so existing jobs
+    are kept when switching to this jobstore.
+
+    :param storage: the connected :py:class:`~machine.storage.backends.redis.RedisStorage`
+    :param jobs_key: key of the hash that holds the jobs
+    :param run_times_key: key of the sorted set that holds the next run times of the jobs
+    :param refresh_interval: number of seconds between reloads of the jobs from Redis, or ``0``
+        to only load the jobs on start
+    """
+
+    def __init__(
+        self,
+        storage,
+        jobs_key="apscheduler.jobs",
+        run_times_key="apscheduler.run_times",
+        refresh_interval=10,
+        pickle_protocol=pickle.HIGHEST_PROTOCOL,
+    ):
+        super().__init__(refresh_interval, pickle_protocol)
+        self._storage = storage
+        self.jobs_key = jobs_key
+        self.run_times_key = run_times_key
+
+    async def _read_states(self):
+        return await self._storage.run_command(lambda redis: redis.hgetall(self.jobs_key))
+
+    async def _write_change(self, action, job_id, state, timestamp):
+        await self._storage.run_command(
+            lambda redis: self._write(redis, action, job_id, state, timestamp)
+        )
+
+    def _write(self, redis, action, job_id, state, timestamp):
+        transaction = redis.multi_exec()
+        if action == PUT:
+            transaction.hset(self.jobs_key, job_id, state)
+            if timestamp is not None:
+                transaction.zadd(self.run_times_key, timestamp, job_id)
+            else:
+                transaction.zrem(self.run_times_key, job_id)
+        elif action == REMOVE:
+            transaction.hdel(self.jobs_key, job_id)
+            transaction.zrem(self.run_times_key, job_id)
+        else:
+            transaction.delete(self.jobs_key, self.run_times_key)
+        return transaction.execute()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import pickle
+import sqlite3
+from functools import partial
+
+from machine.jobstores.base import PUT, REMOVE, BufferedJobStore
+from machine.utils.aio import build_executor
+
+# Same table as APScheduler's SQLAlchemyJobStore
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS apscheduler_jobs (
+        id VARCHAR(191) PRIMARY KEY,
+        next_run_time FLOAT,
+        job_state BLOB NOT NULL
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_apscheduler_jobs_next_run_time
+        ON apscheduler_jobs (next_run_time)
+    """,
+]
+
+
+class SQLiteJobStore(BufferedJobStore):
+    """Jobstore that keeps jobs in a local SQLite database, so they survive restarts
+
+    Reads are served from memory and changes are written in the background, see
+    :py:class:`~machine.jobstores.base.BufferedJobStore`. All database I/O happens on a single
+    dedicated thread that owns the connection, like in the
+    :py:class:`~machine.storage.backends.sqlite.SQLiteStorage` backend. Jobs are stored in the
+    same table as APScheduler's ``SQLAlchemyJobStore`` uses, indexed by their next run time.
+
+    :param path: path of the database file
+    """
+
+    def __init__(self, path="slack-machine-jobs.db", pickle_protocol=pickle.HIGHEST_PROTOCOL):
+        super().__init__(refresh_interval=0, pickle_protocol=pickle_protocol)
+        self.path = path
+        self._executor = None
+        self._conn = None
+
+    def start(self, scheduler, alias):
+        self._executor = build_executor(max_workers=1, thread_name_prefix="sqlite-jobstore")
+        super().start(scheduler, alias)
+
+    def shutdown(self):
+        super().shutdown()
+        if self._executor is not None:
+            self._executor.submit(self._close)
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, partial(fn, *args))
+
+    def _connection(self):
+        if self._conn is None:
+            # The connection is only ever used from the executor's single thread
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            for statement in SCHEMA:
+                self._conn.execute(statement)
+        return self._conn
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def _read_states(self):
+        return await self._run(self._select_states)
+
+    def _select_states(self):
+        rows = self._connection().execute(
+            "SELECT id, job_state FROM apscheduler_jobs ORDER BY next_run_time"
+        )
+        return dict(rows)
+
+    async def _write_change(self, action, job_id, state, timestamp):
+        await self._run(self._apply_change, action, job_id, state, timestamp)
+
+    def _apply_change(self, action, job_id, state, timestamp):
+        with self._connection() as conn:
+            if action == PUT:
+                conn.execute(
+                    "INSERT OR REPLACE INTO apscheduler_jobs (id, next_run_time, job_state) "
+                    "VALUES (?, ?, ?)",
+                    (job_id, timestamp, state),
+                )
+            elif action == REMOVE:
+                conn.execute("DELETE FROM apscheduler_jobs WHERE id = ?", (job_id,))
+            else:
+                conn.execute("DELETE FROM apscheduler_jobs")
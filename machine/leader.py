@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import time
+import uuid
+
+from loguru import logger
+
+from machine.singletons import Storage
+
+
+class LeaderElection:
+    """Elect a single leader among all Slack Machine processes that share the same storage
+
+    The leader holds a lease, a lock in storage that expires after ``ttl`` seconds and that is
+    renewed every ``ttl / 3`` seconds for as long as the leader is alive. Every other process
+    tries to take the lease at the same interval, so when the leader dies another process takes
+    over within ``ttl + ttl / 3`` seconds.
+
+    A leader that can't renew its lease (eg. because storage can't be reached) steps down before
+    the lease expires, so there is never more than one leader at a time.
+
+    :param key: storage key of the lease
+    :param ttl: number of seconds after which the lease expires when it is not renewed
+    :param on_elected: optional function that is called when this process becomes the leader
+    :param on_demoted: optional function that is called when this process stops being the leader
+    """
+
+    def __init__(self, key, ttl=15, on_elected=None, on_demoted=None):
+        self.key = key
+        self.ttl = ttl
+        self.is_leader = False
+        self.token = None
+        self._on_elected = on_elected
+        self._on_demoted = on_demoted
+        self._owner = uuid.uuid4().hex
+        self._lease_expires = 0
+        self._campaigner = None
+
+    @property
+    def interval(self):
+        return self.ttl / 3
+
+    async def start(self):
+        """Take part in the election, the first attempt to become leader is made right away"""
+        await self.campaign()
+        self._campaigner = asyncio.ensure_future(self._campaign_periodically())
+
+    async def stop(self):
+        """Stop taking part in the election, giving up the lease if this process is the leader"""
+        if self._campaigner is not None:
+            self._campaigner.cancel()
+            self._campaigner = None
+        if self.is_leader:
+            self._demote()
+            try:
+                await Storage.get_instance().release_lock(self.key, self._owner)
+            except Exception:
+                logger.exception("Failed to release the leader lease, it will expire instead")
+
+    async def campaign(self):
+        """Renew the lease if this process is the leader, or try to take it otherwise"""
+        backend = Storage.get_instance()
+        start = time.monotonic()
+        try:
+            if self.is_leader:
+                if not await backend.extend_lock(self.key, self._owner, self.ttl):
+                    logger.warning("Lost the leader lease, it expired before it was renewed")
+                    self._demote()
+                    return
+            else:
+                token = await backend.acquire_lock(self.key, self._owner, self.ttl)
+                if token is None:
+                    return
+                self._elect(token)
+        except Exception:
+            logger.exception("Leader election failed")
+            # Step down if the lease could expire before the next attempt to renew it
+            if self.is_leader and time.monotonic() + self.interval >= self._lease_expires:
+                self._demote()
+            return
+        self._lease_expires = start + self.ttl
+
+    async def _campaign_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.campaign()
+
+    def _elect(self, token):
+        logger.info(f"Elected leader (term {token})")
+        self.is_leader = True
+        self.token = token
+        if self._on_elected is not None:
+            self._on_elected()
+
+    def _demote(self):
+        logger.info(f"Stepping down as leader (term {self.token})")
+        self.is_leader = False
+        self.token = None
+        if self._on_demoted is not None:
+            self._on_demoted()
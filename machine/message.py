@@ -120,10 +120,11 @@ class Message:
         :param attachments: optional attachments (see `attachments`_)
         :param ephemeral: ``True/False`` wether to send the message as an ephemeral message, only
             visible to the sender of the original message
-        :return: None
+        :return: :py:class:`asyncio.Future` that can be cancelled to cancel the message, see
+            :py:meth:`~machine.slack.MessagingClient.send_scheduled`
         """
 
-        self._client.send_scheduled(
+        return self._client.send_scheduled(
             when, self.channel_id, text, **self._handle_context_args(**kwargs)
         )
 
@@ -168,14 +169,15 @@ class Message:
         :param attachments: optional attachments (see `attachments`_)
         :param ephemeral: ``True/False`` wether to send the message as an ephemeral message, only
             visible to the sender of the original message
-        :return: None
+        :return: :py:class:`asyncio.Future` that can be cancelled to cancel the message, see
+            :py:meth:`~machine.slack.MessagingClient.send_scheduled`
         """
         in_thread = kwargs.get("in_thread", False)
         ephemeral = kwargs.get("ephemeral", False)
         if in_thread and not ephemeral:
             text = self._create_reply(text)
 
-        self.say_scheduled(when, text, **self._handle_context_args(**kwargs))
+        return self.say_scheduled(when, text, **self._handle_context_args(**kwargs))
 
     async def reply_dm(self, text, **kwargs):
         """Reply to the sender of the original message with a DM using the WebAPI
@@ -207,9 +209,10 @@ class Message:
         :param when: when you want the message to be sent, as :py:class:`datetime.datetime` instance
         :param text: message text
         :param attachments: optional attachments (see `attachments`_)
-        :return: None
+        :return: :py:class:`asyncio.Future` that can be cancelled to cancel the message, see
+            :py:meth:`~machine.slack.MessagingClient.send_scheduled`
         """
-        self._client.send_dm_scheduled(
+        return self._client.send_dm_scheduled(
             when, self.user_id, text, **self._handle_context_args(**kwargs)
         )
 
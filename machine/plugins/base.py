@@ -34,7 +34,26 @@ class MachineBasePlugin:
         not been initialized yet, so you cannot send or process messages during initialization.
 
         This method can be specified as either synchronous or asynchronous, depending on the needs
-        of the plugin.
+        of the plugin. Asynchronous ``init`` methods of all plugins run at the same time, and are
+        cancelled if they take longer than the ``PLUGIN_INIT_TIMEOUT`` setting. Slow preparations
+        that the plugin can do without, like prefetching data, belong in
+        :py:meth:`~machine.plugins.base.MachineBasePlugin.warm_up` instead.
+
+        :return: None
+        """
+        pass
+
+    def warm_up(self):
+        """Prepare the plugin in the background
+
+        This method can be implemented by concrete plugin classes. It is called **once** for each
+        plugin when Slack Machine starts, after all plugins have been initialized. Slack Machine
+        connects to Slack without waiting for it to finish, so the plugin can receive messages
+        while it's warming up. Use it for work that makes the plugin faster, but that the plugin
+        can do without, like filling caches.
+
+        This method can be specified as either synchronous or asynchronous. Synchronous methods
+        run in a separate thread.
 
         :return: None
         """
@@ -122,7 +141,7 @@ class MachineBasePlugin:
             ephemeral_user=ephemeral_user,
         )
 
-    def say_scheduled(self, when, channel, text, attachments, ephemeral_user):
+    def say_scheduled(self, when, channel, text, attachments=None, ephemeral_user=None):
         """Schedule a message to a channel and send it using the WebAPI
 
         This is the scheduled version of
@@ -134,9 +153,12 @@ class MachineBasePlugin:
         :param attachments: optional attachments (see `attachments`_)
         :param ephemeral_user: optional user name or id if the message needs to visible
             to a specific user only
-        :return: None
+        :return: :py:class:`asyncio.Future` that can be cancelled to cancel the message, see
+            :py:meth:`~machine.slack.MessagingClient.send_scheduled`
         """
-        self._client.send_scheduled(when, channel, text, attachments, ephemeral_user)
+        return self._client.send_scheduled(
+            when, channel, text, attachments=attachments, ephemeral_user=ephemeral_user
+        )
 
     async def react(self, channel, ts, emoji):
         """React to a message in a channel
@@ -184,9 +206,10 @@ class MachineBasePlugin:
         :param when: when you want the message to be sent, as :py:class:`datetime.datetime` instance
         :param text: message text
         :param attachments: optional attachments (see `attachments`_)
-        :return: None
+        :return: :py:class:`asyncio.Future` that can be cancelled to cancel the message, see
+            :py:meth:`~machine.slack.MessagingClient.send_scheduled`
         """
-        self._client.send_dm_scheduled(when, user, text, attachments)
+        return self._client.send_dm_scheduled(when, user, text, attachments=attachments)
 
     def emit(self, event, **kwargs):
         """Emit an event
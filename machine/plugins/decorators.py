@@ -102,12 +102,17 @@ def schedule(
     start_date=None,
     end_date=None,
     timezone=None,
+    jitter=None,
+    coalesce=None,
+    misfire_grace_time=None,
+    max_instances=None,
 ):
     """Schedule a function to be executed according to a crontab-like schedule
 
     The decorated function will be executed according to the schedule provided. Slack Machine uses
     APScheduler under the hood for scheduling. For more information on the interpretation of the
     provided parameters, see :class:`CronTrigger<apscheduler:apscheduler.triggers.cron.CronTrigger>`
+    and :meth:`add_job<apscheduler:apscheduler.schedulers.base.BaseScheduler.add_job>`
 
     :param int|str year: 4-digit year
     :param int|str month: month (1-12)
@@ -121,14 +126,25 @@ def schedule(
     :param datetime|str end_date: latest possible date/time to trigger on (inclusive)
     :param datetime.tzinfo|str timezone: time zone to use for the date/time calculations (defaults
         to scheduler timezone)
+    :param int jitter: run the function up to this many seconds earlier or later than scheduled, to
+        keep functions with the same schedule from running all at once (defaults to the
+        ``SCHEDULER_CRON_JITTER`` setting)
+    :param bool coalesce: run the function once instead of several times when multiple runs were
+        missed
+    :param int misfire_grace_time: number of seconds after the scheduled time during which the
+        function is still run, if it couldn't run in time
+    :param int max_instances: maximum number of runs of the function at the same time
+
+    ``coalesce``, ``misfire_grace_time`` and ``max_instances`` default to the job defaults of the
+    scheduler when they are not set. These are the APScheduler defaults, except for
+    ``misfire_grace_time`` with the Redis jobstore, which defaults to one second more than the
+    ``SCHEDULER_JOBSTORE_REFRESH_INTERVAL`` setting.
     """
     kwargs = locals()
 
     def schedule_decorator(f):
         f.metadata = getattr(f, "metadata", {})
         f.metadata.setdefault("plugin_actions", {})
-        f.metadata["plugin_actions"].setdefault("respond_to", {})
-
         f.metadata["plugin_actions"]["schedule"] = kwargs
         return f
 
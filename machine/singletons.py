@@ -8,7 +8,9 @@ from typing import Optional
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from slack import RTMClient, WebClient
 
+from machine.executors.instrumented import InstrumentedAsyncIOExecutor
 from machine.utils import Singleton
+from machine.utils.metrics import registry
 from machine.utils.module_loading import import_string
 from machine.utils.readonly_proxy import ReadonlyProxy
 from machine.utils.redis import gen_config_dict
@@ -74,10 +76,57 @@ class Scheduler(metaclass=Singleton):
         if settings is None:
             raise ValueError("Expected a settings dictionary, got None")
 
-        self._scheduler = AsyncIOScheduler(event_loop=loop)
-        if "REDIS_URL" in settings:
+        self._jobstore = None
+        job_defaults = {}
+        if settings.get("SCHEDULER_JOBSTORE") == "sqlite":
+            # Keeps jobs across restarts without an external service
+            _, jobstore = import_string("machine.jobstores.sqlite.SQLiteJobStore")[0]
+            self._jobstore = jobstore(
+                settings.get("SCHEDULER_SQLITE_PATH", "slack-machine-jobs.db")
+            )
+        elif "REDIS_URL" in settings:
+            storage = Storage.get_instance()
+            if hasattr(storage, "run_command"):
+                # Share the connection pool of the Redis storage backend, instead of doing
+                # blocking I/O with APScheduler's RedisJobStore
+                _, jobstore = import_string("machine.jobstores.redis.AsyncRedisJobStore")[0]
+                refresh_interval = settings.get("SCHEDULER_JOBSTORE_REFRESH_INTERVAL", 10)
+                self._jobstore = jobstore(storage, refresh_interval=refresh_interval)
+                if refresh_interval:
+                    # Jobs added by other instances are only loaded when the jobs are refreshed,
+                    # so they are allowed to run that much later than they were scheduled
+                    job_defaults["misfire_grace_time"] = refresh_interval + 1
+        self._scheduler = AsyncIOScheduler(
+            event_loop=loop,
+            executors={"default": InstrumentedAsyncIOExecutor()},
+            job_defaults=job_defaults,
+        )
+        if self._jobstore is not None:
+            self._scheduler.add_jobstore(self._jobstore)
+        elif "REDIS_URL" in settings:
             redis_config = gen_config_dict(settings)
             self._scheduler.add_jobstore("redis", **redis_config)
+        # Whether other processes see the jobs of this scheduler, which only Redis offers
+        self.shared_jobstore = (
+            "REDIS_URL" in settings and settings.get("SCHEDULER_JOBSTORE") != "sqlite"
+        )
+
+    async def refresh(self):
+        """Load the jobs that other processes added to the jobstore, if it's loaded in the
+        background"""
+        if self._jobstore is not None:
+            await self._jobstore.refresh()
+
+    async def close(self):
+        """Write pending changes to the jobstore, if it writes changes in the background"""
+        if self._jobstore is not None:
+            await self._jobstore.flush()
+
+    @staticmethod
+    def get_stats():
+        """Return the metrics of scheduled jobs, see
+        :py:class:`~machine.executors.instrumented.InstrumentedAsyncIOExecutor`"""
+        return registry.snapshot("scheduler_")
 
     def __getattr__(self, item):
         return getattr(self._scheduler, item)
@@ -94,6 +143,11 @@ class Storage(metaclass=Singleton):
 
         _, cls = import_string(settings["STORAGE_BACKEND"])[0]
         self._storage = cls(settings)
+        if settings.get("STORAGE_WRITE_BEHIND"):
+            _, write_behind = import_string(
+                "machine.storage.backends.write_behind.WriteBehindStorage"
+            )[0]
+            self._storage = write_behind(self._storage, settings)
 
     def __getattr__(self, item):
         return getattr(self._storage, item)
@@ -1,16 +1,46 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+import math
+import time
+import uuid
 from datetime import datetime
-from typing import Optional, Sequence
+from functools import partial
+from typing import List, Optional, Sequence
 
 from async_lru import alru_cache
+from loguru import logger
+from slack.errors import SlackApiError
 from slack.web.slack_response import SlackResponse
 
 from machine.singletons import Scheduler, Slack
-from machine.utils.aio import run_coro_until_complete
+from machine.utils.aio import RateLimiter, join, run_coro_until_complete
+from machine.utils.timer_wheel import timer_wheel
+
+# Batch jobs are only extended by the process that created them, so processes that share a
+# jobstore don't overwrite each other's batches
+_BATCH_JOB_PREFIX = f"machine.batch:{uuid.uuid4().hex}"
+# Messages that have not been added to their batch job yet, by the second they are due
+_pending_batches = {}
 
 
 class MessagingClient:
+    # Messages that are scheduled more than this many seconds ahead are handed to Slack with
+    # chat.scheduleMessage, instead of being kept by the scheduler until they are due. Configured
+    # with the SLACK_SCHEDULE_MESSAGE_THRESHOLD setting, ``None`` keeps all messages local.
+    schedule_message_threshold: Optional[float] = None
+    # Messages that are scheduled less than this many seconds ahead are kept on a timer wheel in
+    # memory, instead of being added as scheduler jobs. Configured with the
+    # SCHEDULER_TIMER_WHEEL_HORIZON setting, ``None`` adds all messages to the scheduler.
+    timer_wheel_horizon: Optional[float] = None
+    # Messages that the scheduler has to send in the same second are sent by a single job, at no
+    # more than batch_rate_limit messages per second and batch_concurrency at a time. Configured
+    # with the SLACK_BATCH_SCHEDULED_MESSAGES, SLACK_BATCH_RATE_LIMIT and SLACK_BATCH_CONCURRENCY
+    # settings.
+    batch_scheduled_messages: bool = False
+    batch_rate_limit: float = 20
+    batch_concurrency: int = 10
+
     @staticmethod
     def retrieve_bot_info() -> Optional[dict]:
         return Slack.get_instance().login_data.get("self")
@@ -83,10 +113,122 @@ class MessagingClient:
     def fmt_mention(self, user: dict) -> str:
         return f"<@{user['id']}>"
 
-    def send_scheduled(self, when: datetime, channel_id: str, text: str, **kwargs):
+    @staticmethod
+    async def schedule_message(
+        when: datetime,
+        channel_id: str,
+        text: str,
+        *,
+        attachments: Optional[Sequence[dict]] = None,
+        thread_ts: Optional[str] = None,
+    ) -> SlackResponse:
+        payload = {
+            "channel": channel_id,
+            "text": text,
+            "blocks": attachments,
+            "as_user": True,
+            "post_at": int(when.timestamp()),
+        }
+        if thread_ts:
+            payload["thread_ts"] = thread_ts
+
+        return await Slack.get_instance().web.api_call("chat.scheduleMessage", json=payload)
+
+    def _timer_wheel_delay(self, when: datetime) -> Optional[float]:
+        if self.timer_wheel_horizon is None:
+            return None
+        delay = when.timestamp() - time.time()
+        if delay < min(self.timer_wheel_horizon, timer_wheel.horizon):
+            return delay
+        return None
+
+    def _hand_to_slack(self, when: datetime, kwargs: dict) -> bool:
+        if self.schedule_message_threshold is None or kwargs.get("ephemeral_user"):
+            # Slack can't schedule ephemeral messages
+            return False
+        return when.timestamp() - time.time() > self.schedule_message_threshold
+
+    async def _schedule_with_slack(self, when: datetime, channel_id: str, text: str, **kwargs):
+        try:
+            await self.schedule_message(
+                when,
+                channel_id,
+                text,
+                attachments=kwargs.get("attachments"),
+                thread_ts=kwargs.get("thread_ts"),
+            )
+        except Exception:
+            # eg. Slack only schedules messages up to 120 days ahead
+            logger.exception("Slack could not schedule the message, scheduling it locally")
+            self._add_message_job(when, channel_id, text, **kwargs)
+
+    async def _schedule_dm_with_slack(self, when: datetime, user_id: str, text: str, **kwargs):
+        try:
+            dm_channel = await self.open_im(user_id)
+        except Exception:
+            logger.exception("Could not open the DM channel, scheduling the message locally")
+            self._add_dm_job(when, user_id, text, **kwargs)
+            return
+        await self._schedule_with_slack(when, dm_channel, text, **kwargs)
+
+    @staticmethod
+    def _log_failure(future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.opt(exception=future.exception()).error("Failed to send a scheduled message")
+
+    @classmethod
+    def _handle(cls, future: Optional[asyncio.Future] = None) -> asyncio.Future:
+        if future is None:
+            # The message was added to the scheduler right away
+            future = asyncio.get_event_loop().create_future()
+            future.set_result(None)
+        future.add_done_callback(cls._log_failure)
+        return future
+
+    @classmethod
+    def _send_later(cls, delay: float, send) -> asyncio.Future:
+        future = asyncio.get_event_loop().create_future()
+
+        async def send_when_due():
+            try:
+                await send()
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(None)
+
+        timer = timer_wheel.call_later(delay, send_when_due)
+        future.add_done_callback(lambda f: timer.cancel() if f.cancelled() else None)
+        return cls._handle(future)
+
+    def send_scheduled(
+        self, when: datetime, channel_id: str, text: str, **kwargs
+    ) -> asyncio.Future:
+        """Send a message to a channel at a later time
+
+        :return: future that is done once the message has been sent, or has been handed to
+            Slack or the scheduler to be sent later. Failures are logged. Cancelling the future
+            before then cancels the message.
+        """
+        delay = self._timer_wheel_delay(when)
+        if delay is not None:
+            return self._send_later(delay, partial(self.send, channel_id, text, **kwargs))
+        if self._hand_to_slack(when, kwargs):
+            return self._handle(
+                asyncio.ensure_future(self._schedule_with_slack(when, channel_id, text, **kwargs))
+            )
+        self._add_message_job(when, channel_id, text, **kwargs)
+        return self._handle()
+
+    def _add_message_job(self, when: datetime, channel_id: str, text: str, **kwargs):
+        if self.batch_scheduled_messages:
+            self._add_to_batch(when, ["channel", channel_id, text, kwargs])
+            return
         args = [channel_id, text]
         Scheduler.get_instance().add_job(
-            MessagingClient.send,
+            "machine.slack:MessagingClient.send",
             trigger="date",
             args=args,
             kwargs=kwargs,
@@ -97,12 +239,121 @@ class MessagingClient:
         dm_channel = await self.open_im(user_id)
         return await self.send(dm_channel, text=text, **kwargs)
 
-    def send_dm_scheduled(self, when: datetime, user_id: str, text: str, **kwargs):
-        args = [self, user_id, text]
+    def send_dm_scheduled(
+        self, when: datetime, user_id: str, text: str, **kwargs
+    ) -> asyncio.Future:
+        """Send a direct message at a later time
+
+        :return: future like the one returned by :py:meth:`send_scheduled`
+        """
+        delay = self._timer_wheel_delay(when)
+        if delay is not None:
+            return self._send_later(delay, partial(self.send_dm, user_id, text, **kwargs))
+        if self._hand_to_slack(when, kwargs):
+            return self._handle(
+                asyncio.ensure_future(self._schedule_dm_with_slack(when, user_id, text, **kwargs))
+            )
+        self._add_dm_job(when, user_id, text, **kwargs)
+        return self._handle()
+
+    def _add_dm_job(self, when: datetime, user_id: str, text: str, **kwargs):
+        if self.batch_scheduled_messages:
+            self._add_to_batch(when, ["dm", user_id, text, kwargs])
+            return
+        args = [user_id, text]
+        # The job refers to a function instead of pickling the client
         Scheduler.get_instance().add_job(
-            MessagingClient.send_dm,
+            "machine.jobs:send_dm",
             trigger="date",
             args=args,
             kwargs=kwargs,
             run_date=when,
         )
+
+    @staticmethod
+    def _add_to_batch(when: datetime, message: list):
+        # Messages are grouped per second, and sent at the end of that second. The messages that
+        # are added while the event loop runs other code are collected first, and added to their
+        # batch jobs at once, so a persistent jobstore isn't rewritten for every single message.
+        timestamp = math.ceil(when.timestamp())
+        if not _pending_batches:
+            asyncio.get_event_loop().call_soon(MessagingClient._schedule_batches)
+        if timestamp not in _pending_batches:
+            run_date = datetime.fromtimestamp(timestamp, tz=when.tzinfo)
+            _pending_batches[timestamp] = (run_date, [])
+        _pending_batches[timestamp][1].append(message)
+
+    @staticmethod
+    def _schedule_batches():
+        batches = dict(_pending_batches)
+        _pending_batches.clear()
+        scheduler = Scheduler.get_instance()
+        for timestamp, (run_date, messages) in batches.items():
+            job_id = f"{_BATCH_JOB_PREFIX}:{timestamp}"
+            job = scheduler.get_job(job_id)
+            # Jobs that were added before the scheduler started have no next run time yet
+            next_run_time = getattr(job, "next_run_time", None)
+            if job is not None and (
+                next_run_time is None or next_run_time.timestamp() > time.time()
+            ):
+                job.modify(args=[job.args[0] + messages])
+                continue
+            if job is not None:
+                # The batch is due, and might have been picked up by the scheduler of another
+                # process
+                job_id = None
+            scheduler.add_job(
+                "machine.jobs:send_batch",
+                trigger="date",
+                args=[messages],
+                run_date=run_date,
+                id=job_id,
+            )
+
+    async def send_batch(self, messages: List[list]) -> dict:
+        """Send a batch of messages, and return a summary of the results
+
+        Messages are lists of the kind of message (``"channel"`` or ``"dm"``), the channel or user
+        id, the text and the keyword arguments of :py:meth:`send` or :py:meth:`send_dm`. Messages
+        are sent at no more than :py:attr:`batch_rate_limit` per second, with up to
+        :py:attr:`batch_concurrency` at a time. Messages that Slack rate limits are retried after
+        the time Slack asks for.
+        """
+        limiter = RateLimiter(self.batch_rate_limit, burst=self.batch_concurrency)
+        semaphore = asyncio.Semaphore(self.batch_concurrency)
+
+        async def deliver(kind, target, text, kwargs):
+            async with semaphore:
+                for attempt in range(3):
+                    await limiter.acquire()
+                    try:
+                        if kind == "dm":
+                            return await self.send_dm(target, text, **kwargs)
+                        return await self.send(target, text, **kwargs)
+                    except SlackApiError as e:
+                        if e.response.status_code != 429 or attempt == 2:
+                            raise
+                        await asyncio.sleep(float(e.response.headers.get("Retry-After", 1)))
+
+        start = time.monotonic()
+        results = await join([deliver(*message) for message in messages])
+        errors = [
+            {"target": message[1], "error": str(result)}
+            for message, result in zip(messages, results)
+            if isinstance(result, Exception)
+        ]
+        summary = {
+            "total": len(messages),
+            "sent": len(messages) - len(errors),
+            "failed": len(errors),
+            "seconds": time.monotonic() - start,
+            "errors": errors,
+        }
+        logger.info(
+            "Sent batch of {total} scheduled messages in {seconds:.2f}s, {failed} failed",
+            **summary,
+        )
+        for error in errors:
+            logger.warning("Scheduled message to {target} failed: {error}", **error)
+        return summary
+
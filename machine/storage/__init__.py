@@ -1,8 +1,18 @@
 # -*- coding: utf-8 -*-
+import re
+import time
+
 import dill
+from loguru import logger
 
 from machine.singletons import Storage
+from machine.storage.locks import StorageLock, new_lock_stats
 from machine.utils import sizeof_fmt
+from machine.utils.metrics import LATENCY_BUCKETS, SIZE_BUCKETS, registry
+
+# Counters are stored as the digits of the integer, while pickled values always start with the
+# PROTO opcode, so the two can't be confused
+_COUNTER = re.compile(rb"-?[0-9]+")
 
 
 class PluginStorage:
@@ -13,11 +23,73 @@ class PluginStorage:
     the storage backend, and deserialized upon retrieval. Serialization is done by `dill`_, so
     pretty much any Python object can be stored and retrieved.
 
+    A plugin can be given a quota, in which case writes that would push the storage used by the
+    plugin's namespace over the quota are rejected with :py:class:`StorageQuotaExceeded`. The
+    usage of the namespace is retrieved from the backend at most every ``quota_refresh`` seconds
+    and tracked locally in between.
+
+    The time spent serializing, in the backend and deserializing, and the size of the data written
+    and read, are recorded per operation in histograms, see :py:meth:`get_stats`. Operations that
+    take longer than ``slow_threshold`` seconds are logged.
+
     .. _Dill: https://pypi.python.org/pypi/dill
     """
 
-    def __init__(self, fq_plugin_name):
+    def __init__(self, fq_plugin_name, quota=None, quota_refresh=60, slow_threshold=None):
         self._fq_plugin_name = fq_plugin_name
+        self._quota = quota
+        self._quota_refresh = quota_refresh
+        self._slow_threshold = slow_threshold
+        self._usage_bytes = 0
+        self._usage_checked_at = None
+        self._lock_stats = new_lock_stats()
+        self._histograms = {}
+
+    def _histogram(self, name, operation, **labels):
+        # Cache the histograms, finding them in the registry means sorting their labels
+        key = (name, operation, *labels.values())
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            buckets = SIZE_BUCKETS if name == "storage_bytes" else LATENCY_BUCKETS
+            histogram = self._histograms[key] = registry.histogram(
+                name, buckets, plugin=self._fq_plugin_name, operation=operation, **labels
+            )
+        return histogram
+
+    def _observe_time(self, operation, phase, seconds):
+        self._histogram("storage_seconds", operation, phase=phase).observe(seconds)
+        if self._slow_threshold is not None and seconds >= self._slow_threshold:
+            logger.warning(
+                f"Slow storage operation {operation} ({phase}) by {self._fq_plugin_name} "
+                f"took {seconds:.3f}s"
+            )
+
+    async def _call(self, operation, *args):
+        start = time.perf_counter()
+        try:
+            return await getattr(Storage.get_instance(), operation)(*args)
+        finally:
+            self._observe_time(operation, "backend", time.perf_counter() - start)
+
+    def _dumps(self, operation, value):
+        start = time.perf_counter()
+        data = dill.dumps(value)
+        self._observe_time(operation, "serialize", time.perf_counter() - start)
+        self._histogram("storage_bytes", operation, direction="written").observe(len(data))
+        return data
+
+    def _loads(self, operation, data):
+        start = time.perf_counter()
+        value = dill.loads(data)
+        self._observe_time(operation, "deserialize", time.perf_counter() - start)
+        self._histogram("storage_bytes", operation, direction="read").observe(len(data))
+        return value
+
+    def _loads_value(self, operation, data):
+        # Keys that were written by incr() hold a counter instead of a pickled value
+        if isinstance(data, bytes) and _COUNTER.fullmatch(data):
+            return int(data)
+        return self._loads(operation, data)
 
     def _gen_unique_key(self, key):
         separator = ":"
@@ -34,6 +106,28 @@ class PluginStorage:
     def _namespace_key(self, key, shared):
         return key if shared else self._gen_unique_key(key)
 
+    async def _refresh_usage(self):
+        usage = await Storage.get_instance().namespace_usage(self._fq_plugin_name)
+        self._usage_bytes = usage["bytes"]
+        self._usage_checked_at = time.monotonic()
+
+    async def _check_quota(self, namespaced_key, value):
+        write_size = len(namespaced_key) + len(value)
+        if (
+            self._usage_checked_at is None
+            or time.monotonic() - self._usage_checked_at > self._quota_refresh
+        ):
+            await self._refresh_usage()
+        elif self._usage_bytes + write_size > self._quota:
+            # Writes are tracked pessimistically (overwrites are counted as new data), so
+            # make sure we are really over the quota before rejecting the write.
+            if time.monotonic() - self._usage_checked_at > 1:
+                await self._refresh_usage()
+
+        if self._usage_bytes + write_size > self._quota:
+            raise StorageQuotaExceeded(self._fq_plugin_name, self._quota)
+        self._usage_bytes += write_size
+
     async def set(self, key, value, expires=None, shared=False):
         """Store or update a value by key
 
@@ -42,25 +136,405 @@ class PluginStorage:
         :param expires: optional number of seconds after which the data is expired
         :param shared: ``True/False`` whether this data should be shared by other plugins.  Use with
             care, because it pollutes the global namespace of the storage.
+        :raises StorageQuotaExceeded: if the plugin has a quota and storing the data would exceed it.
+            Shared data does not count towards the quota.
         """
         namespaced_key = self._namespace_key(key, shared)
-        pickled_value = dill.dumps(value)
-        await Storage.get_instance().set(namespaced_key, pickled_value, expires)
+        pickled_value = self._dumps("set", value)
+        if self._quota is not None and not shared:
+            await self._check_quota(namespaced_key, pickled_value)
+        await self._call("set", namespaced_key, pickled_value, expires)
 
-    async def get(self, key, shared=False):
+    async def get(self, key, shared=False, refresh_ttl=None):
         """Retrieve data by key
 
         :param key: key for the data to retrieve
         :param shared: ``True/False`` whether to retrieve data from the shared (global) namespace.
+        :param refresh_ttl: optional number of seconds after which the data should expire,
+            counting from now. This makes data expire a fixed time after it was last used, like
+            a session, without having to store it again.
         :return: the data, or ``None`` if the key cannot be found/has expired
         """
         namespaced_key = self._namespace_key(key, shared)
-        value = await Storage.get_instance().get(namespaced_key)
+        if refresh_ttl is None:
+            value = await self._call("get", namespaced_key)
+        else:
+            value = await self._call("get_and_touch", namespaced_key, refresh_ttl)
         if value:
-            return dill.loads(value)
+            return self._loads_value("get", value)
         else:
             return None
 
+    async def touch(self, key, expires, shared=False):
+        """Set a new expiration time for a key, without retrieving or storing its data
+
+        :param key: the key for which to set the expiration time
+        :param expires: number of seconds after which the data should expire, counting from now
+        :param shared: ``True/False`` whether the key is in the shared (global) namespace
+        :return: ``True/False`` whether the key exists
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        return await self._call("touch", namespaced_key, expires)
+
+    async def ttl(self, key, shared=False):
+        """Retrieve the number of seconds until a key expires
+
+        :param key: the key for which to retrieve the time to live
+        :param shared: ``True/False`` whether the key is in the shared (global) namespace
+        :return: the number of seconds (rounded up), or ``None`` if the key does not expire or
+            cannot be found
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        return await self._call("ttl", namespaced_key)
+
+    async def incr(self, key, amount=1, expires=None, shared=False):
+        """Atomically increment a counter
+
+        Counters are stored as plain integers instead of being serialized with `dill`_, so the
+        increment can happen inside the storage backend without reading the value first, and
+        concurrent increments (eg. from multiple bot instances) never get lost. Use
+        :py:meth:`get_counter` to read a counter. :py:meth:`get` and :py:meth:`iter_items` return
+        counters as ``int`` too.
+
+        :param key: key of the counter. A counter that does not exist yet starts at ``0``
+        :param amount: amount to increment the counter by
+        :param expires: optional number of seconds after which the counter is expired. The
+            expiration is set when the counter is created and not extended by later increments,
+            which makes this convenient for rate limiting.
+        :param shared: ``True/False`` whether this counter should be shared by other plugins
+        :return: the value of the counter after incrementing
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        return await self._call("incr", namespaced_key, amount, expires)
+
+    async def decr(self, key, amount=1, expires=None, shared=False):
+        """Atomically decrement a counter
+
+        This is the same as calling :py:meth:`incr` with a negative ``amount``.
+
+        :return: the value of the counter after decrementing
+        """
+        return await self.incr(key, -amount, expires, shared)
+
+    async def get_counter(self, key, shared=False):
+        """Retrieve the value of a counter
+
+        :param key: key of the counter
+        :param shared: ``True/False`` whether to retrieve the counter from the shared (global)
+            namespace
+        :return: the value of the counter, or ``0`` if the counter cannot be found/has expired
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        value = await self._call("get", namespaced_key)
+        return int(value) if value else 0
+
+    async def set_if_absent(self, key, value, expires=None, shared=False):
+        """Atomically store a value, only if the key does not exist yet
+
+        :param key: the key under which to store the data
+        :param value: the data to store
+        :param expires: optional number of seconds after which the data is expired
+        :param shared: ``True/False`` whether this data should be shared by other plugins
+        :return: ``True/False`` whether the value was stored
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        pickled_value = self._dumps("set_if_absent", value)
+        if self._quota is not None and not shared:
+            await self._check_quota(namespaced_key, pickled_value)
+        return await self._call("set_if_absent", namespaced_key, pickled_value, expires)
+
+    async def compare_and_set(self, key, expected, value, expires=None, shared=False):
+        """Atomically replace a value, only if it has not changed since it was read
+
+        This can be used to safely do read-modify-write cycles when multiple handlers might update
+        the same key at the same time::
+
+            while True:
+                current = await self.storage.get("scores")
+                updated = {**(current or {}), user: score}
+                if await self.storage.compare_and_set("scores", current, updated):
+                    break
+
+        Values are compared in their serialized form.
+
+        :param key: the key under which to store the data
+        :param expected: the value that is expected to be stored under the key currently, or
+            ``None`` if the key is expected not to exist
+        :param value: the data to store
+        :param expires: optional number of seconds after which the data is expired
+        :param shared: ``True/False`` whether this data should be shared by other plugins
+        :return: ``True/False`` whether the value was replaced
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        pickled_expected = None if expected is None else self._dumps("compare_and_set", expected)
+        pickled_value = self._dumps("compare_and_set", value)
+        if self._quota is not None and not shared:
+            await self._check_quota(namespaced_key, pickled_value)
+        return await self._call(
+            "compare_and_set", namespaced_key, pickled_expected, pickled_value, expires
+        )
+
+    async def _collection_call(self, operation, *args):
+        backend = Storage.get_instance()
+        if not backend.supports_collections:
+            raise CollectionsNotSupported(type(backend).__name__)
+        return await self._call(operation, *args)
+
+    async def _check_collection_quota(self, namespaced_key, pickled_values, shared):
+        if self._quota is not None and not shared:
+            await self._check_quota(namespaced_key, b"".join(pickled_values))
+
+    async def list_push(self, key, *values, left=False, shared=False):
+        """Add values to the end of a list
+
+        Lists, sets, hashes and sorted sets are stored under a single key, but can be updated an
+        element at a time, without reading and writing the whole collection. Elements are
+        serialized with `dill`_ just like regular values::
+
+            await self.storage.list_push("queue", job)
+            job = await self.storage.list_pop("queue", left=True)
+
+        :param key: key of the list
+        :param values: the values to add
+        :param left: ``True/False`` whether to add the values to the start of the list instead
+        :param shared: ``True/False`` whether this list should be shared by other plugins
+        :return: the length of the list after adding the values
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        pickled_values = [self._dumps("list_push", value) for value in values]
+        await self._check_collection_quota(namespaced_key, pickled_values, shared)
+        return await self._collection_call("list_push", namespaced_key, pickled_values, left)
+
+    async def list_pop(self, key, left=False, shared=False):
+        """Remove and return the last value of a list
+
+        :param key: key of the list
+        :param left: ``True/False`` whether to pop the first value of the list instead
+        :param shared: ``True/False`` whether to use the shared (global) namespace
+        :return: the value, or ``None`` if the list is empty
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        value = await self._collection_call("list_pop", namespaced_key, left)
+        return None if value is None else self._loads("list_pop", value)
+
+    async def list_range(self, key, start=0, end=-1, shared=False):
+        """Retrieve a range of values from a list
+
+        :param key: key of the list
+        :param start: index of the first value to return
+        :param end: index of the last value to return (inclusive). Negative indices count from the
+            end of the list, so by default the whole list is returned.
+        :param shared: ``True/False`` whether to use the shared (global) namespace
+        :return: list of values
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        values = await self._collection_call("list_range", namespaced_key, start, end)
+        return [self._loads("list_range", value) for value in values]
+
+    async def list_length(self, key, shared=False):
+        """Calculate the length of a list
+
+        :param key: key of the list
+        :param shared: ``True/False`` whether to use the shared (global) namespace
+        :return: the number of values in the list
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        return await self._collection_call("list_length", namespaced_key)
+
+    async def set_add(self, key, *members, shared=False):
+        """Add members to a set
+
+        Members are compared in their serialized form.
+
+        :param key: key of the set
+        :param members: the members to add
+        :param shared: ``True/False`` whether this set should be shared by other plugins
+        :return: the number of members that were not in the set yet
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        pickled_members = [self._dumps("set_add", member) for member in members]
+        await self._check_collection_quota(namespaced_key, pickled_members, shared)
+        return await self._collection_call("set_add", namespaced_key, pickled_members)
+
+    async def set_remove(self, key, *members, shared=False):
+        """Remove members from a set
+
+        :param key: key of the set
+        :param members: the members to remove
+        :param shared: ``True/False`` whether to use the shared (global) namespace
+        :return: the number of members that were removed
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        pickled_members = [self._dumps("set_remove", member) for member in members]
+        return await self._collection_call("set_remove", namespaced_key, pickled_members)
+
+    async def set_members(self, key, shared=False):
+        """Retrieve all members of a set
+
+        :param key: key of the set
+        :param shared: ``True/False`` whether to use the shared (global) namespace
+        :return: list of members
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        members = await self._collection_call("set_members", namespaced_key)
+        return [self._loads("set_members", member) for member in members]
+
+    async def set_contains(self, key, member, shared=False):
+        """Check if a member is part of a set
+
+        :param key: key of the set
+        :param member: the member to check
+        :param shared: ``True/False`` whether to use the shared (global) namespace
+        :return: ``True/False`` whether the member is part of the set
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        pickled_member = self._dumps("set_contains", member)
+        return await self._collection_call("set_contains", namespaced_key, pickled_member)
+
+    async def hash_set(self, key, field, value, shared=False):
+        """Store a value under a field of a hash
+
+        :param key: key of the hash
+        :param field: name of the field (string)
+        :param value: the value to store
+        :param shared: ``True/False`` whether this hash should be shared by other plugins
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        pickled_value = self._dumps("hash_set", value)
+        await self._check_collection_quota(namespaced_key, [pickled_value], shared)
+        await self._collection_call("hash_set", namespaced_key, field, pickled_value)
+
+    async def hash_get(self, key, field, shared=False):
+        """Retrieve the value of a field of a hash
+
+        :param key: key of the hash
+        :param field: name of the field
+        :param shared: ``True/False`` whether to use the shared (global) namespace
+        :return: the value, or ``None`` if the field does not exist
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        value = await self._collection_call("hash_get", namespaced_key, field)
+        return None if value is None else self._loads("hash_get", value)
+
+    async def hash_get_all(self, key, shared=False):
+        """Retrieve all fields of a hash
+
+        :param key: key of the hash
+        :param shared: ``True/False`` whether to use the shared (global) namespace
+        :return: dictionary mapping fields to values
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        fields = await self._collection_call("hash_get_all", namespaced_key)
+        return {
+            field.decode("utf-8")
+            if isinstance(field, bytes)
+            else field: self._loads("hash_get_all", value)
+            for field, value in fields.items()
+        }
+
+    async def hash_delete(self, key, *fields, shared=False):
+        """Remove fields from a hash
+
+        :param key: key of the hash
+        :param fields: names of the fields to remove
+        :param shared: ``True/False`` whether to use the shared (global) namespace
+        :return: the number of fields that were removed
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        return await self._collection_call("hash_delete", namespaced_key, list(fields))
+
+    async def sorted_set_add(self, key, scores, shared=False):
+        """Add members to a sorted set, or update their scores
+
+        Members are ordered by score, which makes sorted sets a good fit for leaderboards::
+
+            await self.storage.sorted_set_increment("karma", user_id)
+            top_10 = await self.storage.sorted_set_range("karma", 0, 9, reverse=True)
+
+        :param key: key of the sorted set
+        :param scores: dictionary mapping members to their score
+        :param shared: ``True/False`` whether this sorted set should be shared by other plugins
+        :return: the number of members that were not in the sorted set yet
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        pickled_scores = {
+            self._dumps("sorted_set_add", member): score for member, score in scores.items()
+        }
+        await self._check_collection_quota(namespaced_key, pickled_scores, shared)
+        return await self._collection_call("sorted_set_add", namespaced_key, pickled_scores)
+
+    async def sorted_set_increment(self, key, member, amount=1, shared=False):
+        """Increment the score of a member of a sorted set
+
+        :param key: key of the sorted set
+        :param member: the member, added with a score of ``0`` if it is not in the sorted set yet
+        :param amount: amount to increment the score by
+        :param shared: ``True/False`` whether this sorted set should be shared by other plugins
+        :return: the score after incrementing
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        pickled_member = self._dumps("sorted_set_increment", member)
+        await self._check_collection_quota(namespaced_key, [pickled_member], shared)
+        return await self._collection_call(
+            "sorted_set_increment", namespaced_key, pickled_member, amount
+        )
+
+    async def sorted_set_remove(self, key, *members, shared=False):
+        """Remove members from a sorted set
+
+        :param key: key of the sorted set
+        :param members: the members to remove
+        :param shared: ``True/False`` whether to use the shared (global) namespace
+        :return: the number of members that were removed
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        pickled_members = [self._dumps("sorted_set_remove", member) for member in members]
+        return await self._collection_call("sorted_set_remove", namespaced_key, pickled_members)
+
+    async def sorted_set_score(self, key, member, shared=False):
+        """Retrieve the score of a member of a sorted set
+
+        :param key: key of the sorted set
+        :param member: the member
+        :param shared: ``True/False`` whether to use the shared (global) namespace
+        :return: the score, or ``None`` if the member is not in the sorted set
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        pickled_member = self._dumps("sorted_set_score", member)
+        return await self._collection_call("sorted_set_score", namespaced_key, pickled_member)
+
+    async def sorted_set_rank(self, key, member, reverse=False, shared=False):
+        """Retrieve the position of a member in a sorted set
+
+        :param key: key of the sorted set
+        :param member: the member
+        :param reverse: ``True/False`` whether to count from the highest score
+        :param shared: ``True/False`` whether to use the shared (global) namespace
+        :return: the 0-based position, or ``None`` if the member is not in the sorted set
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        pickled_member = self._dumps("sorted_set_rank", member)
+        return await self._collection_call(
+            "sorted_set_rank", namespaced_key, pickled_member, reverse
+        )
+
+    async def sorted_set_range(self, key, start=0, end=-1, reverse=False, shared=False):
+        """Retrieve a range of members of a sorted set by position, with their scores
+
+        :param key: key of the sorted set
+        :param start: position of the first member to return
+        :param end: position of the last member to return (inclusive). Negative positions count
+            from the end, so by default all members are returned.
+        :param reverse: ``True/False`` whether to order the members from highest to lowest score
+        :param shared: ``True/False`` whether to use the shared (global) namespace
+        :return: list of ``(member, score)`` tuples
+        """
+        namespaced_key = self._namespace_key(key, shared)
+        members = await self._collection_call(
+            "sorted_set_range", namespaced_key, start, end, reverse
+        )
+        return [(self._loads("sorted_set_range", member), score) for member, score in members]
+
     async def has(self, key, shared=False):
         """Check if the key exists in storage
 
@@ -75,7 +549,7 @@ class PluginStorage:
             expired.
         """
         namespaced_key = self._namespace_key(key, shared)
-        return await Storage.get_instance().has(namespaced_key)
+        return await self._call("has", namespaced_key)
 
     async def delete(self, key, shared=False):
         """Remove a key and its data from storage
@@ -85,7 +559,30 @@ class PluginStorage:
             namespace
         """
         namespaced_key = self._namespace_key(key, shared)
-        await Storage.get_instance().delete(namespaced_key)
+        await self._call("delete", namespaced_key)
+
+    async def clear(self, pattern=None, shared=False):
+        """Remove all keys matching a pattern, and their data, from storage
+
+        This is a lot faster than deleting the keys returned by :py:meth:`find_keys` one by one,
+        because backends delete the keys in bulk. On Redis, keys are removed with ``UNLINK`` as
+        they are found, so Redis is not blocked while the memory is reclaimed.
+
+        :param pattern: pattern of the keys to remove, or ``None`` to remove all data of the
+            plugin
+        :param shared: ``True/False`` whether the keys to remove are in the shared (global)
+            namespace. A pattern is required to remove shared keys.
+        :return: the number of keys that were removed
+        """
+        if pattern is None:
+            if shared:
+                raise ValueError("A pattern is required to clear shared data")
+            pattern = "*"
+        namespaced_ptn = self._namespace_key(pattern, shared)
+        deleted = await self._call("delete_matching", namespaced_ptn)
+        # Let the quota check find out how much data is left
+        self._usage_checked_at = None
+        return deleted
 
     async def find_keys(self, pattern, shared=False):
         """ Find all keys matching the pattern.
@@ -96,11 +593,122 @@ class PluginStorage:
             :return: iterable over matching keys
         """
         namespaced_ptn = self._namespace_key(pattern, shared)
-        return await Storage.get_instance().find_keys(namespaced_ptn)
+        return await self._call("find_keys", namespaced_ptn)
+
+    async def iter_keys(self, pattern, shared=False, count=None):
+        """Iterate over all keys matching the pattern, as they are retrieved from the backend.
+
+        Unlike :py:meth:`find_keys`, this does not collect all keys before returning, so it
+        can be used to process large numbers of keys incrementally::
+
+            async for key in self.storage.iter_keys("session:*"):
+                ...
+
+        :param pattern: pattern to search for
+        :param shared: ``True/False`` whether the search should occur on the shared (global)
+            namespace
+        :param count: optional hint for the number of keys to fetch from the backend at once
+        :return: async iterator over matching keys
+        """
+        namespaced_ptn = self._namespace_key(pattern, shared)
+        async for key in Storage.get_instance().iter_keys(namespaced_ptn, count=count):
+            yield key
+
+    async def iter_items(self, pattern, shared=False, count=None):
+        """Iterate over all keys matching the pattern together with their data.
+
+        Data is retrieved in batches where the backend supports it, so this is a lot cheaper
+        than calling :py:meth:`get` for every key returned by :py:meth:`iter_keys`.
+
+        :param pattern: pattern to search for
+        :param shared: ``True/False`` whether the search should occur on the shared (global)
+            namespace
+        :param count: optional hint for the number of keys to fetch from the backend at once
+        :return: async iterator over ``(key, data)`` tuples. The data of counters, see
+            :py:meth:`incr`, is an ``int``.
+        """
+        namespaced_ptn = self._namespace_key(pattern, shared)
+        items = Storage.get_instance().iter_items(namespaced_ptn, count=count)
+        async for key, value in items:
+            yield key, self._loads_value("iter_items", value)
+
+    def lock(self, name, ttl=30, timeout=None, renew=True, shared=False):
+        """Create a lock that is shared by all Slack Machine processes using the same storage
+
+        Use the lock as an async context manager to make sure only one handler at a time, in any
+        process, works on something::
+
+            async with self.storage.lock("deploy", timeout=10) as lock:
+                await deploy(fencing_token=lock.token)
+
+        The lock expires after ``ttl`` seconds, so it is released even if the process holding it
+        dies. While the lock is held, it is extended in the background so long-running work is
+        not interrupted.
+
+        :param name: name of the lock
+        :param ttl: number of seconds after which the lock expires if it's not extended
+        :param timeout: maximum number of seconds to wait for the lock, or ``None`` to wait
+            indefinitely
+        :param renew: ``True/False`` whether to extend the lock automatically while it is held
+        :param shared: ``True/False`` whether this lock should be shared by other plugins
+        :return: a :py:class:`~machine.storage.locks.StorageLock`. Acquiring it raises
+            :py:class:`~machine.storage.locks.LockTimeout` if it can't be acquired in time.
+        """
+        key = self._namespace_key("lock:" + name, shared)
+        return StorageLock(key, ttl, timeout, renew, stats=self._lock_stats)
+
+    def get_lock_stats(self):
+        """Statistics about the locks used by this plugin
+
+        :return: dictionary with the number of locks ``acquired``, the number of ``timeouts`` and
+            the number of locks ``lost`` because they couldn't be extended, and the total, mean and
+            maximum time spent waiting for a lock
+        """
+        acquired = self._lock_stats["acquired"]
+        total = self._lock_stats["wait_seconds_total"]
+        return {**self._lock_stats, "wait_seconds_mean": total / acquired if acquired else 0.0}
+
+    def get_stats(self):
+        """Statistics about the storage operations of this plugin
+
+        Every operation is timed in three phases: ``serialize``, ``backend`` and ``deserialize``
+        (the ``storage_seconds`` histograms), and the size of the serialized data that is
+        ``written`` and ``read`` is recorded as well (the ``storage_bytes`` histograms).
+
+        :return: list of dictionaries with the ``name`` and ``labels`` of a histogram, and the
+            ``count``, ``sum``, ``mean``, ``max``, ``p50``, ``p95`` and ``p99`` of its values
+        """
+        return [
+            histogram
+            for histogram in registry.snapshot("storage_")
+            if histogram["labels"].get("plugin") == self._fq_plugin_name
+        ]
+
+    async def get_usage(self):
+        """Calculate the storage used by this plugin
+
+        Only data in the plugin's own namespace is taken into account, not shared data. Depending
+        on the backend, the number of bytes is exact (in-memory) or an estimate (Redis).
+
+        :return: dictionary with the number of ``keys`` stored by this plugin and the ``bytes``
+            they use
+        """
+        return await Storage.get_instance().namespace_usage(self._fq_plugin_name)
+
+    async def get_usage_human(self):
+        """Calculate the storage used by this plugin in human readable format
+
+        :return: the number of bytes used by this plugin in a human readable string, see
+            :py:meth:`get_storage_size_human`
+        """
+        return sizeof_fmt((await self.get_usage())["bytes"])
 
     async def get_storage_size(self):
         """Calculate the total size of the storage
 
+        This is the size of the storage backend as a whole, including the data of other plugins.
+        Use :py:meth:`get_usage` for the storage used by the current plugin.
+
         :return: the total size of the storage in bytes (integer)
         """
         return await Storage.get_instance().size()
@@ -112,3 +720,30 @@ class PluginStorage:
             applicable division. eg. B for Bytes, KiB for Kilobytes, MiB for Megabytes etc.
         """
         return sizeof_fmt(await self.get_storage_size())
+
+
+class StorageQuotaExceeded(Exception):
+    def __init__(self, namespace, quota):
+        super().__init__()
+        self.namespace = namespace
+        self.quota = quota
+        self.message = "Storage quota of {} exceeded for {}".format(
+            sizeof_fmt(quota), namespace
+        )
+
+    def __repr__(self):
+        return self.message
+
+    __str__ = __repr__
+
+
+class CollectionsNotSupported(NotImplementedError):
+    def __init__(self, backend):
+        super().__init__()
+        self.backend = backend
+        self.message = "The {} storage backend does not support collections".format(backend)
+
+    def __repr__(self):
+        return self.message
+
+    __str__ = __repr__
@@ -0,0 +1,481 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import math
+import mmap
+import os
+import struct
+import time
+import uuid
+import zlib
+from collections import namedtuple
+from fnmatch import fnmatchcase
+
+from loguru import logger
+
+from machine.storage.backends.base import LocalLocksMixin, MachineBaseStorage
+from machine.utils.aio import run_in_threadpool
+from machine.utils.collections import SortedKeyIndex, glob_prefix
+
+# The data log starts with a magic string and a generation id, followed by records. Every record
+# is a header (crc32, flags, expires_at, key length, value length) followed by the key and value.
+DATA_HEADER = struct.Struct("<8s16s")
+RECORD_HEADER = struct.Struct("<IBdII")
+MAGIC = b"SMAOF001"
+
+# The hint file repeats the generation id of the data log it describes and how many bytes of the
+# log it covers, followed by an entry (record start, record size, flags, expires_at, key length)
+# plus the key for every live record.
+HINT_HEADER = struct.Struct("<16sQ")
+HINT_ENTRY = struct.Struct("<QIBdI")
+
+FLAG_TOMBSTONE = 1
+FLAG_TEXT = 2
+
+# Fencing tokens of locks are stored in the log under keys with this prefix, so they survive a
+# restart. They are left out of the key index, so data operations never see them.
+FENCE_PREFIX = "\x00fence:"
+
+_Entry = namedtuple("_Entry", "start size key_len flags expires_at")
+
+
+def _value_range(entry):
+    value_start = entry.start + RECORD_HEADER.size + entry.key_len
+    return value_start, entry.start + entry.size
+
+
+def _expired(entry, now):
+    return entry.expires_at is not None and entry.expires_at <= now
+
+
+def _encode_record(key, value, flags, expires_at):
+    key = key.encode("utf-8")
+    if isinstance(value, str):
+        value, flags = value.encode("utf-8"), flags | FLAG_TEXT
+    header = RECORD_HEADER.pack(0, flags, expires_at or 0.0, len(key), len(value))
+    crc = zlib.crc32(value, zlib.crc32(key, zlib.crc32(header[4:])))
+    return struct.pack("<I", crc) + header[4:] + key + value, len(key), flags
+
+
+def _scan(buf, pos, entries, base=0):
+    """Apply the records in ``buf`` starting at ``pos`` to ``entries``
+
+    Scanning stops at the end of the buffer, or at the first record that is truncated or
+    corrupt (ie. because of a crash while it was being written). ``base`` is the position of
+    ``buf`` in the data log, when only part of the log is scanned.
+
+    :return: the position after the last valid record, and the number of bytes taken up by
+        records that have been overwritten or deleted
+    """
+    dead = 0
+    end = len(buf)
+    while pos + RECORD_HEADER.size <= end:
+        crc, flags, expires_at, key_len, value_len = RECORD_HEADER.unpack_from(buf, pos)
+        size = RECORD_HEADER.size + key_len + value_len
+        if pos + size > end:
+            break
+        body = buf[pos + 4 : pos + size]
+        if zlib.crc32(body) != crc:
+            break
+        key_start = pos + RECORD_HEADER.size
+        key = bytes(buf[key_start : key_start + key_len]).decode("utf-8")
+
+        previous = entries.pop(key, None)
+        if previous is not None:
+            dead += previous.size
+        if flags & FLAG_TOMBSTONE:
+            dead += size
+        else:
+            entries[key] = _Entry(base + pos, size, key_len, flags, expires_at or None)
+        pos += size
+    return pos, dead
+
+
+def _build_index(entries):
+    return SortedKeyIndex(sorted(key for key in entries if not key.startswith(FENCE_PREFIX)))
+
+
+class AppendOnlyFileStorage(LocalLocksMixin, MachineBaseStorage):
+    """Storage backend that persists data in an append-only log on local disk
+
+    Every write is appended to the log, and an in-memory index maps each key to the location of
+    its latest value. Values are read straight from the log through a memory map, so reads never
+    touch the disk when the file is in the page cache. Deletes are recorded as tombstones and the
+    expiration time of a key is stored with its value.
+
+    Overwritten, deleted and expired data is removed by periodically compacting the log into a
+    new file. Compaction also writes a hint file with the index, so on restart the index is loaded
+    from the hint file and only records written after the last compaction have to be scanned.
+
+    The log is meant to be used by a single process, so locks are kept in memory. Their fencing
+    tokens are written to the log, so they keep increasing after a restart.
+    """
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self._path = settings.get("AOF_STORAGE_PATH", "slack-machine-data")
+        self._fsync = settings.get("AOF_FSYNC", False)
+        self._compaction_interval = settings.get("AOF_COMPACTION_INTERVAL", 300)
+        self._compaction_ratio = settings.get("AOF_COMPACTION_RATIO", 0.5)
+        self._entries = {}
+        self._index = SortedKeyIndex()
+        self._writer = None
+        self._reader = None
+        self._mmap = None
+        self._size = 0
+        self._dead_bytes = 0
+        self._compacting = False
+        self._compactor = None
+
+    @property
+    def _data_path(self):
+        return os.path.join(self._path, "data.log")
+
+    @property
+    def _hint_path(self):
+        return os.path.join(self._path, "data.hint")
+
+    async def connect(self):
+        os.makedirs(self._path, exist_ok=True)
+        await run_in_threadpool(self._load)()
+        self._open()
+        if self._compaction_interval:
+            self._compactor = asyncio.ensure_future(self._compact_periodically())
+
+    async def close(self):
+        if self._compactor is not None:
+            self._compactor.cancel()
+            self._compactor = None
+        if self._writer is not None:
+            await run_in_threadpool(os.fsync)(self._writer.fileno())
+            self._close()
+            self._writer = None
+
+    def _open(self):
+        self._writer = open(self._data_path, "ab")
+        self._reader = open(self._data_path, "rb")
+        self._mmap = None
+
+    def _close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        self._writer.close()
+        self._reader.close()
+
+    def _load(self):
+        if not os.path.exists(self._data_path):
+            with open(self._data_path, "wb") as f:
+                f.write(DATA_HEADER.pack(MAGIC, uuid.uuid4().bytes))
+
+        with open(self._data_path, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                magic, generation = DATA_HEADER.unpack_from(buf, 0)
+                if magic != MAGIC:
+                    raise ValueError(f"{self._data_path} is not a Slack Machine data log")
+                entries, pos = self._read_hint(generation, len(buf))
+                if pos == DATA_HEADER.size < len(buf):
+                    logger.info(f"Scanning {self._data_path} to rebuild the index...")
+                end, dead = _scan(buf, pos, entries)
+                size = len(buf)
+            finally:
+                buf.close()
+
+        if end < size:
+            logger.warning(
+                f"Truncating {size - end} bytes of incomplete records from {self._data_path}"
+            )
+            os.truncate(self._data_path, end)
+
+        now = time.time()
+        for key, entry in list(entries.items()):
+            if _expired(entry, now):
+                del entries[key]
+                dead += entry.size
+
+        self._entries = entries
+        self._index = _build_index(entries)
+        self._size = end
+        self._dead_bytes = dead
+
+    def _read_hint(self, generation, size):
+        """Load the index from the hint file, if it belongs to the current data log
+
+        :return: the index, and the position in the data log from where records still have to be
+            scanned
+        """
+        try:
+            with open(self._hint_path, "rb") as f:
+                hint = f.read()
+        except FileNotFoundError:
+            return {}, DATA_HEADER.size
+
+        hint_generation, covered = HINT_HEADER.unpack_from(hint, 0)
+        if hint_generation != generation or covered > size:
+            return {}, DATA_HEADER.size
+
+        entries = {}
+        pos = HINT_HEADER.size
+        while pos < len(hint):
+            start, record_size, flags, expires_at, key_len = HINT_ENTRY.unpack_from(hint, pos)
+            pos += HINT_ENTRY.size
+            key = hint[pos : pos + key_len].decode("utf-8")
+            pos += key_len
+            entries[key] = _Entry(start, record_size, key_len, flags, expires_at or None)
+        return entries, covered
+
+    def _append(self, key, value, flags=0, expires_at=None):
+        record, key_len, flags = _encode_record(key, value, flags, expires_at)
+        self._writer.write(record)
+        self._writer.flush()
+        if self._fsync:
+            os.fsync(self._writer.fileno())
+
+        entry = _Entry(self._size, len(record), key_len, flags, expires_at)
+        self._size += len(record)
+        return entry
+
+    def _put(self, key, value, expires_at):
+        entry = self._append(key, value, 0, expires_at)
+        previous = self._entries.get(key)
+        if previous is None:
+            if not key.startswith(FENCE_PREFIX):
+                self._index.add(key)
+        else:
+            self._dead_bytes += previous.size
+        self._entries[key] = entry
+
+    def _remove(self, key, tombstone=True):
+        entry = self._entries.pop(key)
+        self._index.remove(key)
+        self._dead_bytes += entry.size
+        if tombstone:
+            self._dead_bytes += self._append(key, b"", FLAG_TOMBSTONE).size
+
+    def _read(self, entry):
+        start, end = _value_range(entry)
+        if self._mmap is None or len(self._mmap) < end:
+            # The log has grown since it was mapped
+            if self._mmap is not None:
+                self._mmap.close()
+            self._mmap = mmap.mmap(self._reader.fileno(), 0, access=mmap.ACCESS_READ)
+        value = self._mmap[start:end]
+        return value.decode("utf-8") if entry.flags & FLAG_TEXT else value
+
+    def _lookup(self, key):
+        key = self._key(key)
+        entry = self._entries.get(key)
+        if entry is not None and _expired(entry, time.time()):
+            # The expiration time is part of the record, so there is no need for a tombstone
+            self._remove(key, tombstone=False)
+            return None
+        return entry
+
+    @staticmethod
+    def _key(key):
+        return key.decode("utf-8") if isinstance(key, bytes) else key
+
+    @staticmethod
+    def _expires_at(expires):
+        return time.time() + expires if expires else None
+
+    def _next_fencing_token(self, key):
+        fence_key = FENCE_PREFIX + self._key(key)
+        entry = self._entries.get(fence_key)
+        token = (int(self._read(entry)) if entry is not None else 0) + 1
+        self._put(fence_key, str(token).encode("utf-8"), None)
+        return token
+
+    async def get(self, key):
+        entry = self._lookup(key)
+        return None if entry is None else self._read(entry)
+
+    async def set(self, key, value, expires=None):
+        self._put(self._key(key), value, self._expires_at(expires))
+
+    async def set_many(self, items, expires=None):
+        expires_at = self._expires_at(expires)
+        for key, value in items.items():
+            self._put(self._key(key), value, expires_at)
+
+    async def incr(self, key, amount=1, expires=None):
+        entry = self._lookup(key)
+        if entry is None:
+            value, expires_at = amount, self._expires_at(expires)
+        else:
+            value, expires_at = int(self._read(entry)) + amount, entry.expires_at
+            if expires_at is None:
+                expires_at = self._expires_at(expires)
+        self._put(self._key(key), str(value).encode("utf-8"), expires_at)
+        return value
+
+    async def set_if_absent(self, key, value, expires=None):
+        if self._lookup(key) is not None:
+            return False
+        self._put(self._key(key), value, self._expires_at(expires))
+        return True
+
+    async def compare_and_set(self, key, expected, value, expires=None):
+        if await self.get(key) != expected:
+            return False
+        self._put(self._key(key), value, self._expires_at(expires))
+        return True
+
+    async def ttl(self, key):
+        entry = self._lookup(key)
+        if entry is None or entry.expires_at is None:
+            return None
+        return math.ceil(entry.expires_at - time.time())
+
+    async def touch(self, key, expires):
+        entry = self._lookup(key)
+        if entry is None:
+            return False
+        # The expiration time is part of the record, so the value has to be written again
+        self._put(self._key(key), self._read(entry), self._expires_at(expires))
+        return True
+
+    async def get_and_touch(self, key, expires):
+        entry = self._lookup(key)
+        if entry is None:
+            return None
+        value = self._read(entry)
+        self._put(self._key(key), value, self._expires_at(expires))
+        return value
+
+    async def delete(self, key):
+        if self._lookup(key) is not None:
+            self._remove(self._key(key))
+
+    async def delete_matching(self, pattern):
+        keys = await self.find_keys(pattern)
+        for key in keys:
+            self._remove(key)
+        return len(keys)
+
+    async def has(self, key):
+        return self._lookup(key) is not None
+
+    async def size(self):
+        return self._size
+
+    async def find_keys(self, pattern):
+        pattern = self._key(pattern)
+        now = time.time()
+        return [
+            key
+            for key in self._index.prefixed(glob_prefix(pattern))
+            if fnmatchcase(key, pattern) and not _expired(self._entries[key], now)
+        ]
+
+    async def scan(self, pattern, cursor=None, count=None):
+        # Continue from the cursor in the sorted index, instead of finding and ordering all
+        # matching keys for every page. Keys are always stored as text, so is the cursor.
+        count = count or 1000
+        pattern = self._key(pattern)
+        now = time.time()
+        keys = []
+        for key in self._index.prefixed(glob_prefix(pattern), start=cursor):
+            if fnmatchcase(key, pattern) and not _expired(self._entries[key], now):
+                keys.append(key)
+                if len(keys) == count:
+                    return key, keys
+        return None, keys
+
+    async def namespace_usage(self, namespace):
+        now = time.time()
+        keys, size = 0, 0
+        for key in self._index.prefixed(namespace + ":"):
+            entry = self._entries[key]
+            if not _expired(entry, now):
+                keys += 1
+                size += entry.size
+        return {"keys": keys, "bytes": size}
+
+    async def compact(self):
+        """Rewrite the log with only the live data, and write a new hint file
+
+        The live records are copied on a worker thread. Records that were appended to the log in
+        the meantime are copied over afterwards, before the new log replaces the old one.
+        """
+        if self._compacting:
+            return
+        self._compacting = True
+        try:
+            entries, end = dict(self._entries), self._size
+            logger.debug(f"Compacting {self._data_path} ({end} bytes)...")
+            new_entries, covered = await run_in_threadpool(self._write_compacted)(entries)
+
+            # From here on nothing awaits, so no writes can happen until the logs are swapped
+            compact_path = self._data_path + ".compact"
+            with open(self._data_path, "rb") as src, open(compact_path, "r+b") as dst:
+                src.seek(end)
+                tail = src.read(self._size - end)
+                dst.seek(covered)
+                dst.write(tail)
+                dst.flush()
+                os.fsync(dst.fileno())
+
+            self._close()
+            os.replace(compact_path, self._data_path)
+            os.replace(self._hint_path + ".compact", self._hint_path)
+            self._open()
+
+            tail_end, dead = _scan(tail, 0, new_entries, base=covered)
+            self._entries = new_entries
+            self._index = _build_index(new_entries)
+            self._size = covered + tail_end
+            self._dead_bytes = dead
+            logger.debug(f"Compacted {self._data_path} to {self._size} bytes")
+        finally:
+            self._compacting = False
+
+    def _write_compacted(self, entries):
+        now = time.time()
+        generation = uuid.uuid4().bytes
+        new_entries = {}
+        pos = DATA_HEADER.size
+        with open(self._data_path, "rb") as src, open(
+            self._data_path + ".compact", "wb"
+        ) as dst, open(self._hint_path + ".compact", "wb") as hint:
+            dst.write(DATA_HEADER.pack(MAGIC, generation))
+            hint_entries = []
+            for key in sorted(entries):
+                entry = entries[key]
+                if _expired(entry, now):
+                    continue
+                src.seek(entry.start)
+                dst.write(src.read(entry.size))
+                new_entry = entry._replace(start=pos)
+                new_entries[key] = new_entry
+                encoded_key = key.encode("utf-8")
+                hint_entries.append(
+                    HINT_ENTRY.pack(
+                        new_entry.start,
+                        new_entry.size,
+                        new_entry.flags,
+                        new_entry.expires_at or 0.0,
+                        len(encoded_key),
+                    )
+                    + encoded_key
+                )
+                pos += entry.size
+            dst.flush()
+            os.fsync(dst.fileno())
+            hint.write(HINT_HEADER.pack(generation, pos))
+            hint.write(b"".join(hint_entries))
+            hint.flush()
+            os.fsync(hint.fileno())
+        return new_entries, pos
+
+    def _needs_compaction(self):
+        return self._size > 0 and self._dead_bytes / self._size >= self._compaction_ratio
+
+    async def _compact_periodically(self):
+        while True:
+            await asyncio.sleep(self._compaction_interval)
+            if self._needs_compaction():
+                try:
+                    await self.compact()
+                except OSError:
+                    logger.exception(f"Failed to compact {self._data_path}")
@@ -1,4 +1,9 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import time
+from bisect import bisect_right
+
+
 class MachineBaseStorage:
     """Base class for storage backends
 
@@ -10,6 +15,10 @@ class MachineBaseStorage:
     - Namespacing of keys (so data stored by different plugins doesn't clash)
     """
 
+    # Whether the backend implements the collection methods (``list_*``, ``set_*``, ``hash_*``
+    # and ``sorted_set_*``)
+    supports_collections = False
+
     def __init__(self, settings):
         self.settings = settings
 
@@ -20,6 +29,12 @@ class MachineBaseStorage:
 
         raise NotImplementedError()
 
+    async def close(self):
+        """Used when Slack Machine shuts down, to write out pending data and release resources
+
+        The default implementation does nothing.
+        """
+
     async def get(self, key):
         """Retrieve data by key
 
@@ -29,6 +44,18 @@ class MachineBaseStorage:
         """
         raise NotImplementedError()
 
+    async def get_many(self, keys):
+        """Retrieve data for multiple keys at once
+
+        Backends that can batch reads should override this method. The default implementation
+        retrieves the keys one by one.
+
+        :param keys: list of keys for which to retrieve data
+        :return: list with the raw data for each key, in the same order as ``keys``. Contains
+            ``None`` for keys that are unknown or expired.
+        """
+        return [await self.get(key) for key in keys]
+
     async def set(self, key, value, expires=None):
         """Store data by key
 
@@ -39,6 +66,307 @@ class MachineBaseStorage:
         """
         raise NotImplementedError()
 
+    async def set_many(self, items, expires=None):
+        """Store data for multiple keys at once
+
+        Backends that can batch writes should override this method. The default implementation
+        stores the keys one by one.
+
+        :param items: dictionary mapping keys to data as (byte)string
+        :param expires: optional expiration time in seconds, applied to all keys
+        """
+        for key, value in items.items():
+            await self.set(key, value, expires)
+
+    async def incr(self, key, amount=1, expires=None):
+        """Atomically increment the integer stored under a key
+
+        The data under the key is interpreted as a base-10 integer (stored as (byte)string), and a
+        key that does not exist is treated as ``0``. The increment must happen atomically, so
+        concurrent increments from multiple processes never get lost.
+
+        :param key: key of the counter
+        :param amount: amount to increment by, can be negative to decrement
+        :param expires: optional expiration time in seconds. It is only applied when the key has no
+            expiration yet (ie. when the counter is created), so the expiration is not extended by
+            every increment.
+        :return: the value of the counter after incrementing (integer)
+        """
+        raise NotImplementedError()
+
+    async def set_if_absent(self, key, value, expires=None):
+        """Atomically store data by key, only if the key does not exist yet
+
+        :param key: the key under which to store the data
+        :param value: data as (byte)string
+        :param expires: optional expiration time in seconds
+        :return: ``True/False`` whether the data was stored
+        """
+        raise NotImplementedError()
+
+    async def compare_and_set(self, key, expected, value, expires=None):
+        """Atomically replace data by key, only if the current data is what the caller expects
+
+        :param key: the key under which to store the data
+        :param expected: the data (as (byte)string) that should currently be stored under the key,
+            or ``None`` if the key should not exist
+        :param value: data as (byte)string
+        :param expires: optional expiration time in seconds
+        :return: ``True/False`` whether the data was replaced
+        """
+        raise NotImplementedError()
+
+    async def list_push(self, key, values, left=False):
+        """Add values to the end of a list
+
+        Collections (lists, sets, hashes and sorted sets) are stored under a single key, like
+        regular data, but their elements can be updated one by one. A collection that does not
+        exist is created by the first update, and removed once it is empty. Backends that
+        implement the collection methods set :py:attr:`supports_collections` to ``True``.
+
+        :param key: key of the list
+        :param values: list of values to add, as (byte)strings
+        :param left: ``True/False`` whether to add the values to the start of the list instead
+        :return: the length of the list after adding the values (integer)
+        """
+        raise NotImplementedError()
+
+    async def list_pop(self, key, left=False):
+        """Remove and return the last value of a list
+
+        :param key: key of the list
+        :param left: ``True/False`` whether to pop the first value of the list instead
+        :return: the value, or ``None`` if the list is empty or does not exist
+        """
+        raise NotImplementedError()
+
+    async def list_range(self, key, start=0, end=-1):
+        """Retrieve a range of values from a list
+
+        Like Redis' ``LRANGE``, ``end`` is inclusive and negative indices count from the end of
+        the list, so the defaults return the whole list.
+
+        :param key: key of the list
+        :param start: index of the first value to return
+        :param end: index of the last value to return
+        :return: list of values
+        """
+        raise NotImplementedError()
+
+    async def list_length(self, key):
+        """Calculate the length of a list
+
+        :param key: key of the list
+        :return: the number of values in the list, ``0`` if the list does not exist
+        """
+        raise NotImplementedError()
+
+    async def set_add(self, key, members):
+        """Add members to a set
+
+        :param key: key of the set
+        :param members: list of members to add, as (byte)strings
+        :return: the number of members that were not in the set yet
+        """
+        raise NotImplementedError()
+
+    async def set_remove(self, key, members):
+        """Remove members from a set
+
+        :param key: key of the set
+        :param members: list of members to remove, as (byte)strings
+        :return: the number of members that were removed
+        """
+        raise NotImplementedError()
+
+    async def set_members(self, key):
+        """Retrieve all members of a set
+
+        :param key: key of the set
+        :return: set of members, empty if the set does not exist
+        """
+        raise NotImplementedError()
+
+    async def set_contains(self, key, member):
+        """Check if a member is part of a set
+
+        :param key: key of the set
+        :param member: member to check, as (byte)string
+        :return: ``True/False`` whether the member is part of the set
+        """
+        raise NotImplementedError()
+
+    async def hash_set(self, key, field, value):
+        """Store data under a field of a hash
+
+        :param key: key of the hash
+        :param field: name of the field
+        :param value: data as (byte)string
+        """
+        raise NotImplementedError()
+
+    async def hash_get(self, key, field):
+        """Retrieve the data of a field of a hash
+
+        :param key: key of the hash
+        :param field: name of the field
+        :return: the data, or ``None`` if the field or hash does not exist
+        """
+        raise NotImplementedError()
+
+    async def hash_get_all(self, key):
+        """Retrieve all fields of a hash
+
+        :param key: key of the hash
+        :return: dictionary mapping fields to data, empty if the hash does not exist
+        """
+        raise NotImplementedError()
+
+    async def hash_delete(self, key, fields):
+        """Remove fields from a hash
+
+        :param key: key of the hash
+        :param fields: list of names of the fields to remove
+        :return: the number of fields that were removed
+        """
+        raise NotImplementedError()
+
+    async def sorted_set_add(self, key, scores):
+        """Add members to a sorted set, or update their scores
+
+        Members of a sorted set are ordered by their score, and members with the same score by
+        the members themselves.
+
+        :param key: key of the sorted set
+        :param scores: dictionary mapping members, as (byte)strings, to their score (number)
+        :return: the number of members that were not in the sorted set yet
+        """
+        raise NotImplementedError()
+
+    async def sorted_set_increment(self, key, member, amount=1):
+        """Increment the score of a member of a sorted set
+
+        :param key: key of the sorted set
+        :param member: member to increment the score of, added with a score of ``0`` if it is
+            not in the sorted set yet
+        :param amount: amount to increment the score by
+        :return: the score after incrementing
+        """
+        raise NotImplementedError()
+
+    async def sorted_set_remove(self, key, members):
+        """Remove members from a sorted set
+
+        :param key: key of the sorted set
+        :param members: list of members to remove, as (byte)strings
+        :return: the number of members that were removed
+        """
+        raise NotImplementedError()
+
+    async def sorted_set_score(self, key, member):
+        """Retrieve the score of a member of a sorted set
+
+        :param key: key of the sorted set
+        :param member: the member, as (byte)string
+        :return: the score, or ``None`` if the member is not in the sorted set
+        """
+        raise NotImplementedError()
+
+    async def sorted_set_rank(self, key, member, reverse=False):
+        """Retrieve the position of a member in a sorted set
+
+        :param key: key of the sorted set
+        :param member: the member, as (byte)string
+        :param reverse: ``True/False`` whether to count from the member with the highest score
+        :return: the 0-based position, or ``None`` if the member is not in the sorted set
+        """
+        raise NotImplementedError()
+
+    async def sorted_set_range(self, key, start=0, end=-1, reverse=False):
+        """Retrieve a range of members of a sorted set, with their scores
+
+        ``start`` and ``end`` work like in :py:meth:`list_range`.
+
+        :param key: key of the sorted set
+        :param start: position of the first member to return
+        :param end: position of the last member to return
+        :param reverse: ``True/False`` whether to order the members from highest to lowest score
+        :return: list of ``(member, score)`` tuples
+        """
+        raise NotImplementedError()
+
+    async def acquire_lock(self, key, owner, ttl):
+        """Try to acquire a lock, without waiting
+
+        A lock is held by one owner at a time, until it is released or until its ttl runs out.
+        Every time a lock is acquired, a fencing token is returned that is higher than all tokens
+        returned for that lock before. Systems that are updated while holding the lock can use it
+        to reject updates from an owner whose lock has expired in the meantime.
+
+        Locks and fencing tokens must be kept apart from the data: a lock with the same key as
+        some data does not affect it, and they are never returned, counted or deleted by
+        :py:meth:`find_keys`, :py:meth:`scan`, :py:meth:`namespace_usage`,
+        :py:meth:`delete_matching` and the like.
+
+        :param key: key of the lock
+        :param owner: unique id of the owner that acquires the lock (string)
+        :param ttl: number of seconds after which the lock expires if it's not extended
+        :return: the fencing token (integer), or ``None`` if the lock is held by someone else
+        """
+        raise NotImplementedError()
+
+    async def extend_lock(self, key, owner, ttl):
+        """Reset the ttl of a lock, if it is still held by the owner
+
+        :param key: key of the lock
+        :param owner: unique id of the owner that holds the lock
+        :param ttl: number of seconds after which the lock expires from now on
+        :return: ``True/False`` whether the lock was still held by the owner and was extended
+        """
+        raise NotImplementedError()
+
+    async def release_lock(self, key, owner):
+        """Release a lock, if it is still held by the owner
+
+        :param key: key of the lock
+        :param owner: unique id of the owner that holds the lock
+        :return: ``True/False`` whether the lock was still held by the owner
+        """
+        raise NotImplementedError()
+
+    async def wait_for_lock(self, key, timeout):
+        """Wait until a lock might have become available
+
+        Backends that can notify waiters when a lock is released should override this method.
+        The default implementation sleeps for ``timeout`` seconds, so callers poll for the lock.
+
+        :param key: key of the lock
+        :param timeout: maximum number of seconds to wait
+        """
+        await asyncio.sleep(timeout)
+
+    async def dump(self, key):
+        """Retrieve a key with its data, whatever the type of the data, to move it elsewhere
+
+        The result is only meant to be passed to :py:meth:`restore` of a backend of the same type.
+        The default implementation uses :py:meth:`get`, which is enough for backends that return
+        collections from :py:meth:`get` or don't support them. Other backends should override
+        this method and :py:meth:`restore`.
+
+        :param key: key to dump
+        :return: the dumped data, or ``None`` if the key does not exist
+        """
+        return await self.get(key)
+
+    async def restore(self, key, data, expires=None):
+        """Store a key with data returned by :py:meth:`dump`, replacing the key if it exists
+
+        :param key: key to store
+        :param data: data returned by :py:meth:`dump`
+        :param expires: optional expiration time in seconds
+        """
+        await self.set(key, data, expires)
+
     async def delete(self, key):
         """Delete data by key
 
@@ -46,6 +374,54 @@ class MachineBaseStorage:
         """
         raise NotImplementedError()
 
+    async def delete_matching(self, pattern):
+        """Delete all keys matching a glob pattern
+
+        Backends that can delete keys in bulk should override this method. The default
+        implementation deletes the keys returned by :py:meth:`find_keys` one by one.
+
+        :param pattern: pattern of the keys to delete
+        :return: the number of keys that were deleted
+        """
+        keys = list(await self.find_keys(pattern))
+        for key in keys:
+            await self.delete(self.logical_key(key))
+        return len(keys)
+
+    async def ttl(self, key):
+        """Retrieve the remaining time to live of a key
+
+        :param key: key for which to retrieve the time to live
+        :return: the number of seconds (integer, rounded up) until the data expires, or ``None``
+            if the key does not expire or does not exist
+        """
+        raise NotImplementedError()
+
+    async def touch(self, key, expires):
+        """Set a new expiration time for a key, without changing its data
+
+        :param key: key for which to set the expiration time
+        :param expires: number of seconds after which the data should not be returned any more
+        :return: ``True/False`` whether the key exists
+        """
+        raise NotImplementedError()
+
+    async def get_and_touch(self, key, expires):
+        """Retrieve data by key, and set a new expiration time for it
+
+        Backends that can do this in a single operation should override this method. The default
+        implementation calls :py:meth:`get` and :py:meth:`touch`.
+
+        :param key: key for which to retrieve data
+        :param expires: number of seconds after which the data should not be returned any more
+        :return: the raw data for the provided key, or ``None`` when the key is unknown or the
+            data has expired
+        """
+        value = await self.get(key)
+        if value is not None:
+            await self.touch(key, expires)
+        return value
+
     async def has(self, key):
         """Check if the key exists
 
@@ -61,6 +437,30 @@ class MachineBaseStorage:
         """
         raise NotImplementedError()
 
+    async def namespace_usage(self, namespace):
+        """Calculate the storage used by all keys in a namespace
+
+        Keys in a namespace are prefixed by the namespace and a ``:`` separator. The default
+        implementation adds up the size of every key and its data, backends can override it with
+        something cheaper or more accurate.
+
+        :param namespace: the namespace to calculate the usage for
+        :return: dictionary with the number of ``keys`` in the namespace and an estimate of the
+            ``bytes`` they use
+        """
+        keys, size = 0, 0
+        async for key, value in self.iter_items(namespace + ":*"):
+            keys += 1
+            size += len(key) + len(value)
+        return {"keys": keys, "bytes": size}
+
+    def stats(self):
+        """Operational statistics of the backend, like connection pool usage
+
+        :return: dictionary of statistics, empty if the backend does not report any
+        """
+        return {}
+
     async def find_keys(self, pattern):
         """ Find matching keys based on a glob pattern.
 
@@ -68,3 +468,131 @@ class MachineBaseStorage:
         :return: Iterable over matching keys
         """
         raise NotImplementedError()
+
+    def logical_key(self, key):
+        """Translate a key returned by a search into the key that data was stored under
+
+        Backends that store keys in a different form (eg. with a prefix) should override this.
+
+        :param key: key as returned by :py:meth:`find_keys`, :py:meth:`iter_keys` or
+            :py:meth:`scan`
+        :return: the key as it was passed to :py:meth:`set`
+        """
+        return key
+
+    async def iter_keys(self, pattern, count=None):
+        """Iterate over matching keys based on a glob pattern, without collecting them first
+
+        Backends that can page through their keys should override this method, so callers can
+        process large numbers of keys incrementally. The default implementation falls back to
+        :py:meth:`find_keys`.
+
+        :param pattern: pattern to search for
+        :param count: optional hint for the number of keys to fetch from the backend at once
+        :return: async iterator over matching keys
+        """
+        for key in await self.find_keys(pattern):
+            yield key
+
+    async def scan(self, pattern, cursor=None, count=None):
+        """Retrieve a page of keys matching a glob pattern, for resumable iteration
+
+        Unlike :py:meth:`iter_keys`, the position of the iteration is returned to the caller, so
+        the iteration can be continued later, even from another process. The default
+        implementation orders the keys returned by :py:meth:`find_keys` and uses the last key of
+        a page as cursor. Backends that keep their keys ordered should override this, to
+        continue from the cursor without ordering all keys for every page.
+
+        :param pattern: pattern to search for
+        :param cursor: ``None`` to start a new iteration, or the cursor returned by the previous
+            call to continue it
+        :param count: optional hint for the number of keys to return
+        :return: tuple of the next cursor, which is ``None`` when the iteration is complete, and
+            a list of keys. The cursor can be serialized as JSON.
+        """
+        count = count or 1000
+        keys = await self.find_keys(pattern)
+        # Keys are ordered as text, so keys of both types can be compared to each other and to
+        # the cursor
+        decoded = sorted(
+            (key.decode("utf-8") if isinstance(key, bytes) else key, idx)
+            for idx, key in enumerate(keys)
+        )
+        keys = [keys[idx] for _, idx in decoded]
+        start = 0
+        if cursor is not None:
+            start = bisect_right([key for key, _ in decoded], cursor)
+        page = keys[start : start + count]
+        if start + count >= len(keys):
+            return None, page
+        last = page[-1]
+        return last.decode("utf-8") if isinstance(last, bytes) else last, page
+
+    async def iter_items(self, pattern, count=None):
+        """Iterate over matching keys and their data based on a glob pattern
+
+        Keys that expire or are removed while iterating are skipped. The default implementation
+        retrieves the data for each key returned by :py:meth:`iter_keys` separately.
+
+        :param pattern: pattern to search for
+        :param count: optional hint for the number of keys to fetch from the backend at once
+        :return: async iterator over ``(key, data)`` tuples
+        """
+        async for key in self.iter_keys(pattern, count=count):
+            value = await self.get(key)
+            if value is not None:
+                yield key, value
+
+
+class LocalLocksMixin:
+    """Locks for backends that are only used by a single process
+
+    The locks are kept in memory, apart from the data. Waiters are woken up by an event when a lock
+    is released, and check again after a timeout to notice locks that have expired. Backends that
+    persist their data should override :py:meth:`_next_fencing_token` to persist the fencing
+    tokens as well, so they keep increasing after a restart.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._locks = {}
+        self._fencing_tokens = {}
+        self._lock_released = {}
+
+    def _lock_holder(self, key):
+        held = self._locks.get(key)
+        if held is None or held[1] <= time.monotonic():
+            return None
+        return held[0]
+
+    def _next_fencing_token(self, key):
+        self._fencing_tokens[key] = self._fencing_tokens.get(key, 0) + 1
+        return self._fencing_tokens[key]
+
+    async def acquire_lock(self, key, owner, ttl):
+        if self._lock_holder(key) is not None:
+            return None
+        self._locks[key] = (owner, time.monotonic() + ttl)
+        return self._next_fencing_token(key)
+
+    async def extend_lock(self, key, owner, ttl):
+        if self._lock_holder(key) != owner:
+            return False
+        self._locks[key] = (owner, time.monotonic() + ttl)
+        return True
+
+    async def release_lock(self, key, owner):
+        if self._lock_holder(key) != owner:
+            return False
+        del self._locks[key]
+        released = self._lock_released.pop(key, None)
+        if released is not None:
+            released.set()
+        return True
+
+    async def wait_for_lock(self, key, timeout):
+        released = self._lock_released.setdefault(key, asyncio.Event())
+        try:
+            await asyncio.wait_for(released.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
@@ -1,36 +1,231 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import copy
+import itertools
+import math
 import sys
+from collections import deque
 from datetime import datetime, timedelta
 from fnmatch import fnmatchcase
 
-from machine.storage.backends.base import MachineBaseStorage
+from machine.storage.backends.base import LocalLocksMixin, MachineBaseStorage
+from machine.utils.collections import SortedKeyIndex, SortedSet, glob_prefix
 
 
-class MemoryStorage(MachineBaseStorage):
+class MemoryStorage(LocalLocksMixin, MachineBaseStorage):
+    supports_collections = True
+
     def __init__(self, settings):
         super().__init__(settings)
         self._storage = {}
+        self._index = SortedKeyIndex()
 
     async def connect(self):
         pass
 
-    async def get(self, key):
+    def _remove(self, key):
+        del self._storage[key]
+        self._index.remove(key)
+
+    def _lookup(self, key):
         stored = self._storage.get(key, None)
         if not stored:
             return None
         else:
             if stored[1] and stored[1] < datetime.utcnow():
-                del self._storage[key]
+                self._remove(key)
                 return None
             else:
                 return stored[0]
 
-    async def set(self, key, value, expires=None):
+    @staticmethod
+    def _is_collection(value):
+        return value is not None and not isinstance(value, (bytes, str))
+
+    async def get(self, key):
+        value = self._lookup(key)
+        if self._is_collection(value):
+            # Like Redis, which refuses GET on a key of the wrong type
+            raise TypeError(f"{key} holds a collection, not a value")
+        return value
+
+    async def dump(self, key):
+        # Unlike get, this includes collections, copied so they can be restored elsewhere
+        return copy.deepcopy(self._lookup(key))
+
+    async def get_many(self, keys):
+        # Collection keys are skipped, like Redis does with MGET
+        values = [self._lookup(key) for key in keys]
+        return [None if self._is_collection(value) else value for value in values]
+
+    def _store(self, key, value, expires_at):
+        if key not in self._storage:
+            self._index.add(key)
+        self._storage[key] = (value, expires_at)
+
+    @staticmethod
+    def _expires_at(expires):
         if expires:
-            expires_at = datetime.utcnow() + timedelta(seconds=expires)
+            return datetime.utcnow() + timedelta(seconds=expires)
         else:
-            expires_at = None
-        self._storage[key] = (value, expires_at)
+            return None
+
+    async def set(self, key, value, expires=None):
+        self._store(key, value, self._expires_at(expires))
+
+    # The atomic operations below never await between reading and writing a key, so no other
+    # task can interleave with them on the event loop.
+
+    async def incr(self, key, amount=1, expires=None):
+        current = await self.get(key)
+        if current is None:
+            value, expires_at = amount, self._expires_at(expires)
+        else:
+            value, expires_at = int(current) + amount, self._storage[key][1]
+            if expires_at is None:
+                expires_at = self._expires_at(expires)
+        self._store(key, str(value).encode("utf-8"), expires_at)
+        return value
+
+    async def set_if_absent(self, key, value, expires=None):
+        if await self.has(key):
+            return False
+        self._store(key, value, self._expires_at(expires))
+        return True
+
+    async def compare_and_set(self, key, expected, value, expires=None):
+        if await self.get(key) != expected:
+            return False
+        self._store(key, value, self._expires_at(expires))
+        return True
+
+    # Collections are stored as Python data structures. Like Redis, a collection is created when
+    # it is first updated, and removed when it becomes empty.
+
+    def _collection(self, key, cls, create=False):
+        stored = self._storage.get(key, None)
+        if stored and stored[1] and stored[1] < datetime.utcnow():
+            self._remove(key)
+            stored = None
+        if not stored:
+            if not create:
+                return None
+            collection = cls()
+            self._store(key, collection, None)
+            return collection
+        if not isinstance(stored[0], cls):
+            raise TypeError(f"{key} does not hold a {cls.__name__}")
+        return stored[0]
+
+    def _remove_if_empty(self, key, collection):
+        if not collection:
+            self._remove(key)
+
+    @staticmethod
+    def _slice(size, start, end):
+        """Translate an inclusive range with Redis semantics into slice bounds"""
+        start = max(size + start, 0) if start < 0 else start
+        stop = size + end + 1 if end < 0 else end + 1
+        return start, max(stop, start)
+
+    async def list_push(self, key, values, left=False):
+        collection = self._collection(key, deque, create=True)
+        if left:
+            collection.extendleft(values)
+        else:
+            collection.extend(values)
+        self._remove_if_empty(key, collection)
+        return len(collection)
+
+    async def list_pop(self, key, left=False):
+        collection = self._collection(key, deque)
+        if not collection:
+            return None
+        value = collection.popleft() if left else collection.pop()
+        self._remove_if_empty(key, collection)
+        return value
+
+    async def list_range(self, key, start=0, end=-1):
+        collection = self._collection(key, deque) or deque()
+        start, stop = self._slice(len(collection), start, end)
+        return list(itertools.islice(collection, start, stop))
+
+    async def list_length(self, key):
+        return len(self._collection(key, deque) or ())
+
+    async def set_add(self, key, members):
+        collection = self._collection(key, set, create=True)
+        size = len(collection)
+        collection.update(members)
+        self._remove_if_empty(key, collection)
+        return len(collection) - size
+
+    async def set_remove(self, key, members):
+        collection = self._collection(key, set)
+        if not collection:
+            return 0
+        size = len(collection)
+        collection.difference_update(members)
+        self._remove_if_empty(key, collection)
+        return size - len(collection)
+
+    async def set_members(self, key):
+        return set(self._collection(key, set) or ())
+
+    async def set_contains(self, key, member):
+        return member in (self._collection(key, set) or ())
+
+    async def hash_set(self, key, field, value):
+        self._collection(key, dict, create=True)[field] = value
+
+    async def hash_get(self, key, field):
+        return (self._collection(key, dict) or {}).get(field)
+
+    async def hash_get_all(self, key):
+        return dict(self._collection(key, dict) or {})
+
+    async def hash_delete(self, key, fields):
+        collection = self._collection(key, dict)
+        if not collection:
+            return 0
+        removed = sum(collection.pop(field, None) is not None for field in set(fields))
+        self._remove_if_empty(key, collection)
+        return removed
+
+    async def sorted_set_add(self, key, scores):
+        collection = self._collection(key, SortedSet, create=True)
+        added = sum(collection.add(member, score) for member, score in scores.items())
+        self._remove_if_empty(key, collection)
+        return added
+
+    async def sorted_set_increment(self, key, member, amount=1):
+        collection = self._collection(key, SortedSet, create=True)
+        score = (collection.score(member) or 0) + amount
+        collection.add(member, score)
+        return score
+
+    async def sorted_set_remove(self, key, members):
+        collection = self._collection(key, SortedSet)
+        if not collection:
+            return 0
+        removed = sum(collection.discard(member) for member in set(members))
+        self._remove_if_empty(key, collection)
+        return removed
+
+    async def sorted_set_score(self, key, member):
+        return (self._collection(key, SortedSet) or SortedSet()).score(member)
+
+    async def sorted_set_rank(self, key, member, reverse=False):
+        collection = self._collection(key, SortedSet) or SortedSet()
+        rank = collection.rank(member)
+        if rank is None or not reverse:
+            return rank
+        return len(collection) - 1 - rank
+
+    async def sorted_set_range(self, key, start=0, end=-1, reverse=False):
+        collection = self._collection(key, SortedSet) or SortedSet()
+        start, stop = self._slice(len(collection), start, end)
+        return collection.range(start, stop, reverse=reverse)
 
     async def has(self, key):
         stored = self._storage.get(key, None)
@@ -38,16 +233,106 @@ class MemoryStorage(MachineBaseStorage):
             return False
         else:
             if stored[1] and stored[1] < datetime.utcnow():
-                del self._storage[key]
+                self._remove(key)
                 return False
             else:
                 return True
 
+    async def ttl(self, key):
+        if not await self.has(key):
+            return None
+        expires_at = self._storage[key][1]
+        if expires_at is None:
+            return None
+        return math.ceil((expires_at - datetime.utcnow()).total_seconds())
+
+    async def touch(self, key, expires):
+        if not await self.has(key):
+            return False
+        self._storage[key] = (self._storage[key][0], self._expires_at(expires))
+        return True
+
     async def delete(self, key):
-        del self._storage[key]
+        if key in self._storage:
+            self._remove(key)
+
+    async def delete_matching(self, pattern):
+        now = datetime.utcnow()
+        keys = [
+            key
+            for key in self._index.prefixed(glob_prefix(pattern))
+            if fnmatchcase(key, pattern)
+        ]
+        deleted = 0
+        for key in keys:
+            expires_at = self._storage.pop(key)[1]
+            if not expires_at or expires_at >= now:
+                deleted += 1
+        # The matching keys are in one range of the index, so only the buckets of the index that
+        # hold that range are rebuilt
+        self._index.remove_many(keys)
+        return deleted
 
     async def size(self):
         return sys.getsizeof(self._storage)  # pragma: no cover
 
+    @staticmethod
+    def _size(value):
+        """Size of the serialized data of a value or collection, in bytes"""
+        if isinstance(value, (bytes, str)):
+            return len(value)
+        if isinstance(value, dict):
+            return sum(len(field) + len(data) for field, data in value.items())
+        if isinstance(value, SortedSet):
+            # Scores are stored as doubles, like Redis does
+            return sum(len(member) + 8 for member in value)
+        return sum(len(member) for member in value)
+
+    async def namespace_usage(self, namespace):
+        now = datetime.utcnow()
+        keys, size = 0, 0
+        for key in self._index.prefixed(namespace + ":"):
+            value, expires_at = self._storage[key]
+            if expires_at and expires_at < now:
+                continue
+            keys += 1
+            size += len(key) + self._size(value)
+        return {"keys": keys, "bytes": size}
+
     async def find_keys(self, pattern):
-        return filter(lambda key: fnmatchcase(key, pattern), self._storage.keys())
+        # Every key matching the pattern shares its literal prefix, so only keys in that
+        # range of the sorted index need to be matched against the full pattern.
+        candidates = self._index.prefixed(glob_prefix(pattern))
+        return [key for key in candidates if fnmatchcase(key, pattern)]
+
+    async def scan(self, pattern, cursor=None, count=None):
+        # Continue from the cursor in the sorted index, instead of finding and ordering all
+        # matching keys for every page
+        count = count or 1000
+        if cursor is not None and isinstance(pattern, bytes):
+            cursor = cursor.encode("utf-8")
+        now = datetime.utcnow()
+        keys = []
+        for key in self._index.prefixed(glob_prefix(pattern), start=cursor):
+            expires_at = self._storage[key][1]
+            if fnmatchcase(key, pattern) and not (expires_at and expires_at < now):
+                keys.append(key)
+                if len(keys) == count:
+                    last = keys[-1]
+                    return last.decode("utf-8") if isinstance(last, bytes) else last, keys
+        return None, keys
+
+    async def iter_items(self, pattern, count=None):
+        async for key in self.iter_keys(pattern, count=count):
+            value = self._lookup(key)
+            # Collection keys are skipped, their data can't be returned as a single value
+            if value is not None and not self._is_collection(value):
+                yield key, value
+
+    async def iter_keys(self, pattern, count=None):
+        count = count or 1000
+        for idx, key in enumerate(await self.find_keys(pattern), start=1):
+            yield key
+            # Give other tasks a chance to run between pages of keys
+            if idx % count == 0:
+                await asyncio.sleep(0)
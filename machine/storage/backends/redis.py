@@ -1,28 +1,259 @@
 # -*- coding: utf-8 -*-
 
-import aioredis
+import asyncio
 import itertools
+import random
+import time
+from collections import OrderedDict
+
+import aioredis
+from loguru import logger
 
 from machine.storage.backends.base import MachineBaseStorage
+from machine.utils.circuit_breaker import CLOSED, CircuitBreaker, CircuitOpenError
+
+# Errors that indicate Redis can't be reached, as opposed to errors returned by a command
+CONNECTION_ERRORS = (aioredis.RedisError, OSError, asyncio.TimeoutError)
+
+
+# Increment a counter, and set its expiration only if it doesn't have one yet
+INCR_SCRIPT = """
+local value = redis.call('INCRBY', KEYS[1], ARGV[1])
+if redis.call('TTL', KEYS[1]) == -1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return value
+"""
+
+# Replace a value only if the current value matches ARGV[2], or if the key doesn't exist when
+# ARGV[1] is '0'
+COMPARE_AND_SET_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if ARGV[1] == '1' then
+    if current ~= ARGV[2] then
+        return 0
+    end
+elseif current then
+    return 0
+end
+if tonumber(ARGV[4]) > 0 then
+    redis.call('SET', KEYS[1], ARGV[3], 'EX', ARGV[4])
+else
+    redis.call('SET', KEYS[1], ARGV[3])
+end
+return 1
+"""
+
+# Acquire a lock (KEYS[1]) for an owner, and return the next fencing token (KEYS[2])
+ACQUIRE_LOCK_SCRIPT = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return redis.call('INCR', KEYS[2])
+end
+return false
+"""
+
+# Extend or release a lock, only if it's still held by the owner
+EXTEND_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class InstrumentedConnectionsPool(aioredis.ConnectionsPool):
+    """Connections pool that keeps track of how long commands wait for a free connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = {"waits": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+
+    async def acquire(self, command=None, args=()):
+        start = time.perf_counter()
+        try:
+            return await super().acquire(command, args)
+        finally:
+            waited = time.perf_counter() - start
+            self.wait_stats["waits"] += 1
+            self.wait_stats["total_seconds"] += waited
+            self.wait_stats["max_seconds"] = max(self.wait_stats["max_seconds"], waited)
 
 
 class RedisStorage(MachineBaseStorage):
+    supports_collections = True
+
     def __init__(self, settings):
         super().__init__(settings)
         self._redis_url = settings.get("REDIS_URL", "redis://localhost:6379")
         self._max_connections = settings.get("REDIS_MAX_CONNECTIONS", 10)
         self._key_prefix = settings.get("REDIS_KEY_PREFIX", "SM")
+        self._scan_count = settings.get("REDIS_SCAN_COUNT", None)
+        self._usage_samples = settings.get("REDIS_USAGE_SAMPLES", 100)
+        self._health_check_interval = settings.get("REDIS_HEALTH_CHECK_INTERVAL", 10)
+        self._max_backoff = settings.get("REDIS_RECONNECT_MAX_BACKOFF", 60)
+        self._breaker = CircuitBreaker(
+            failure_threshold=settings.get("REDIS_CIRCUIT_BREAKER_THRESHOLD", 5),
+            reset_timeout=settings.get("REDIS_CIRCUIT_BREAKER_TIMEOUT", 30),
+        )
+        if settings.get("REDIS_DEGRADED_MODE", False):
+            self._degraded_cache = OrderedDict()
+            self._degraded_cache_size = settings.get("REDIS_DEGRADED_CACHE_SIZE", 1024)
+        else:
+            self._degraded_cache = None
+        self._degraded_reads = 0
+        self._reconnects = 0
+        self._pool_wait = {"waits": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+        self._health_checker = None
+        self._getex_supported = True
         self._redis = None
 
     async def connect(self):
-        self._redis = await aioredis.create_redis_pool(
-            self._redis_url, maxsize=self._max_connections
+        self._redis = await self._create_pool()
+        if self._health_check_interval:
+            self._health_checker = asyncio.ensure_future(self._check_health())
+
+    async def close(self):
+        if self._health_checker is not None:
+            self._health_checker.cancel()
+            self._health_checker = None
+        if self._redis is not None:
+            self._redis.close()
+            await self._redis.wait_closed()
+
+    async def _create_pool(self):
+        redis = await aioredis.create_redis_pool(
+            self._redis_url,
+            maxsize=self._max_connections,
+            pool_cls=InstrumentedConnectionsPool,
         )
+        # Keep the wait statistics when the pool is re-created
+        redis.connection.wait_stats = self._pool_wait
+        return redis
 
     def _ensure_connected(self):
         if self._redis is None:
             raise NotConnectedError()
 
+    async def _call(self, method, *args, **kwargs):
+        """Execute a command, keeping track of failures in the circuit breaker
+
+        While the circuit breaker is open, commands fail immediately with a
+        :py:class:`~machine.utils.circuit_breaker.CircuitOpenError` instead of waiting for a
+        connection that is not going to work.
+        """
+        return await self._guard(lambda redis: getattr(redis, method)(*args, **kwargs))
+
+    async def _guard(self, command):
+        """Execute ``command(redis)`` through the circuit breaker, see :py:meth:`_call`"""
+        self._ensure_connected()
+        if not self._breaker.allow():
+            raise CircuitOpenError("Redis")
+        try:
+            result = await command(self._redis)
+        except aioredis.ReplyError:
+            # The command was rejected, but Redis itself is fine
+            self._breaker.record_success()
+            raise
+        except CONNECTION_ERRORS:
+            self._breaker.record_failure()
+            raise
+        self._breaker.record_success()
+        return result
+
+    async def run_command(self, command):
+        """Execute ``command(redis)`` with a client from the connection pool of this backend
+
+        This is for components that keep their own data in Redis, like the scheduler's jobstore,
+        so they share the connection pool and the circuit breaker. Keys are not prefixed.
+        """
+        return await self._guard(command)
+
+    async def _check_health(self):
+        backoff = self._health_check_interval
+        while True:
+            await asyncio.sleep(backoff)
+            try:
+                await asyncio.wait_for(self._redis.ping(), timeout=backoff)
+            except CONNECTION_ERRORS:
+                logger.warning("Redis health check failed, re-creating connection pool")
+                self._breaker.trip()
+                try:
+                    await self._reconnect()
+                except CONNECTION_ERRORS:
+                    backoff = min(backoff * 2, self._max_backoff)
+                    logger.warning(
+                        f"Reconnecting to Redis failed, retrying in {backoff}s"
+                    )
+                    continue
+            if self._breaker.state != CLOSED:
+                logger.info("Redis is reachable again")
+            self._breaker.reset()
+            backoff = self._health_check_interval
+
+    async def _reconnect(self):
+        redis = await self._create_pool()
+        old, self._redis = self._redis, redis
+        self._reconnects += 1
+        old.close()
+
+    @staticmethod
+    def _cache_key(key):
+        # Keys can be passed as str or bytes, and SCAN returns bytes, but they share one entry
+        return key.decode("utf-8") if isinstance(key, bytes) else key
+
+    def _cache(self, key, value):
+        if self._degraded_cache is None:
+            return
+        key = self._cache_key(key)
+        if value is None:
+            self._degraded_cache.pop(key, None)
+        else:
+            self._degraded_cache[key] = value
+            self._degraded_cache.move_to_end(key)
+            if len(self._degraded_cache) > self._degraded_cache_size:
+                self._degraded_cache.popitem(last=False)
+
+    def _read_degraded(self, key, error):
+        """Serve a read from the local cache, when Redis can't be reached"""
+        key = self._cache_key(key)
+        if self._degraded_cache is None or key not in self._degraded_cache:
+            raise error
+        self._degraded_reads += 1
+        return self._degraded_cache[key]
+
+    def stats(self):
+        pool = self._redis.connection if self._redis is not None else None
+        size, free = (pool.size, pool.freesize) if pool is not None else (0, 0)
+        waits = self._pool_wait["waits"]
+        return {
+            "pool": {
+                "size": size,
+                "free": free,
+                "max_size": self._max_connections,
+                "utilisation": (size - free) / self._max_connections,
+            },
+            "pool_wait": {
+                **self._pool_wait,
+                "mean_seconds": (
+                    self._pool_wait["total_seconds"] / waits if waits else 0.0
+                ),
+            },
+            "circuit_breaker": {
+                "state": self._breaker.state,
+                "failures": self._breaker.failures,
+                "times_opened": self._breaker.times_opened,
+            },
+            "reconnects": self._reconnects,
+            "degraded_reads": self._degraded_reads,
+        }
+
     def _prefix(self, key):
         separator = ":"
         prefix = self._key_prefix
@@ -35,27 +266,275 @@ class RedisStorage(MachineBaseStorage):
 
         return prefix + separator + key
 
+    def logical_key(self, key):
+        if isinstance(key, bytes):
+            key = key.decode("utf-8")
+        prefix = self._key_prefix + ":"
+        return key[len(prefix) :] if key.startswith(prefix) else key
+
     async def has(self, key):
-        self._ensure_connected()
-        return await self._redis.exists(self._prefix(key))
+        key = self._prefix(key)
+        try:
+            return await self._call("exists", key)
+        except aioredis.ReplyError:
+            raise
+        except (CircuitOpenError, *CONNECTION_ERRORS) as e:
+            return self._read_degraded(key, e) is not None
 
     async def get(self, key):
-        self._ensure_connected()
-        return await self._redis.get(self._prefix(key))
+        key = self._prefix(key)
+        try:
+            value = await self._call("get", key)
+        except aioredis.ReplyError:
+            raise
+        except (CircuitOpenError, *CONNECTION_ERRORS) as e:
+            return self._read_degraded(key, e)
+        self._cache(key, value)
+        return value
+
+    async def get_many(self, keys):
+        if not keys:
+            return []
+        return await self._call("mget", *(self._prefix(key) for key in keys))
 
     async def set(self, key, value, expires=None):
-        self._ensure_connected()
-        await self._redis.set(self._prefix(key), value, expire=expires)
+        key = self._prefix(key)
+        await self._call("set", key, value, expire=expires)
+        self._cache(key, value)
+
+    async def set_many(self, items, expires=None):
+        items = [(self._prefix(key), value) for key, value in items.items()]
+
+        def pipelined(redis):
+            # All SETs are sent in one go, instead of waiting for a reply to each of them
+            pipe = redis.pipeline()
+            for key, value in items:
+                pipe.set(key, value, expire=expires)
+            return pipe.execute()
+
+        await self._guard(pipelined)
+        for key, value in items:
+            self._cache(key, value)
+
+    async def incr(self, key, amount=1, expires=None):
+        key = self._prefix(key)
+        self._cache(key, None)
+        if not expires:
+            return await self._call("incrby", key, amount)
+        return await self._call("eval", INCR_SCRIPT, keys=[key], args=[amount, expires])
+
+    async def set_if_absent(self, key, value, expires=None):
+        key = self._prefix(key)
+        self._cache(key, None)
+        return await self._call(
+            "set",
+            key,
+            value,
+            expire=expires,
+            exist=aioredis.Redis.SET_IF_NOT_EXIST,
+        )
+
+    async def compare_and_set(self, key, expected, value, expires=None):
+        key = self._prefix(key)
+        self._cache(key, None)
+        if expected is None:
+            args = [0, b"", value, expires or 0]
+        else:
+            args = [1, expected, value, expires or 0]
+        result = await self._call("eval", COMPARE_AND_SET_SCRIPT, keys=[key], args=args)
+        return result == 1
+
+    async def ttl(self, key):
+        # TTL returns -2 for keys that don't exist and -1 for keys without expiration
+        ttl = await self._call("ttl", self._prefix(key))
+        return ttl if ttl >= 0 else None
+
+    async def touch(self, key, expires):
+        return bool(await self._call("pexpire", self._prefix(key), int(expires * 1000)))
+
+    async def get_and_touch(self, key, expires):
+        if not self._getex_supported:
+            return await super().get_and_touch(key, expires)
+        prefixed = self._prefix(key)
+        try:
+            value = await self._call("execute", b"GETEX", prefixed, b"PX", int(expires * 1000))
+        except aioredis.ReplyError as e:
+            if "unknown command" not in str(e).lower():
+                raise
+            # GETEX was added in Redis 6.2, fall back to GET and PEXPIRE on older versions
+            self._getex_supported = False
+            return await super().get_and_touch(key, expires)
+        except (CircuitOpenError, *CONNECTION_ERRORS) as e:
+            return self._read_degraded(prefixed, e)
+        self._cache(prefixed, value)
+        return value
+
+    async def list_push(self, key, values, left=False):
+        if not values:
+            return await self.list_length(key)
+        return await self._call("lpush" if left else "rpush", self._prefix(key), *values)
+
+    async def list_pop(self, key, left=False):
+        return await self._call("lpop" if left else "rpop", self._prefix(key))
+
+    async def list_range(self, key, start=0, end=-1):
+        return await self._call("lrange", self._prefix(key), start, end)
+
+    async def list_length(self, key):
+        return await self._call("llen", self._prefix(key))
+
+    async def set_add(self, key, members):
+        if not members:
+            return 0
+        return await self._call("sadd", self._prefix(key), *members)
+
+    async def set_remove(self, key, members):
+        if not members:
+            return 0
+        return await self._call("srem", self._prefix(key), *members)
+
+    async def set_members(self, key):
+        return set(await self._call("smembers", self._prefix(key)))
+
+    async def set_contains(self, key, member):
+        return bool(await self._call("sismember", self._prefix(key), member))
+
+    async def hash_set(self, key, field, value):
+        await self._call("hset", self._prefix(key), field, value)
+
+    async def hash_get(self, key, field):
+        return await self._call("hget", self._prefix(key), field)
+
+    async def hash_get_all(self, key):
+        return await self._call("hgetall", self._prefix(key))
+
+    async def hash_delete(self, key, fields):
+        if not fields:
+            return 0
+        return await self._call("hdel", self._prefix(key), *fields)
+
+    async def sorted_set_add(self, key, scores):
+        if not scores:
+            return 0
+        pairs = itertools.chain.from_iterable(
+            (score, member) for member, score in scores.items()
+        )
+        return await self._call("zadd", self._prefix(key), *pairs)
+
+    async def sorted_set_increment(self, key, member, amount=1):
+        return await self._call("zincrby", self._prefix(key), amount, member)
+
+    async def sorted_set_remove(self, key, members):
+        if not members:
+            return 0
+        return await self._call("zrem", self._prefix(key), *members)
+
+    async def sorted_set_score(self, key, member):
+        return await self._call("zscore", self._prefix(key), member)
+
+    async def sorted_set_rank(self, key, member, reverse=False):
+        return await self._call("zrevrank" if reverse else "zrank", self._prefix(key), member)
+
+    async def sorted_set_range(self, key, start=0, end=-1, reverse=False):
+        method = "zrevrange" if reverse else "zrange"
+        return await self._call(method, self._prefix(key), start, end, withscores=True)
+
+    def _lock_keys(self, key):
+        # Locks and their fencing tokens live outside the data prefix, so data operations like
+        # find_keys and delete_matching never see them
+        if isinstance(key, bytes):
+            key = key.decode("utf-8")
+        return f"{self._key_prefix}-lock:{key}", f"{self._key_prefix}-fence:{key}"
+
+    async def acquire_lock(self, key, owner, ttl):
+        return await self._call(
+            "eval",
+            ACQUIRE_LOCK_SCRIPT,
+            keys=list(self._lock_keys(key)),
+            args=[owner, int(ttl * 1000)],
+        )
+
+    async def extend_lock(self, key, owner, ttl):
+        result = await self._call(
+            "eval",
+            EXTEND_LOCK_SCRIPT,
+            keys=[self._lock_keys(key)[0]],
+            args=[owner, int(ttl * 1000)],
+        )
+        return result == 1
+
+    async def release_lock(self, key, owner):
+        result = await self._call(
+            "eval", RELEASE_LOCK_SCRIPT, keys=[self._lock_keys(key)[0]], args=[owner]
+        )
+        return result == 1
+
+    async def dump(self, key):
+        return await self._call("dump", self._prefix(key))
+
+    async def restore(self, key, data, expires=None):
+        ttl = int(expires * 1000) if expires else 0
+        await self._guard(
+            lambda redis: redis.execute(b"RESTORE", self._prefix(key), ttl, data, b"REPLACE")
+        )
 
     async def delete(self, key):
+        key = self._prefix(key)
+        self._cache(key, None)
+        await self._call("delete", key)
+
+    async def delete_matching(self, pattern):
         self._ensure_connected()
-        await self._redis.delete(self._prefix(key))
+        deleted = 0
+        unlinking = None
+        async for page in self._scan_iter(self._prefix(pattern)):
+            # Unlink each page while the next page is scanned. UNLINK reclaims the memory in the
+            # background, so Redis isn't blocked by deleting large values.
+            if unlinking is not None:
+                deleted += await unlinking
+                unlinking = None
+            if page:
+                for key in page:
+                    self._cache(key, None)
+                unlinking = asyncio.ensure_future(self._call("unlink", *page))
+        if unlinking is not None:
+            deleted += await unlinking
+        return deleted
 
     async def size(self):
-        self._ensure_connected()
-        info = await self._redis.info("memory")
+        info = await self._call("info", "memory")
         return info["memory"]["used_memory"]
 
+    async def namespace_usage(self, namespace):
+        self._ensure_connected()
+        keys = 0
+        sample = []
+        # Reservoir-sample the keys while counting them, so MEMORY USAGE is only called for a
+        # bounded number of keys no matter how big the namespace is.
+        async for key in self.iter_keys(namespace + ":*"):
+            keys += 1
+            if len(sample) < self._usage_samples:
+                sample.append(key)
+            else:
+                idx = random.randrange(keys)
+                if idx < self._usage_samples:
+                    sample[idx] = key
+
+        if not sample:
+            return {"keys": 0, "bytes": 0}
+
+        def pipelined(redis):
+            # All MEMORY USAGE commands are sent in one go, instead of waiting for a reply to
+            # each of them
+            pipe = redis.pipeline()
+            for key in sample:
+                pipe.execute(b"MEMORY", b"USAGE", key)
+            return pipe.execute()
+
+        # Keys that were deleted since they were sampled have no usage
+        sampled_bytes = sum(usage or 0 for usage in await self._guard(pipelined))
+        return {"keys": keys, "bytes": int(sampled_bytes / len(sample) * keys)}
+
     async def find_keys(self, pattern):
         self._ensure_connected()
         pattern = self._prefix(pattern)
@@ -63,10 +542,42 @@ class RedisStorage(MachineBaseStorage):
             [page async for page in self._scan_iter(pattern)]
         )
 
-    async def _scan_iter(self, pattern):
+    async def iter_keys(self, pattern, count=None):
+        self._ensure_connected()
+        async for page in self._scan_iter(self._prefix(pattern), count=count):
+            for key in page:
+                yield key
+
+    async def iter_items(self, pattern, count=None):
+        self._ensure_connected()
+        async for page in self._scan_iter(self._prefix(pattern), count=count):
+            if not page:
+                continue
+            # Fetch the values for a whole page of keys in a single round trip
+            values = await self._call("mget", *page)
+            for key, value in zip(page, values):
+                if value is not None:
+                    yield key, value
+
+    async def scan(self, pattern, cursor=None, count=None):
+        self._ensure_connected()
+        cursor, keys = await self._call(
+            "scan",
+            cursor=cursor or 0,
+            match=self._prefix(pattern),
+            count=count or self._scan_count,
+        )
+        return cursor or None, keys
+
+    async def _scan_iter(self, pattern, count=None):
+        scan_kwargs = {"match": pattern}
+        count = count or self._scan_count
+        if count:
+            scan_kwargs["count"] = count
+
         cursor = b"0"
         while cursor:
-            cursor, keys = await self._redis.scan(cursor=cursor, match=pattern)
+            cursor, keys = await self._call("scan", cursor=cursor, **scan_kwargs)
             yield keys
 
 
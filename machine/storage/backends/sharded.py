@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import itertools
+from collections import defaultdict
+
+from loguru import logger
+
+from machine.storage.backends.base import MachineBaseStorage
+from machine.storage.backends.redis import RedisStorage
+from machine.utils.aio import merge
+from machine.utils.collections import HashRing
+from machine.utils.module_loading import import_string
+
+
+class ShardedStorage(MachineBaseStorage):
+    """Storage backend that spreads data over multiple shards using consistent hashing
+
+    Every shard is an instance of another storage backend (Redis by default), and keys are
+    routed to a shard based on a consistent hash of the (namespaced) key. Operations on a single
+    key go to one shard only, while batch operations and searches are sent to all involved shards
+    in parallel.
+
+    Because of the consistent hashing, adding a shard only moves the keys that now belong to the
+    new shard, about ``1/n`` of all keys. Use :py:meth:`add_shard` to add a shard and move those
+    keys over.
+    """
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        shards = settings.get("STORAGE_SHARDS", [])
+        if not shards:
+            raise ValueError("ShardedStorage needs at least one shard in STORAGE_SHARDS")
+
+        backend = settings.get(
+            "STORAGE_SHARD_BACKEND", "machine.storage.backends.redis.RedisStorage"
+        )
+        _, self._shard_cls = import_string(backend)[0]
+        # Keys returned by Redis shards carry the key prefix, which is not part of the hashed key
+        if issubclass(self._shard_cls, RedisStorage):
+            self._key_prefix = settings.get("REDIS_KEY_PREFIX", "SM") + ":"
+        else:
+            self._key_prefix = None
+
+        self._ring = HashRing(vnodes=settings.get("STORAGE_SHARD_VNODES", 128))
+        self._shards = {}
+        for url in shards:
+            self._shards[url] = self._build_shard(url)
+            self._ring.add(url)
+        self.supports_collections = self._shard_cls.supports_collections
+
+    def _build_shard(self, url):
+        return self._shard_cls({**self.settings, "REDIS_URL": url})
+
+    async def connect(self):
+        await asyncio.gather(*(shard.connect() for shard in self._shards.values()))
+
+    async def close(self):
+        # Close every shard, even if closing one of them fails
+        results = await asyncio.gather(
+            *(shard.close() for shard in self._shards.values()), return_exceptions=True
+        )
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            raise errors[0]
+
+    def _ring_key(self, key):
+        if isinstance(key, bytes):
+            key = key.decode("utf-8")
+        if self._key_prefix and key.startswith(self._key_prefix):
+            key = key[len(self._key_prefix) :]
+        return key
+
+    def _shard_name(self, key):
+        return self._ring.get(self._ring_key(key))
+
+    def _shard(self, key):
+        return self._shards[self._shard_name(key)]
+
+    async def get(self, key):
+        return await self._shard(key).get(key)
+
+    async def get_many(self, keys):
+        by_shard = defaultdict(list)
+        for idx, key in enumerate(keys):
+            by_shard[self._shard_name(key)].append(idx)
+        shard_values = await asyncio.gather(
+            *(
+                self._shards[name].get_many([keys[idx] for idx in indices])
+                for name, indices in by_shard.items()
+            )
+        )
+        values = [None] * len(keys)
+        for indices, shard_value in zip(by_shard.values(), shard_values):
+            for idx, value in zip(indices, shard_value):
+                values[idx] = value
+        return values
+
+    async def set(self, key, value, expires=None):
+        await self._shard(key).set(key, value, expires)
+
+    async def set_many(self, items, expires=None):
+        by_shard = defaultdict(dict)
+        for key, value in items.items():
+            by_shard[self._shard_name(key)][key] = value
+        await asyncio.gather(
+            *(
+                self._shards[name].set_many(shard_items, expires)
+                for name, shard_items in by_shard.items()
+            )
+        )
+
+    async def incr(self, key, amount=1, expires=None):
+        return await self._shard(key).incr(key, amount, expires)
+
+    async def set_if_absent(self, key, value, expires=None):
+        return await self._shard(key).set_if_absent(key, value, expires)
+
+    async def compare_and_set(self, key, expected, value, expires=None):
+        return await self._shard(key).compare_and_set(key, expected, value, expires)
+
+    async def list_push(self, key, values, left=False):
+        return await self._shard(key).list_push(key, values, left)
+
+    async def list_pop(self, key, left=False):
+        return await self._shard(key).list_pop(key, left)
+
+    async def list_range(self, key, start=0, end=-1):
+        return await self._shard(key).list_range(key, start, end)
+
+    async def list_length(self, key):
+        return await self._shard(key).list_length(key)
+
+    async def set_add(self, key, members):
+        return await self._shard(key).set_add(key, members)
+
+    async def set_remove(self, key, members):
+        return await self._shard(key).set_remove(key, members)
+
+    async def set_members(self, key):
+        return await self._shard(key).set_members(key)
+
+    async def set_contains(self, key, member):
+        return await self._shard(key).set_contains(key, member)
+
+    async def hash_set(self, key, field, value):
+        return await self._shard(key).hash_set(key, field, value)
+
+    async def hash_get(self, key, field):
+        return await self._shard(key).hash_get(key, field)
+
+    async def hash_get_all(self, key):
+        return await self._shard(key).hash_get_all(key)
+
+    async def hash_delete(self, key, fields):
+        return await self._shard(key).hash_delete(key, fields)
+
+    async def sorted_set_add(self, key, scores):
+        return await self._shard(key).sorted_set_add(key, scores)
+
+    async def sorted_set_increment(self, key, member, amount=1):
+        return await self._shard(key).sorted_set_increment(key, member, amount)
+
+    async def sorted_set_remove(self, key, members):
+        return await self._shard(key).sorted_set_remove(key, members)
+
+    async def sorted_set_score(self, key, member):
+        return await self._shard(key).sorted_set_score(key, member)
+
+    async def sorted_set_rank(self, key, member, reverse=False):
+        return await self._shard(key).sorted_set_rank(key, member, reverse)
+
+    async def sorted_set_range(self, key, start=0, end=-1, reverse=False):
+        return await self._shard(key).sorted_set_range(key, start, end, reverse)
+
+    async def acquire_lock(self, key, owner, ttl):
+        return await self._shard(key).acquire_lock(key, owner, ttl)
+
+    async def extend_lock(self, key, owner, ttl):
+        return await self._shard(key).extend_lock(key, owner, ttl)
+
+    async def release_lock(self, key, owner):
+        return await self._shard(key).release_lock(key, owner)
+
+    async def wait_for_lock(self, key, timeout):
+        return await self._shard(key).wait_for_lock(key, timeout)
+
+    async def ttl(self, key):
+        return await self._shard(key).ttl(key)
+
+    async def touch(self, key, expires):
+        return await self._shard(key).touch(key, expires)
+
+    async def get_and_touch(self, key, expires):
+        return await self._shard(key).get_and_touch(key, expires)
+
+    async def dump(self, key):
+        return await self._shard(key).dump(key)
+
+    async def restore(self, key, data, expires=None):
+        await self._shard(key).restore(key, data, expires)
+
+    async def delete(self, key):
+        await self._shard(key).delete(key)
+
+    async def delete_matching(self, pattern):
+        deleted = await asyncio.gather(
+            *(shard.delete_matching(pattern) for shard in self._shards.values())
+        )
+        return sum(deleted)
+
+    async def has(self, key):
+        return await self._shard(key).has(key)
+
+    async def size(self):
+        sizes = await asyncio.gather(*(shard.size() for shard in self._shards.values()))
+        return sum(sizes)
+
+    async def namespace_usage(self, namespace):
+        usages = await asyncio.gather(
+            *(shard.namespace_usage(namespace) for shard in self._shards.values())
+        )
+        return {
+            "keys": sum(usage["keys"] for usage in usages),
+            "bytes": sum(usage["bytes"] for usage in usages),
+        }
+
+    def stats(self):
+        return {"shards": {name: shard.stats() for name, shard in self._shards.items()}}
+
+    async def find_keys(self, pattern):
+        keys = await asyncio.gather(
+            *(shard.find_keys(pattern) for shard in self._shards.values())
+        )
+        return list(itertools.chain.from_iterable(keys))
+
+    async def scan(self, pattern, cursor=None, count=None):
+        # The cursor is the index of the shard being scanned, and the cursor within that shard
+        names = list(self._shards)
+        idx, shard_cursor = cursor or (0, None)
+        shard_cursor, keys = await self._shards[names[idx]].scan(pattern, shard_cursor, count)
+        if shard_cursor is None:
+            idx, shard_cursor = idx + 1, None
+        if idx == len(names):
+            return None, keys
+        return [idx, shard_cursor], keys
+
+    def logical_key(self, key):
+        return next(iter(self._shards.values())).logical_key(key)
+
+    async def iter_keys(self, pattern, count=None):
+        shards = self._shards.values()
+        async for key in merge([shard.iter_keys(pattern, count=count) for shard in shards]):
+            yield key
+
+    async def iter_items(self, pattern, count=None):
+        shards = self._shards.values()
+        async for item in merge([shard.iter_items(pattern, count=count) for shard in shards]):
+            yield item
+
+    async def add_shard(self, url, rebalance=True):
+        """Add a shard, and move the keys that belong to it from the existing shards
+
+        :param url: the url of the new shard
+        :param rebalance: ``True/False`` whether to move keys to the new shard right away. When
+            ``False``, keys that now belong to the new shard can't be found until
+            :py:meth:`rebalance` is called.
+        :return: the number of keys moved to the new shard
+        """
+        if url in self._shards:
+            raise ValueError("Shard {} already exists".format(url))
+        shard = self._build_shard(url)
+        await shard.connect()
+        self._shards[url] = shard
+        self._ring.add(url)
+        if not rebalance:
+            return 0
+        return await self.rebalance()
+
+    async def rebalance(self, count=None):
+        """Move every key that is stored on another shard than the one it belongs to
+
+        Keys are moved with their data, whatever its type (including collections), and their
+        expiration is kept. Keys are written to their new shard before they are deleted from the
+        old one, so they don't disappear while rebalancing, but concurrent writes to a key that is
+        being moved can get lost.
+
+        :param count: optional hint for the number of keys to fetch from a shard at once
+        :return: the number of keys that were moved
+        """
+        moved = await asyncio.gather(
+            *(self._rebalance_shard(name, count) for name in list(self._shards))
+        )
+        return sum(moved)
+
+    async def _rebalance_shard(self, name, count):
+        shard = self._shards[name]
+        moved = 0
+        async for key in shard.iter_keys("*", count=count):
+            owner = self._shard_name(key)
+            if owner == name:
+                continue
+            # Keys are dumped and restored as a whole, so collections are moved as well
+            data = await shard.dump(key)
+            if data is None:
+                # The key expired or was removed since it was found
+                continue
+            ttl = await shard.ttl(key)
+            if ttl is not None:
+                # A ttl of 0 would store the key without expiration
+                ttl = max(ttl, 1)
+            await self._shards[owner].restore(key, data, ttl)
+            await shard.delete(key)
+            moved += 1
+        if moved:
+            logger.info(f"Moved {moved} keys from shard {name}")
+        return moved
@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import math
+import sqlite3
+import time
+from contextlib import contextmanager
+from functools import partial
+
+from loguru import logger
+
+from machine.storage.backends.base import MachineBaseStorage
+from machine.utils.aio import build_executor
+from machine.utils.collections import glob_prefix
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS storage (
+        key TEXT PRIMARY KEY,
+        value BLOB NOT NULL,
+        expires_at REAL
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS storage_expires_at
+        ON storage (expires_at) WHERE expires_at IS NOT NULL
+    """,
+    # Locks are kept apart from the data. A released lock keeps its row, so the fencing token
+    # keeps increasing.
+    """
+    CREATE TABLE IF NOT EXISTS locks (
+        key TEXT PRIMARY KEY,
+        owner TEXT,
+        expires_at REAL,
+        token INTEGER NOT NULL
+    ) WITHOUT ROWID
+    """,
+]
+
+NOT_EXPIRED = "(expires_at IS NULL OR expires_at > ?)"
+
+
+class SQLiteStorage(MachineBaseStorage):
+    """Storage backend that keeps data in a local SQLite database
+
+    The database is opened in WAL mode, so reads don't block on writes. All database I/O happens
+    on a single dedicated thread that owns the connection, so the event loop is never blocked by
+    disk access. Expired data is filtered out on read and purged from the database periodically.
+
+    Locks are kept in a separate table. Processes that share the database file share the locks,
+    and poll for a lock that is held by someone else.
+    """
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self._path = settings.get("SQLITE_PATH", "slack-machine.db")
+        self._purge_interval = settings.get("SQLITE_PURGE_INTERVAL", 60)
+        self._executor = None
+        self._conn = None
+        self._purger = None
+
+    async def connect(self):
+        self._executor = build_executor(
+            max_workers=1, thread_name_prefix="sqlite-storage"
+        )
+        await self._run(self._open)
+        if self._purge_interval:
+            self._purger = asyncio.ensure_future(self._purge_periodically())
+
+    async def close(self):
+        if self._purger is not None:
+            self._purger.cancel()
+            self._purger = None
+        if self._executor is not None:
+            await self._run(self._close)
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _close(self):
+        self._conn.close()
+        self._conn = None
+
+    def _open(self):
+        # The connection is only ever used from the executor's single thread, and transactions
+        # are managed explicitly.
+        self._conn = sqlite3.connect(
+            self._path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in SCHEMA:
+            self._conn.execute(statement)
+
+    async def _run(self, fn, *args):
+        if self._executor is None:
+            raise NotConnectedError()
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, partial(fn, *args))
+
+    @contextmanager
+    def _transaction(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._conn
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        else:
+            self._conn.execute("COMMIT")
+
+    @staticmethod
+    def _key(key):
+        return key.decode("utf-8") if isinstance(key, bytes) else key
+
+    @staticmethod
+    def _expires_at(expires):
+        return time.time() + expires if expires else None
+
+    @staticmethod
+    def _key_range(pattern):
+        """Translate a glob pattern into SQL conditions on the primary key
+
+        The literal prefix of the pattern is turned into a range condition, so SQLite can
+        resolve it with the primary key index before applying the GLOB to the candidates.
+        """
+        prefix = glob_prefix(pattern)
+        # SQLite's GLOB negates character classes with ^ instead of !
+        conditions, params = ["key GLOB ?"], [pattern.replace("[!", "[^")]
+        if prefix:
+            upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            conditions[:0] = ["key >= ?", "key < ?"]
+            params[:0] = [prefix, upper]
+        return " AND ".join(conditions), params
+
+    def _get(self, key, now):
+        row = self._conn.execute(
+            f"SELECT value, expires_at FROM storage WHERE key = ? AND {NOT_EXPIRED}",
+            (key, now),
+        ).fetchone()
+        return row
+
+    def _set(self, key, value, expires_at):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO storage (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, expires_at),
+        )
+
+    async def get(self, key):
+        row = await self._run(self._get, self._key(key), time.time())
+        return row[0] if row else None
+
+    def _get_many(self, keys, now):
+        values = {}
+        # Stay well below SQLite's limit on the number of parameters of a statement
+        for idx in range(0, len(keys), 500):
+            chunk = keys[idx : idx + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            values.update(
+                self._conn.execute(
+                    f"SELECT key, value FROM storage WHERE key IN ({placeholders}) "
+                    f"AND {NOT_EXPIRED}",
+                    (*chunk, now),
+                )
+            )
+        return [values.get(key) for key in keys]
+
+    async def get_many(self, keys):
+        keys = [self._key(key) for key in keys]
+        return await self._run(self._get_many, keys, time.time())
+
+    async def set(self, key, value, expires=None):
+        await self._run(self._set, self._key(key), value, self._expires_at(expires))
+
+    def _set_many(self, items, expires_at):
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO storage (key, value, expires_at) VALUES (?, ?, ?)",
+                ((key, value, expires_at) for key, value in items),
+            )
+
+    async def set_many(self, items, expires=None):
+        items = [(self._key(key), value) for key, value in items.items()]
+        await self._run(self._set_many, items, self._expires_at(expires))
+
+    def _incr(self, key, amount, expires):
+        now = time.time()
+        with self._transaction():
+            row = self._get(key, now)
+            if row is None:
+                value, expires_at = amount, self._expires_at(expires)
+            else:
+                value, expires_at = int(row[0]) + amount, row[1]
+                if expires_at is None:
+                    expires_at = self._expires_at(expires)
+            self._set(key, str(value).encode("utf-8"), expires_at)
+        return value
+
+    async def incr(self, key, amount=1, expires=None):
+        return await self._run(self._incr, self._key(key), amount, expires)
+
+    def _set_if_absent(self, key, value, expires_at):
+        # Rows that have expired but have not been purged yet count as absent
+        cursor = self._conn.execute(
+            "INSERT INTO storage (key, value, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET "
+            "value = excluded.value, expires_at = excluded.expires_at "
+            "WHERE storage.expires_at IS NOT NULL AND storage.expires_at <= ?",
+            (key, value, expires_at, time.time()),
+        )
+        return cursor.rowcount == 1
+
+    async def set_if_absent(self, key, value, expires=None):
+        return await self._run(
+            self._set_if_absent, self._key(key), value, self._expires_at(expires)
+        )
+
+    def _compare_and_set(self, key, expected, value, expires_at):
+        with self._transaction():
+            row = self._get(key, time.time())
+            if (row[0] if row else None) != expected:
+                return False
+            self._set(key, value, expires_at)
+            return True
+
+    async def compare_and_set(self, key, expected, value, expires=None):
+        return await self._run(
+            self._compare_and_set,
+            self._key(key),
+            expected,
+            value,
+            self._expires_at(expires),
+        )
+
+    async def ttl(self, key):
+        now = time.time()
+        row = await self._run(self._get, self._key(key), now)
+        if row is None or row[1] is None:
+            return None
+        return math.ceil(row[1] - now)
+
+    def _touch(self, key, expires_at):
+        cursor = self._conn.execute(
+            f"UPDATE storage SET expires_at = ? WHERE key = ? AND {NOT_EXPIRED}",
+            (expires_at, key, time.time()),
+        )
+        return cursor.rowcount == 1
+
+    async def touch(self, key, expires):
+        return await self._run(self._touch, self._key(key), self._expires_at(expires))
+
+    def _get_and_touch(self, key, expires_at):
+        with self._transaction():
+            row = self._get(key, time.time())
+            if row is None:
+                return None
+            self._touch(key, expires_at)
+            return row[0]
+
+    async def get_and_touch(self, key, expires):
+        return await self._run(self._get_and_touch, self._key(key), self._expires_at(expires))
+
+    def _delete(self, key):
+        self._conn.execute("DELETE FROM storage WHERE key = ?", (key,))
+
+    async def delete(self, key):
+        await self._run(self._delete, self._key(key))
+
+    def _acquire_lock(self, key, owner, expires_at):
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT owner, expires_at, token FROM locks WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row[0] is not None and row[1] > now:
+                return None
+            token = (row[2] if row else 0) + 1
+            conn.execute(
+                "INSERT OR REPLACE INTO locks (key, owner, expires_at, token) VALUES (?, ?, ?, ?)",
+                (key, owner, expires_at, token),
+            )
+        return token
+
+    async def acquire_lock(self, key, owner, ttl):
+        return await self._run(self._acquire_lock, self._key(key), owner, time.time() + ttl)
+
+    def _update_lock(self, key, owner, expires_at):
+        cursor = self._conn.execute(
+            "UPDATE locks SET owner = ?, expires_at = ? "
+            "WHERE key = ? AND owner = ? AND expires_at > ?",
+            (owner if expires_at else None, expires_at, key, owner, time.time()),
+        )
+        return cursor.rowcount == 1
+
+    async def extend_lock(self, key, owner, ttl):
+        return await self._run(self._update_lock, self._key(key), owner, time.time() + ttl)
+
+    async def release_lock(self, key, owner):
+        return await self._run(self._update_lock, self._key(key), owner, None)
+
+    def _delete_matching(self, pattern, now):
+        conditions, params = self._key_range(pattern)
+        with self._transaction() as conn:
+            deleted = conn.execute(
+                f"DELETE FROM storage WHERE {conditions} AND {NOT_EXPIRED}", (*params, now)
+            ).rowcount
+            # Expired rows don't count as deleted, but there's no point in keeping them
+            conn.execute(f"DELETE FROM storage WHERE {conditions}", params)
+        return deleted
+
+    async def delete_matching(self, pattern):
+        return await self._run(self._delete_matching, self._key(pattern), time.time())
+
+    async def has(self, key):
+        return await self._run(self._get, self._key(key), time.time()) is not None
+
+    def _size(self):
+        page_count = self._conn.execute("PRAGMA page_count").fetchone()[0]
+        page_size = self._conn.execute("PRAGMA page_size").fetchone()[0]
+        return page_count * page_size
+
+    async def size(self):
+        return await self._run(self._size)
+
+    def _find_keys(self, pattern, now):
+        conditions, params = self._key_range(pattern)
+        rows = self._conn.execute(
+            f"SELECT key FROM storage WHERE {conditions} AND {NOT_EXPIRED} ORDER BY key",
+            (*params, now),
+        )
+        return [row[0] for row in rows]
+
+    async def find_keys(self, pattern):
+        return await self._run(self._find_keys, self._key(pattern), time.time())
+
+    def _page(self, pattern, after, count, now, columns="key, value"):
+        conditions, params = self._key_range(pattern)
+        if after is not None:
+            conditions += " AND key > ?"
+            params.append(after)
+        return self._conn.execute(
+            f"SELECT {columns} FROM storage WHERE {conditions} AND {NOT_EXPIRED} "
+            "ORDER BY key LIMIT ?",
+            (*params, now, count),
+        ).fetchall()
+
+    async def iter_items(self, pattern, count=None):
+        pattern = self._key(pattern)
+        count = count or 1000
+        after = None
+        while True:
+            page = await self._run(self._page, pattern, after, count, time.time())
+            for key, value in page:
+                yield key, value
+            if len(page) < count:
+                break
+            after = page[-1][0]
+
+    async def scan(self, pattern, cursor=None, count=None):
+        count = count or 1000
+        page = await self._run(
+            self._page, self._key(pattern), cursor, count, time.time(), "key"
+        )
+        keys = [row[0] for row in page]
+        return (keys[-1] if len(keys) == count else None), keys
+
+    async def iter_keys(self, pattern, count=None):
+        # Only the keys are selected, the values are never read
+        cursor = None
+        while True:
+            cursor, keys = await self.scan(pattern, cursor, count)
+            for key in keys:
+                yield key
+            if cursor is None:
+                break
+
+    def _namespace_usage(self, namespace, now):
+        conditions, params = self._key_range(namespace + ":*")
+        keys, size = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(key) + LENGTH(value)), 0) "
+            f"FROM storage WHERE {conditions} AND {NOT_EXPIRED}",
+            (*params, now),
+        ).fetchone()
+        return {"keys": keys, "bytes": size}
+
+    async def namespace_usage(self, namespace):
+        return await self._run(self._namespace_usage, namespace, time.time())
+
+    def _purge_expired(self):
+        cursor = self._conn.execute(
+            "DELETE FROM storage WHERE expires_at <= ?", (time.time(),)
+        )
+        return cursor.rowcount
+
+    async def _purge_periodically(self):
+        while True:
+            await asyncio.sleep(self._purge_interval)
+            try:
+                purged = await self._run(self._purge_expired)
+                logger.debug(f"Purged {purged} expired keys from SQLite storage")
+            except sqlite3.Error:
+                logger.exception("Failed to purge expired keys from SQLite storage")
+
+
+class NotConnectedError(Exception):
+    def __init__(self):
+        super().__init__()
+        self.message = "SQLiteStorage backend must be `connect()`ed before using"
+
+    def __repr__(self):
+        return self.message
+
+    __str__ = __repr__
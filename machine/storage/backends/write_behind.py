@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import math
+import re
+import time
+from collections import defaultdict
+from fnmatch import translate
+
+from loguru import logger
+
+from machine.storage.backends.base import MachineBaseStorage
+
+# Marks a buffered delete
+_DELETED = object()
+
+
+class WriteBehindStorage(MachineBaseStorage):
+    """Storage backend that buffers writes to another backend
+
+    Writes to keys matching one of the configured patterns are kept in memory and written to the
+    wrapped backend in batches, every ``flush_interval`` seconds or as soon as ``max_keys`` keys are
+    buffered. Multiple writes to the same key in between are coalesced into one. Reads check the
+    buffer first, so they always see buffered writes.
+
+    Atomic operations, searches and usage calculations flush the buffer before they are passed on,
+    so they operate on up-to-date data. Writes to other keys are passed on right away.
+
+    Buffered writes are lost when the process dies before they are flushed, so this should only
+    be used for data that can tolerate that, like statistics.
+    """
+
+    def __init__(self, backend, settings):
+        super().__init__(settings)
+        self._backend = backend
+        self.supports_collections = backend.supports_collections
+        patterns = settings.get("STORAGE_WRITE_BEHIND", [])
+        # (?!) never matches, for when no patterns are configured
+        self._patterns = re.compile("|".join(map(translate, patterns)) or "(?!)")
+        self._flush_interval = settings.get("STORAGE_WRITE_BEHIND_INTERVAL", 1)
+        self._max_keys = settings.get("STORAGE_WRITE_BEHIND_MAX_KEYS", 1000)
+        self._buffer = {}
+        self._flushing = {}
+        self._lock = asyncio.Lock()
+        self._flusher = None
+        self._flushes = 0
+        self._flushed_keys = 0
+
+    def __getattr__(self, item):
+        # Give access to backend specific methods, like `ShardedStorage.add_shard`
+        return getattr(self._backend, item)
+
+    async def connect(self):
+        await self._backend.connect()
+        if self._flush_interval:
+            self._flusher = asyncio.ensure_future(self._flush_periodically())
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+        await self._backend.close()
+
+    def _buffered(self, key):
+        if isinstance(key, bytes):
+            key = key.decode("utf-8")
+        return self._patterns.match(key) is not None
+
+    def _lookup(self, key):
+        """Find a buffered write for a key, or ``None`` if the backend has to be checked"""
+        if key in self._buffer:
+            entry = self._buffer[key]
+        else:
+            entry = self._flushing.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            # The buffered value has expired, it is deleted when it is flushed
+            return _DELETED, None
+        return entry
+
+    @staticmethod
+    def _expires_at(expires):
+        # Buffered writes keep their deadline, so the time spent in the buffer counts as well
+        return time.monotonic() + expires if expires else None
+
+    async def _buffer_write(self, key, value, expires=None):
+        self._buffer[key] = (value, self._expires_at(expires))
+        if len(self._buffer) >= self._max_keys:
+            await self.flush()
+
+    async def flush(self):
+        """Write all buffered writes to the backend
+
+        Flushes never run concurrently, so buffered writes to a key always reach the backend in
+        order. When a flush fails, the writes are kept in the buffer to be retried by the next
+        flush (unless the key has been written again since).
+        """
+        async with self._lock:
+            if not self._buffer:
+                return
+            self._flushing, self._buffer = self._buffer, {}
+            try:
+                await self._write(self._flushing)
+            except BaseException:
+                for key, entry in self._flushing.items():
+                    self._buffer.setdefault(key, entry)
+                raise
+            else:
+                self._flushes += 1
+                self._flushed_keys += len(self._flushing)
+            finally:
+                self._flushing = {}
+
+    async def _write(self, batch):
+        by_expiration = defaultdict(dict)
+        deletes = []
+        now = time.monotonic()
+        for key, (value, expires_at) in batch.items():
+            if value is _DELETED or (expires_at is not None and expires_at <= now):
+                deletes.append(key)
+            elif expires_at is None:
+                by_expiration[None][key] = value
+            else:
+                # Backends take whole seconds, round up so keys never expire early
+                by_expiration[math.ceil(expires_at - now)][key] = value
+        for expires, items in by_expiration.items():
+            await self._backend.set_many(items, expires)
+        for key in deletes:
+            await self._backend.delete(key)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to flush buffered storage writes")
+
+    async def get(self, key):
+        buffered = self._lookup(key)
+        if buffered is None:
+            return await self._backend.get(key)
+        value, _ = buffered
+        return None if value is _DELETED else value
+
+    async def get_many(self, keys):
+        buffered = [self._lookup(key) for key in keys]
+        missing = [key for key, entry in zip(keys, buffered) if entry is None]
+        fetched = iter(await self._backend.get_many(missing) if missing else [])
+        values = []
+        for entry in buffered:
+            if entry is None:
+                values.append(next(fetched))
+            else:
+                values.append(None if entry[0] is _DELETED else entry[0])
+        return values
+
+    async def set(self, key, value, expires=None):
+        if self._buffered(key):
+            await self._buffer_write(key, value, expires)
+        else:
+            await self._backend.set(key, value, expires)
+
+    async def set_many(self, items, expires=None):
+        passed_on = {}
+        expires_at = self._expires_at(expires)
+        for key, value in items.items():
+            if self._buffered(key):
+                self._buffer[key] = (value, expires_at)
+            else:
+                passed_on[key] = value
+        if passed_on:
+            await self._backend.set_many(passed_on, expires)
+        if len(self._buffer) >= self._max_keys:
+            await self.flush()
+
+    async def _flush_pending(self, key):
+        """Flush the buffer if it holds a write to the key, before the backend operates on it"""
+        if self._lookup(key) is not None:
+            await self.flush()
+
+    async def incr(self, key, amount=1, expires=None):
+        await self._flush_pending(key)
+        return await self._backend.incr(key, amount, expires)
+
+    async def set_if_absent(self, key, value, expires=None):
+        await self._flush_pending(key)
+        return await self._backend.set_if_absent(key, value, expires)
+
+    async def compare_and_set(self, key, expected, value, expires=None):
+        await self._flush_pending(key)
+        return await self._backend.compare_and_set(key, expected, value, expires)
+
+    async def list_push(self, key, values, left=False):
+        await self._flush_pending(key)
+        return await self._backend.list_push(key, values, left)
+
+    async def list_pop(self, key, left=False):
+        await self._flush_pending(key)
+        return await self._backend.list_pop(key, left)
+
+    async def list_range(self, key, start=0, end=-1):
+        await self._flush_pending(key)
+        return await self._backend.list_range(key, start, end)
+
+    async def list_length(self, key):
+        await self._flush_pending(key)
+        return await self._backend.list_length(key)
+
+    async def set_add(self, key, members):
+        await self._flush_pending(key)
+        return await self._backend.set_add(key, members)
+
+    async def set_remove(self, key, members):
+        await self._flush_pending(key)
+        return await self._backend.set_remove(key, members)
+
+    async def set_members(self, key):
+        await self._flush_pending(key)
+        return await self._backend.set_members(key)
+
+    async def set_contains(self, key, member):
+        await self._flush_pending(key)
+        return await self._backend.set_contains(key, member)
+
+    async def hash_set(self, key, field, value):
+        await self._flush_pending(key)
+        return await self._backend.hash_set(key, field, value)
+
+    async def hash_get(self, key, field):
+        await self._flush_pending(key)
+        return await self._backend.hash_get(key, field)
+
+    async def hash_get_all(self, key):
+        await self._flush_pending(key)
+        return await self._backend.hash_get_all(key)
+
+    async def hash_delete(self, key, fields):
+        await self._flush_pending(key)
+        return await self._backend.hash_delete(key, fields)
+
+    async def sorted_set_add(self, key, scores):
+        await self._flush_pending(key)
+        return await self._backend.sorted_set_add(key, scores)
+
+    async def sorted_set_increment(self, key, member, amount=1):
+        await self._flush_pending(key)
+        return await self._backend.sorted_set_increment(key, member, amount)
+
+    async def sorted_set_remove(self, key, members):
+        await self._flush_pending(key)
+        return await self._backend.sorted_set_remove(key, members)
+
+    async def sorted_set_score(self, key, member):
+        await self._flush_pending(key)
+        return await self._backend.sorted_set_score(key, member)
+
+    async def sorted_set_rank(self, key, member, reverse=False):
+        await self._flush_pending(key)
+        return await self._backend.sorted_set_rank(key, member, reverse)
+
+    async def sorted_set_range(self, key, start=0, end=-1, reverse=False):
+        await self._flush_pending(key)
+        return await self._backend.sorted_set_range(key, start, end, reverse)
+
+    async def acquire_lock(self, key, owner, ttl):
+        return await self._backend.acquire_lock(key, owner, ttl)
+
+    async def extend_lock(self, key, owner, ttl):
+        return await self._backend.extend_lock(key, owner, ttl)
+
+    async def release_lock(self, key, owner):
+        return await self._backend.release_lock(key, owner)
+
+    async def wait_for_lock(self, key, timeout):
+        return await self._backend.wait_for_lock(key, timeout)
+
+    async def ttl(self, key):
+        buffered = self._lookup(key)
+        if buffered is None:
+            return await self._backend.ttl(key)
+        value, expires_at = buffered
+        if value is _DELETED or expires_at is None:
+            return None
+        return math.ceil(expires_at - time.monotonic())
+
+    async def touch(self, key, expires):
+        buffered = self._lookup(key)
+        if buffered is None:
+            return await self._backend.touch(key, expires)
+        if buffered[0] is _DELETED:
+            return False
+        # Buffer the new expiration time with the value, so it takes effect when it is flushed
+        await self._buffer_write(key, buffered[0], expires)
+        return True
+
+    async def get_and_touch(self, key, expires):
+        buffered = self._lookup(key)
+        if buffered is None:
+            return await self._backend.get_and_touch(key, expires)
+        if buffered[0] is _DELETED:
+            return None
+        await self._buffer_write(key, buffered[0], expires)
+        return buffered[0]
+
+    async def delete(self, key):
+        if self._buffered(key):
+            # The delete has to be buffered as well, or it could overtake a buffered write
+            await self._buffer_write(key, _DELETED)
+        else:
+            await self._backend.delete(key)
+
+    async def delete_matching(self, pattern):
+        await self.flush()
+        return await self._backend.delete_matching(pattern)
+
+    async def has(self, key):
+        buffered = self._lookup(key)
+        if buffered is None:
+            return await self._backend.has(key)
+        return buffered[0] is not _DELETED
+
+    async def size(self):
+        await self.flush()
+        return await self._backend.size()
+
+    async def namespace_usage(self, namespace):
+        await self.flush()
+        return await self._backend.namespace_usage(namespace)
+
+    def stats(self):
+        return {
+            **self._backend.stats(),
+            "write_behind": {
+                "buffered": len(self._buffer),
+                "flushes": self._flushes,
+                "flushed_keys": self._flushed_keys,
+            },
+        }
+
+    async def find_keys(self, pattern):
+        await self.flush()
+        return await self._backend.find_keys(pattern)
+
+    async def scan(self, pattern, cursor=None, count=None):
+        await self.flush()
+        return await self._backend.scan(pattern, cursor, count)
+
+    def logical_key(self, key):
+        return self._backend.logical_key(key)
+
+    async def iter_keys(self, pattern, count=None):
+        await self.flush()
+        async for key in self._backend.iter_keys(pattern, count=count):
+            yield key
+
+    async def iter_items(self, pattern, count=None):
+        await self.flush()
+        async for item in self._backend.iter_items(pattern, count=count):
+            yield item
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import time
+import uuid
+
+from loguru import logger
+
+from machine.singletons import Storage
+
+
+class StorageLock:
+    """A lock that is shared by all Slack Machine processes using the same storage
+
+    Use :py:meth:`machine.storage.PluginStorage.lock` to create a lock. While the lock is held,
+    its ttl is extended in the background, so it does not expire while the holder is still
+    working. If the lock can't be extended (because the storage was unreachable for longer than
+    the ttl), :py:attr:`lost` becomes ``True`` and another process may have acquired the lock.
+
+    The :py:attr:`token` of an acquired lock is a fencing token: it is higher than the tokens of
+    everyone who acquired the lock before.
+    """
+
+    def __init__(self, key, ttl=30, timeout=None, renew=True, stats=None):
+        self.key = key
+        self.ttl = ttl
+        self.timeout = timeout
+        self.renew = renew
+        self.token = None
+        self.lost = False
+        self._owner = uuid.uuid4().hex
+        self._renewer = None
+        self._stats = stats if stats is not None else new_lock_stats()
+
+    async def acquire(self):
+        """Acquire the lock, waiting for it if it is held by someone else
+
+        :return: the fencing token
+        :raises LockTimeout: if the lock could not be acquired within ``timeout`` seconds
+        """
+        backend = Storage.get_instance()
+        start = time.monotonic()
+        delay = 0.01
+        while True:
+            token = await backend.acquire_lock(self.key, self._owner, self.ttl)
+            if token is not None:
+                break
+            waited = time.monotonic() - start
+            if self.timeout is not None and waited >= self.timeout:
+                self._stats["timeouts"] += 1
+                raise LockTimeout(self.key, self.timeout)
+            wait = delay if self.timeout is None else min(delay, self.timeout - waited)
+            await backend.wait_for_lock(self.key, wait)
+            delay = min(delay * 2, 1)
+
+        waited = time.monotonic() - start
+        self._stats["acquired"] += 1
+        self._stats["wait_seconds_total"] += waited
+        self._stats["wait_seconds_max"] = max(self._stats["wait_seconds_max"], waited)
+
+        self.token = token
+        self.lost = False
+        if self.renew:
+            self._renewer = asyncio.ensure_future(self._renew_periodically())
+        return token
+
+    async def _renew_periodically(self):
+        backend = Storage.get_instance()
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                extended = await backend.extend_lock(self.key, self._owner, self.ttl)
+            except Exception:
+                # The lock might still be extended before it expires
+                logger.exception(f"Failed to extend lock {self.key}")
+                continue
+            if not extended:
+                logger.warning(f"Lost lock {self.key}, it expired before it was extended")
+                self._stats["lost"] += 1
+                self.lost = True
+                return
+
+    async def release(self):
+        """Release the lock, if it is still held"""
+        if self._renewer is not None:
+            self._renewer.cancel()
+            self._renewer = None
+        await Storage.get_instance().release_lock(self.key, self._owner)
+        self.token = None
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.release()
+
+
+def new_lock_stats():
+    return {
+        "acquired": 0,
+        "timeouts": 0,
+        "lost": 0,
+        "wait_seconds_total": 0.0,
+        "wait_seconds_max": 0.0,
+    }
+
+
+class LockTimeout(Exception):
+    def __init__(self, key, timeout):
+        super().__init__()
+        self.key = key
+        self.message = "Could not acquire lock {} within {} seconds".format(key, timeout)
+
+    def __repr__(self):
+        return self.message
+
+    __str__ = __repr__
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import os
+import time
+from collections import defaultdict
+
+from loguru import logger
+
+from machine.utils import sizeof_fmt
+
+
+async def migrate(
+    source,
+    target,
+    patterns=("*",),
+    batch_size=500,
+    checkpoint=None,
+    report_interval=5,
+):
+    """Copy all keys matching the patterns, with their data and expiration, between backends
+
+    Keys are read from the source backend page by page with
+    :py:meth:`~machine.storage.backends.base.MachineBaseStorage.scan` and written to the target
+    backend in batches, so no more than one page of data is held in memory. Collections (lists,
+    sets, hashes and sorted sets) are copied with
+    :py:meth:`~machine.storage.backends.base.MachineBaseStorage.dump` and
+    :py:meth:`~machine.storage.backends.base.MachineBaseStorage.restore` when both backends are
+    of the same type. Otherwise they can't be copied, and are counted as skipped.
+
+    When a checkpoint file is given, the position of the migration is saved to it after every
+    batch that has been written, and a migration that was interrupted continues from there when
+    it is started again with the same checkpoint file. The checkpoint file is removed when the
+    migration is complete.
+
+    The migration copies the data as it is when each key is read, so keys that are written while
+    the migration runs can be copied before they are written. Run the migration again (without
+    checkpoint) to copy those writes as well.
+
+    :param source: the (connected) backend to copy data from
+    :param target: the (connected) backend to copy data to
+    :param patterns: glob patterns of the keys to copy
+    :param batch_size: the number of keys to read and write at once
+    :param checkpoint: optional path of the checkpoint file
+    :param report_interval: number of seconds between progress reports in the log
+    :return: dictionary with the number of keys ``migrated`` and ``skipped``, the number of
+        ``bytes`` copied and the number of ``seconds`` the migration took
+    """
+    state = _load_checkpoint(checkpoint)
+    start = time.monotonic()
+    reported = start
+    copied = {"migrated": 0, "skipped": 0, "bytes": 0}
+
+    for idx, pattern in enumerate(patterns):
+        if idx < state["pattern"]:
+            continue
+        cursor = state["cursor"] if idx == state["pattern"] else None
+        while True:
+            cursor, keys = await source.scan(pattern, cursor, batch_size)
+            batch = await _copy_batch(source, target, keys)
+            for name, count in batch.items():
+                copied[name] += count
+                state[name] += count
+
+            if cursor is None:
+                break
+            state.update(pattern=idx, cursor=cursor)
+            _save_checkpoint(checkpoint, state)
+
+            if time.monotonic() - reported >= report_interval:
+                reported = time.monotonic()
+                _report(state, copied, reported - start)
+        state.update(pattern=idx + 1, cursor=None)
+        _save_checkpoint(checkpoint, state)
+
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    seconds = time.monotonic() - start
+    _report(state, copied, seconds)
+    return {**state, "seconds": seconds}
+
+
+async def _copy_batch(source, target, keys):
+    values = await source.get_many(keys) if keys else []
+    present, other = [], []
+    for key, value in zip(keys, values):
+        if isinstance(value, (bytes, str)):
+            present.append((key, value))
+        else:
+            # Collections, or keys that were removed since they were found
+            other.append(key)
+    ttls = await asyncio.gather(*(source.ttl(key) for key, _ in present))
+
+    by_ttl = defaultdict(dict)
+    size = 0
+    for (key, value), ttl in zip(present, ttls):
+        by_ttl[_expires(ttl)][source.logical_key(key)] = value
+        size += len(value)
+    for ttl, items in by_ttl.items():
+        await target.set_many(items, ttl)
+
+    migrated, skipped = len(present), 0
+    for key in other:
+        if type(source) is not type(target):
+            # Dumped data can only be restored by a backend of the same type
+            if await source.has(key):
+                logger.warning(f"Skipping {key}, collections can't be copied to another backend")
+                skipped += 1
+            continue
+        data = await source.dump(key)
+        if data is None:
+            continue
+        expires = _expires(await source.ttl(key))
+        await target.restore(source.logical_key(key), data, expires)
+        migrated += 1
+        if isinstance(data, (bytes, str)):
+            size += len(data)
+    return {"migrated": migrated, "skipped": skipped, "bytes": size}
+
+
+def _expires(ttl):
+    # A ttl of 0 would store the key without expiration
+    return max(ttl, 1) if ttl is not None else None
+
+
+def _report(state, copied, seconds):
+    seconds = max(seconds, 1e-6)
+    logger.info(
+        f"Migrated {state['migrated']} keys, skipped {state['skipped']} "
+        f"({copied['migrated'] / seconds:.0f} keys/s, {sizeof_fmt(copied['bytes'] / seconds)}/s)"
+    )
+
+
+def _load_checkpoint(path):
+    state = {"pattern": 0, "cursor": None, "migrated": 0, "skipped": 0, "bytes": 0}
+    if path is not None and os.path.exists(path):
+        with open(path) as f:
+            state.update(json.load(f))
+        logger.info(f"Resuming migration from {path}")
+    return state
+
+
+def _save_checkpoint(path, state):
+    if path is None:
+        return
+    # Write to a temporary file first, so an interruption never leaves a corrupt checkpoint
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
@@ -3,7 +3,17 @@
 import asyncio
 import concurrent
 from functools import partial
-from typing import Any, Callable, Coroutine, List, Optional, Sequence, Tuple, Type
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Coroutine,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+)
 
 
 async def join(tasks: Sequence[Coroutine]) -> List[Any]:
@@ -47,6 +57,72 @@ async def split(tasks: Sequence[Coroutine]) -> Tuple[List[Any], List[Type[Except
     return return_values, exceptions
 
 
+async def merge(iterators: Sequence[AsyncIterator]) -> AsyncIterator:
+    """ Iterate over multiple async iterators concurrently, yielding items
+        from all of them in the order they become available.
+
+        The iterators are consumed by background tasks, which wait for the
+        items to be picked up before fetching more. The first exception
+        raised by any of the iterators is re-raised, and the remaining
+        iterators are cancelled.
+    """
+
+    queue = asyncio.Queue(maxsize=max(len(iterators), 1))
+    done = object()
+
+    async def drain(iterator):
+        try:
+            async for item in iterator:
+                await queue.put((item, None))
+        except Exception as err:
+            await queue.put((done, err))
+        else:
+            await queue.put((done, None))
+
+    tasks = [asyncio.ensure_future(drain(iterator)) for iterator in iterators]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            item, err = await queue.get()
+            if item is not done:
+                yield item
+            elif err is not None:
+                raise err
+            else:
+                remaining -= 1
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class RateLimiter:
+    """ Lets callers through at no more than `rate` per second on average,
+        allowing bursts of up to `burst` callers at once. Callers that have
+        to wait are let through in the order they called `acquire`.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated_at = None
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            loop = asyncio.get_event_loop()
+            while True:
+                now = loop.time()
+                if self._updated_at is not None:
+                    elapsed = now - self._updated_at
+                    self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
 def run_coro_until_complete(
     coro: Coroutine, loop: Optional[asyncio.AbstractEventLoop] = None
 ) -> Any:
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """Tracks failures of calls to an external service, and lets callers fail fast
+    while the service is down.
+
+    The breaker starts *closed*, letting all calls through. After ``failure_threshold``
+    consecutive failures it *opens*, and :py:meth:`allow` returns ``False`` until
+    ``reset_timeout`` seconds have passed. Then it becomes *half-open*: a single call is let
+    through to probe the service, while other calls keep failing fast. A success of the probe
+    closes the breaker, and a failure opens it again. A probe that doesn't report back within
+    ``reset_timeout`` seconds is given up on, and the next call becomes the probe.
+
+    :param failure_threshold: number of consecutive failures that opens the breaker
+    :param reset_timeout: number of seconds after which an open breaker becomes half-open
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.times_opened = 0
+        self._opened_at = None
+        self._probe_started_at = None
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return CLOSED
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    def allow(self):
+        """Return whether a call may go through, the caller has to report its outcome with
+        :py:meth:`record_success` or :py:meth:`record_failure`"""
+        state = self.state
+        if state != HALF_OPEN:
+            return state == CLOSED
+        now = time.monotonic()
+        if self._probe_started_at is not None and now - self._probe_started_at < self.reset_timeout:
+            return False
+        self._probe_started_at = now
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self._opened_at = None
+        self._probe_started_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.trip()
+
+    def trip(self):
+        """Open the breaker immediately, ie. when a health check has failed."""
+        if self.state != OPEN:
+            self.times_opened += 1
+        self._opened_at = time.monotonic()
+        self._probe_started_at = None
+
+    reset = record_success
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, service):
+        super().__init__()
+        self.message = f"Circuit breaker for {service} is open, failing fast"
+
+    def __repr__(self):
+        return self.message
+
+    __str__ = __repr__
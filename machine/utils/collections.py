@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+from bisect import bisect, bisect_left
 from collections.abc import Mapping, MutableMapping
+from itertools import islice
 
 
 class CaseInsensitiveDict(MutableMapping):
@@ -71,3 +74,315 @@ class CaseInsensitiveDict(MutableMapping):
 
     def __repr__(self):
         return "%s(%r)" % (self.__class__.__name__, dict(self.items()))
+
+
+class _SortedKeys:
+    """
+    A sorted list of keys of a single type, split into buckets of
+    at most ``2 * load`` keys. Inserting or removing a key only
+    shifts the keys of one bucket (and, when a bucket is split or
+    dropped, the list of buckets), instead of the tail of one big
+    list.
+    """
+
+    def __init__(self, load):
+        self._load = load
+        self._buckets = []
+        # The last key of every bucket, to find the bucket of a key
+        self._maxes = []
+        self._len = 0
+
+    def add(self, key):
+        if not self._buckets:
+            self._buckets.append([key])
+            self._maxes.append(key)
+            self._len = 1
+            return
+        idx = bisect_left(self._maxes, key)
+        if idx == len(self._maxes):
+            idx -= 1
+            bucket = self._buckets[idx]
+            bucket.append(key)
+            self._maxes[idx] = key
+        else:
+            bucket = self._buckets[idx]
+            pos = bisect_left(bucket, key)
+            if bucket[pos] == key:
+                return
+            bucket.insert(pos, key)
+        self._len += 1
+        if len(bucket) > 2 * self._load:
+            self._buckets[idx : idx + 1] = [bucket[: self._load], bucket[self._load :]]
+            self._maxes[idx : idx + 1] = [bucket[self._load - 1], bucket[-1]]
+
+    def remove(self, key):
+        idx = bisect_left(self._maxes, key)
+        if idx == len(self._maxes):
+            return
+        bucket = self._buckets[idx]
+        pos = bisect_left(bucket, key)
+        if bucket[pos] != key:
+            return
+        del bucket[pos]
+        self._len -= 1
+        self._trim(idx)
+
+    def _trim(self, idx):
+        bucket = self._buckets[idx]
+        if bucket:
+            self._maxes[idx] = bucket[-1]
+        else:
+            del self._buckets[idx]
+            del self._maxes[idx]
+
+    def remove_sorted(self, keys):
+        """Remove keys given in sorted order, rebuilding each bucket
+        they are in once"""
+        idx, pos = 0, 0
+        while pos < len(keys):
+            idx = bisect_left(self._maxes, keys[pos], idx)
+            if idx == len(self._maxes):
+                return
+            # All keys up to the last key of this bucket belong to it
+            end = bisect(keys, self._maxes[idx], pos)
+            bucket = self._buckets[idx]
+            removed = set(keys[pos:end])
+            kept = [key for key in bucket if key not in removed]
+            self._len -= len(bucket) - len(kept)
+            bucket[:] = kept
+            self._trim(idx)
+            if kept:
+                idx += 1
+            pos = end
+
+    def iter_from(self, key, inclusive=True):
+        """Iterate over the keys from ``key`` on, in sorted order"""
+        find = bisect_left if inclusive else bisect
+        idx = find(self._maxes, key)
+        if idx == len(self._maxes):
+            return
+        bucket = self._buckets[idx]
+        yield from islice(bucket, find(bucket, key), None)
+        for bucket in islice(self._buckets, idx + 1, None):
+            yield from bucket
+
+    def __contains__(self, key):
+        idx = bisect_left(self._maxes, key)
+        if idx == len(self._maxes):
+            return False
+        bucket = self._buckets[idx]
+        return bucket[bisect_left(bucket, key)] == key
+
+    def __iter__(self):
+        for bucket in self._buckets:
+            yield from bucket
+
+    def __len__(self):
+        return self._len
+
+
+class SortedKeyIndex:
+    """
+    A sorted index over (byte)string keys, supporting range lookups
+    by prefix. Keys of different types (``str`` and ``bytes``) are
+    kept in separate sorted lists, since they cannot be ordered
+    against each other.
+    Each sorted list is split into buckets of up to ``2 * load``
+    keys, so inserting and removing a key is ``O(log n)`` to locate
+    plus shifting the keys of a single bucket. Iterating all keys
+    starting with a prefix is ``O(log n + k)``, where ``k`` is the
+    number of matching keys.
+    """
+
+    def __init__(self, keys=None, load=1000):
+        self._load = load
+        self._keys = {}
+        for key in keys or ():
+            self.add(key)
+
+    def _sorted(self, key_type):
+        keys = self._keys.get(key_type)
+        if keys is None:
+            keys = self._keys[key_type] = _SortedKeys(self._load)
+        return keys
+
+    def add(self, key):
+        self._sorted(type(key)).add(key)
+
+    def remove(self, key):
+        keys = self._keys.get(type(key))
+        if keys is not None:
+            keys.remove(key)
+
+    def remove_many(self, keys):
+        """Remove multiple keys at once, rebuilding each bucket they
+        are in only once. Keys that are next to each other in the
+        index (like the keys matching a pattern) share their buckets,
+        so this is about ``O(k)`` for ``k`` keys."""
+        by_type = {}
+        for key in keys:
+            by_type.setdefault(type(key), []).append(key)
+        for key_type, removed in by_type.items():
+            if key_type in self._keys:
+                self._keys[key_type].remove_sorted(sorted(set(removed)))
+
+    def prefixed(self, prefix, start=None):
+        """Iterate over all keys starting with ``prefix``, in sorted order.
+        If ``start`` is given, only the keys that sort after it are
+        returned, so a range of keys can be iterated in pages."""
+        if start is None or start < prefix:
+            keys = self.after(prefix, inclusive=True)
+        else:
+            keys = self.after(start)
+        for key in keys:
+            if not key.startswith(prefix):
+                break
+            yield key
+
+    def after(self, key, inclusive=False):
+        """Iterate over all keys of the same type that sort after ``key``
+        (or are equal to it, if ``inclusive``), in sorted order"""
+        keys = self._keys.get(type(key))
+        if keys is not None:
+            yield from keys.iter_from(key, inclusive)
+
+    def __contains__(self, key):
+        keys = self._keys.get(type(key))
+        return keys is not None and key in keys
+
+    def __iter__(self):
+        for keys in self._keys.values():
+            yield from keys
+
+    def __len__(self):
+        return sum(len(keys) for keys in self._keys.values())
+
+
+class SortedSet:
+    """
+    A set of members ordered by score, like a Redis sorted set.
+    Members with the same score are ordered by the members
+    themselves, so members have to be comparable to each other.
+    Adding, removing and ranking a member is ``O(log n)`` (plus a
+    ``memmove``), and retrieving a range of ``k`` members by
+    position is ``O(k)``.
+    """
+
+    def __init__(self, scores=None):
+        self._scores = {}
+        self._order = []
+        for member, score in (scores or {}).items():
+            self.add(member, score)
+
+    def add(self, member, score):
+        """Add a member or update its score, return whether it is new"""
+        is_new = self.discard(member) is False
+        self._scores[member] = score
+        self._order.insert(bisect_left(self._order, (score, member)), (score, member))
+        return is_new
+
+    def discard(self, member):
+        """Remove a member, return whether it was part of the set"""
+        score = self._scores.pop(member, None)
+        if score is None:
+            return False
+        del self._order[bisect_left(self._order, (score, member))]
+        return True
+
+    def score(self, member):
+        return self._scores.get(member)
+
+    def rank(self, member):
+        score = self._scores.get(member)
+        if score is None:
+            return None
+        return bisect_left(self._order, (score, member))
+
+    def range(self, start, stop, reverse=False):
+        """
+        Return ``(member, score)`` tuples by position, like slicing
+        a list ordered by score with ``[start:stop]``. With
+        ``reverse``, positions count from the highest score.
+        """
+        if reverse:
+            size = len(self._order)
+            start, stop, _ = slice(start, stop).indices(size)
+            entries = reversed(self._order[size - stop : size - start])
+        else:
+            entries = self._order[start:stop]
+        return [(member, score) for score, member in entries]
+
+    def __contains__(self, member):
+        return member in self._scores
+
+    def __iter__(self):
+        return (member for _, member in self._order)
+
+    def __len__(self):
+        return len(self._order)
+
+
+class HashRing:
+    """
+    A consistent hash ring, mapping keys to nodes. Every node is
+    placed on the ring at ``vnodes`` pseudo-random points, and a key
+    belongs to the node at the first point following the hash of the
+    key. Adding or removing a node only moves the keys between that
+    node and its neighbours on the ring, about ``1/n`` of all keys.
+    Hashes are derived from MD5, so the mapping is stable between
+    processes (unlike the builtin ``hash()``).
+    """
+
+    def __init__(self, nodes=(), vnodes=128):
+        self.vnodes = vnodes
+        self._points = []
+        self._owners = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key):
+        if isinstance(key, str):
+            key = key.encode("utf-8")
+        return int.from_bytes(hashlib.md5(key).digest()[:8], "big")
+
+    def add(self, node):
+        for idx in range(self.vnodes):
+            point = self._hash("{}#{}".format(node, idx))
+            pos = bisect(self._points, point)
+            self._points.insert(pos, point)
+            self._owners.insert(pos, node)
+
+    def remove(self, node):
+        keep = [(p, n) for p, n in zip(self._points, self._owners) if n != node]
+        self._points = [point for point, _ in keep]
+        self._owners = [owner for _, owner in keep]
+
+    def get(self, key):
+        """Return the node that ``key`` belongs to"""
+        if not self._points:
+            raise LookupError("Hash ring has no nodes")
+        pos = bisect(self._points, self._hash(key)) % len(self._points)
+        return self._owners[pos]
+
+    @property
+    def nodes(self):
+        return set(self._owners)
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+def glob_prefix(pattern):
+    """
+    Return the literal prefix of a glob pattern, ie. everything up to
+    the first wildcard character. Every key matched by the pattern
+    starts with this prefix.
+    """
+
+    wildcards = "*?[" if isinstance(pattern, str) else b"*?["
+    for idx, char in enumerate(pattern):
+        if char in wildcards:
+            return pattern[:idx]
+
+    return pattern
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_left
+
+# Upper bounds of the histogram buckets, in seconds and bytes
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+SIZE_BUCKETS = tuple(4 ** exp for exp in range(3, 13))  # 64B up to 16MiB
+# Scheduled jobs can run late or take long, up to 10 minutes
+DURATION_BUCKETS = LATENCY_BUCKETS + (30, 60, 120, 300, 600)
+COUNT_BUCKETS = tuple(2 ** exp for exp in range(11))  # 1 up to 1024
+
+
+class Histogram:
+    """
+    Counts observed values in buckets with fixed upper bounds, so
+    percentiles can be estimated without keeping all values. A value
+    is counted in the first bucket whose bound is greater than or
+    equal to it, values above the highest bound in an overflow bucket.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percentile):
+        """Estimate a percentile (0-100) by interpolating within its bucket"""
+        if not self.count:
+            return 0
+        rank = self.count * percentile / 100
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[idx - 1] if idx > 0 else 0
+                upper = self.buckets[idx] if idx < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+class Counter:
+    """Counts events, eg. failures"""
+
+    def __init__(self):
+        self.count = 0
+
+    def inc(self, amount=1):
+        self.count += amount
+
+    def snapshot(self):
+        return {"count": self.count}
+
+
+class MetricsRegistry:
+    """
+    Keeps histograms and counters by name and labels, eg.
+    ``registry.histogram("storage_seconds", plugin="MyPlugin", operation="get")``
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+
+    def histogram(self, name, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram(buckets)
+        return histogram
+
+    def counter(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        counter = self._counters.get(key)
+        if counter is None:
+            counter = self._counters[key] = Counter()
+        return counter
+
+    def snapshot(self, prefix=""):
+        """
+        Return the statistics of all histograms and counters whose
+        name starts with ``prefix``, as a list of dictionaries that
+        also contain the name and labels of the metric.
+        """
+        metrics = sorted(
+            list(self._histograms.items()) + list(self._counters.items()),
+            key=lambda item: item[0],
+        )
+        return [
+            {"name": name, "labels": dict(labels), **metric.snapshot()}
+            for (name, labels), metric in metrics
+            if name.startswith(prefix)
+        ]
+
+    def clear(self):
+        self._histograms.clear()
+        self._counters.clear()
+
+
+registry = MetricsRegistry()
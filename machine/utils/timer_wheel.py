@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import math
+
+from loguru import logger
+
+
+class Timer:
+    """A callback that is scheduled on a :py:class:`TimerWheel`, returned by
+    :py:meth:`TimerWheel.call_later`"""
+
+    __slots__ = "deadline", "callback", "args", "cancelled", "_tick", "_bucket", "_wheel"
+
+    def __init__(self, wheel, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self._tick = 0
+        self._bucket = None
+        self._wheel = wheel
+
+    def cancel(self):
+        """Cancel the timer, unless it has already fired"""
+        if self._bucket is not None:
+            del self._bucket[self]
+            self._bucket = None
+            self._wheel._count -= 1
+        self.cancelled = True
+
+
+class TimerWheel:
+    """Runs callbacks after a delay, for large numbers of short-lived timers
+
+    Timers are kept in ``levels`` wheels of ``wheel_size`` slots. A slot of the first wheel holds
+    the timers that are due in one tick of ``tick`` seconds, a slot of the next wheel those that
+    are due in ``wheel_size`` ticks, and so on. Adding and cancelling a timer only touches one
+    slot, so both take constant time no matter how many timers are pending. When the first wheel
+    has turned around once, the timers of the next slot of the second wheel are spread over the
+    first wheel, and so on for the higher wheels.
+
+    Callbacks run up to one tick late. Coroutines returned by callbacks are run as tasks. Timers
+    only live in memory, so they are lost when the process stops.
+
+    :param tick: resolution of the timers, in seconds
+    :param wheel_size: number of slots per wheel
+    :param levels: number of wheels, timers can be up to ``tick * wheel_size ** levels`` seconds
+        ahead
+    """
+
+    def __init__(self, tick=0.1, wheel_size=64, levels=3, loop=None):
+        self.tick = tick
+        self.wheel_size = wheel_size
+        self.levels = levels
+        self._loop = loop
+        self._wheels = [[{} for _ in range(wheel_size)] for _ in range(levels)]
+        self._start = None
+        self._current = 0
+        self._count = 0
+        self._handle = None
+
+    @property
+    def horizon(self):
+        """Maximum delay of a timer, in seconds"""
+        return self.tick * self.wheel_size ** self.levels
+
+    def __len__(self):
+        return self._count
+
+    def call_later(self, delay, callback, *args):
+        """Call ``callback(*args)`` after ``delay`` seconds
+
+        :raises ValueError: if the delay is beyond the horizon of the wheel
+        :return: the :py:class:`Timer`, that can be cancelled
+        """
+        if delay >= self.horizon:
+            raise ValueError(f"Delay of {delay}s is beyond the horizon of {self.horizon}s")
+        loop = self._get_loop()
+        now = loop.time()
+        if self._start is None:
+            self._start = now
+        if not self._count:
+            # Nothing has to run while the wheel was idle, skip the ticks that have passed
+            self._current = max(self._current, int((now - self._start) / self.tick))
+
+        timer = Timer(self, now + max(delay, 0), callback, args)
+        timer._tick = max(math.ceil((timer.deadline - self._start) / self.tick), self._current + 1)
+        self._insert(timer)
+        self._count += 1
+        if self._handle is None:
+            self._schedule_tick(loop)
+        return timer
+
+    def cancel_all(self):
+        """Cancel all pending timers, and return how many there were"""
+        count = self._count
+        for wheel in self._wheels:
+            for bucket in wheel:
+                for timer in list(bucket):
+                    timer.cancel()
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        return count
+
+    def _get_loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    def _insert(self, timer):
+        ticks = timer._tick - self._current
+        span = self.wheel_size
+        for level in range(self.levels):
+            if ticks < span or level == self.levels - 1:
+                slot = (timer._tick // (span // self.wheel_size)) % self.wheel_size
+                bucket = self._wheels[level][slot]
+                bucket[timer] = None
+                timer._bucket = bucket
+                return
+            span *= self.wheel_size
+
+    def _schedule_tick(self, loop):
+        when = self._start + (self._current + 1) * self.tick
+        self._handle = loop.call_at(when, self._advance)
+
+    def _advance(self):
+        self._handle = None
+        loop = self._get_loop()
+        now = loop.time()
+        while self._count and self._start + (self._current + 1) * self.tick <= now:
+            self._current += 1
+            self._cascade()
+            self._fire(self._wheels[0][self._current % self.wheel_size])
+        if self._count:
+            self._schedule_tick(loop)
+
+    def _cascade(self):
+        # Every time a wheel has turned around, spread the next slot of the wheel above it
+        span = self.wheel_size
+        for level in range(1, self.levels):
+            if self._current % span:
+                return
+            bucket = self._wheels[level][(self._current // span) % self.wheel_size]
+            timers = list(bucket)
+            bucket.clear()
+            for timer in timers:
+                self._insert(timer)
+            span *= self.wheel_size
+
+    def _fire(self, bucket):
+        timers = list(bucket)
+        bucket.clear()
+        for timer in timers:
+            timer._bucket = None
+            self._count -= 1
+            try:
+                result = timer.callback(*timer.args)
+                if asyncio.iscoroutine(result):
+                    asyncio.ensure_future(result)
+            except Exception:
+                logger.exception("Timer callback failed")
+
+
+# Shared by the messaging client for messages that are scheduled only a short while ahead
+timer_wheel = TimerWheel()
@@ -102,7 +102,12 @@ setup(
         "Topic :: Office/Business",
     ],
     keywords="slack bot framework ai",
-    entry_points={"console_scripts": ["slack-machine = machine.bin.run:main"]},
+    entry_points={
+        "console_scripts": [
+            "slack-machine = machine.bin.run:main",
+            "slack-machine-migrate = machine.bin.migrate:main",
+        ]
+    },
     packages=find_packages(),
     include_package_data=True,
     zip_safe=False,
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from machine.plugins.base import MachineBasePlugin
-from machine.plugins.decorators import respond_to, listen_to, process
+from machine.plugins.decorators import respond_to, listen_to, process, schedule
 
 
 class FakePlugin(MachineBasePlugin):
@@ -18,3 +18,7 @@ class FakePlugin(MachineBasePlugin):
     @process("some_event")
     async def process_function(self, event):
         pass
+
+    @schedule(minute=0, jitter=30, misfire_grace_time=60)
+    async def scheduled_function(self):
+        pass
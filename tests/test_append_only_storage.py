@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+
+import pytest
+
+from machine.storage.backends.append_only import AppendOnlyFileStorage
+
+
+@pytest.fixture
+def settings(tmp_path):
+    return {"AOF_STORAGE_PATH": str(tmp_path), "AOF_COMPACTION_INTERVAL": 0}
+
+
+async def connected(settings):
+    storage = AppendOnlyFileStorage(settings)
+    await storage.connect()
+    return storage
+
+
+@pytest.mark.asyncio
+async def test_store_retrieve_delete(settings):
+    storage = await connected(settings)
+    await storage.set("key1", b"value1")
+    await storage.set(b"key2", "value2")
+    assert await storage.get("key1") == b"value1"
+    assert await storage.get("key2") == "value2"
+    await storage.set("key1", b"value3")
+    assert await storage.get("key1") == b"value3"
+    await storage.delete("key2")
+    assert not await storage.has("key2")
+    assert await storage.find_keys("key*") == ["key1"]
+
+
+@pytest.mark.asyncio
+async def test_delete_matching(settings):
+    storage = await connected(settings)
+    await storage.set_many({"ns:key1": b"1", "ns:key2": b"2", "ms:key1": b"3"})
+    assert await storage.delete_matching("ns:*") == 2
+    assert await storage.find_keys("*") == ["ms:key1"]
+    # The deletes are written to the log
+    storage = await connected(settings)
+    assert await storage.find_keys("*") == ["ms:key1"]
+
+
+@pytest.mark.asyncio
+async def test_scan(settings):
+    storage = await connected(settings)
+    await storage.set_many({f"ns:key{idx}": b"value" for idx in range(5)})
+    await storage.set("other:key", b"value")
+    await storage.acquire_lock("ns:lock", "owner", 10)
+
+    cursor, keys = await storage.scan("ns:*", count=3)
+    assert (cursor, keys) == ("ns:key2", ["ns:key0", "ns:key1", "ns:key2"])
+    await storage.delete("ns:key3")
+    assert await storage.scan(b"ns:*", cursor, count=3) == (None, ["ns:key4"])
+
+
+@pytest.mark.asyncio
+async def test_expire_values(settings, mocker):
+    mocked_time = mocker.patch("machine.storage.backends.append_only.time.time")
+    mocked_time.return_value = 1000.0
+    storage = await connected(settings)
+    await storage.set("key1", b"value1", expires=15)
+    assert await storage.get("key1") == b"value1"
+    mocked_time.return_value = 1020.0
+    assert await storage.get("key1") is None
+    assert await storage.find_keys("*") == []
+
+
+@pytest.mark.asyncio
+async def test_recover_after_restart(settings):
+    storage = await connected(settings)
+    await storage.set("ns:key1", b"value1")
+    await storage.set("ns:key2", b"value2")
+    await storage.delete("ns:key2")
+    assert await storage.incr("ns:counter", 3) == 3
+    storage._close()
+
+    storage = await connected(settings)
+    assert await storage.get("ns:key1") == b"value1"
+    assert not await storage.has("ns:key2")
+    assert await storage.incr("ns:counter") == 4
+
+
+@pytest.mark.asyncio
+async def test_truncated_record(settings):
+    storage = await connected(settings)
+    await storage.set("key1", b"value1")
+    await storage.set("key2", b"value2")
+    storage._close()
+    data_path = os.path.join(settings["AOF_STORAGE_PATH"], "data.log")
+    os.truncate(data_path, os.path.getsize(data_path) - 3)
+
+    storage = await connected(settings)
+    assert await storage.get("key1") == b"value1"
+    assert await storage.get("key2") is None
+    await storage.set("key2", b"value3")
+    assert await storage.get("key2") == b"value3"
+
+
+@pytest.mark.asyncio
+async def test_compaction(settings):
+    storage = await connected(settings)
+    for i in range(10):
+        await storage.set("key1", b"x" * 100)
+    await storage.set("key2", b"value2")
+    await storage.delete("key2")
+    assert storage._needs_compaction()
+    size_before = await storage.size()
+
+    await storage.compact()
+    assert await storage.size() < size_before
+    assert storage._dead_bytes == 0
+    assert await storage.get("key1") == b"x" * 100
+    await storage.set("key3", b"value3")
+    storage._close()
+
+    # The index is loaded from the hint file, and the record written after compaction is
+    # scanned from the log
+    storage = await connected(settings)
+    assert await storage.find_keys("key*") == ["key1", "key3"]
+    assert await storage.get("key3") == b"value3"
+
+
+@pytest.mark.asyncio
+async def test_ttl(settings, mocker):
+    mocked_time = mocker.patch("machine.storage.backends.append_only.time.time")
+    mocked_time.return_value = 1000.0
+    storage = await connected(settings)
+    await storage.set("key1", b"value1", expires=15)
+    await storage.set("key2", b"value2")
+    mocked_time.return_value = 1005.5
+    assert await storage.ttl("key1") == 10
+    assert await storage.ttl("key2") is None
+    assert await storage.ttl("key3") is None
+
+    assert await storage.touch("key2", 30)
+    assert not await storage.touch("key3", 30)
+    assert await storage.get_and_touch("key1", 60) == b"value1"
+    mocked_time.return_value = 1050.0
+    assert await storage.get("key1") == b"value1"
+    assert await storage.get("key2") is None
+    # The new expiration times are written to the log
+    storage = await connected(settings)
+    assert await storage.ttl("key1") == 16
+
+
+@pytest.mark.asyncio
+async def test_locks(settings):
+    storage = await connected(settings)
+    await storage.set("ns:key1", b"value1")
+    assert await storage.acquire_lock("ns:key1", "owner1", 10) == 1
+    assert await storage.acquire_lock("ns:key1", "owner2", 10) is None
+    assert await storage.release_lock("ns:key1", "owner1")
+    assert await storage.acquire_lock("ns:key1", "owner2", 10) == 2
+    # Fencing tokens are kept apart from the data
+    assert await storage.find_keys("*") == ["ns:key1"]
+    assert (await storage.namespace_usage("ns"))["keys"] == 1
+    assert await storage.delete_matching("*") == 1
+
+    # Fencing tokens keep increasing after a restart, and after compaction
+    await storage.compact()
+    storage = await connected(settings)
+    assert await storage.find_keys("*") == []
+    assert await storage.acquire_lock("ns:key1", "owner1", 10) == 3
+
+
+@pytest.mark.asyncio
+async def test_close(settings):
+    storage = AppendOnlyFileStorage({**settings, "AOF_COMPACTION_INTERVAL": 300})
+    await storage.connect()
+    await storage.set("key1", b"value1")
+    compactor, writer = storage._compactor, storage._writer
+    await storage.close()
+    await asyncio.sleep(0)
+    assert compactor.cancelled()
+    assert writer.closed
+    storage = await connected(settings)
+    assert await storage.get("key1") == b"value1"
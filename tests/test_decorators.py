@@ -155,6 +155,18 @@ def test_schedule(schedule_f):
     assert schedule_f.metadata["plugin_actions"]["schedule"]["minute"] == 30
 
 
+def test_schedule_job_options():
+    @schedule(minute=0, jitter=300, coalesce=False, misfire_grace_time=60, max_instances=2)
+    def f():
+        pass
+
+    config = f.metadata["plugin_actions"]["schedule"]
+    assert config["jitter"] == 300
+    assert config["coalesce"] is False
+    assert config["misfire_grace_time"] == 60
+    assert config["max_instances"] == 2
+
+
 def test_mulitple_decorators(multi_decorator_f):
     assert hasattr(multi_decorator_f, "metadata")
     assert "plugin_actions" in multi_decorator_f.metadata
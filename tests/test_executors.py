@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from machine import jobs
+from machine.executors.instrumented import InstrumentedAsyncIOExecutor
+from machine.utils.metrics import MetricsRegistry
+
+
+class SlowPlugin:
+    async def work(self, fail=False):
+        await asyncio.sleep(0.05)
+        if fail:
+            raise ValueError()
+
+
+@pytest.fixture
+def metrics():
+    return MetricsRegistry()
+
+
+@pytest.fixture
+def scheduler(metrics, event_loop):
+    jobs.register_plugin("tests.test_executors:SlowPlugin", SlowPlugin())
+    scheduler = AsyncIOScheduler(
+        event_loop=event_loop,
+        timezone="UTC",
+        executors={"default": InstrumentedAsyncIOExecutor(metrics)},
+    )
+    scheduler.start()
+    yield scheduler
+    scheduler.shutdown(wait=False)
+
+
+def stats(metrics, name, **labels):
+    for metric in metrics.snapshot(name):
+        if metric["name"] == name and metric["labels"] == labels:
+            return metric
+    return None
+
+
+@pytest.mark.asyncio
+async def test_job_runs_are_measured(scheduler, metrics):
+    label = "tests.test_executors:SlowPlugin.work"
+    now = datetime.now()
+    scheduler.add_job(
+        "machine.jobs:run_plugin_method",
+        trigger="date",
+        run_date=now - timedelta(seconds=0.5),
+        args=["tests.test_executors:SlowPlugin", "work"],
+        misfire_grace_time=10,
+    )
+    scheduler.add_job(
+        "machine.jobs:run_plugin_method",
+        trigger="date",
+        run_date=now,
+        args=["tests.test_executors:SlowPlugin", "work"],
+        kwargs={"fail": True},
+    )
+    await asyncio.sleep(0.2)
+
+    lateness = stats(metrics, "scheduler_lateness_seconds", job=label)
+    assert lateness["count"] == 2
+    assert lateness["max"] >= 0.5
+    duration = stats(metrics, "scheduler_run_seconds", job=label)
+    assert duration["count"] == 2
+    assert duration["max"] >= 0.05
+    assert stats(metrics, "scheduler_runs", job=label, outcome="success")["count"] == 1
+    assert stats(metrics, "scheduler_runs", job=label, outcome="error")["count"] == 1
+    assert stats(metrics, "scheduler_running_jobs")["max"] == 2
+
+
+@pytest.mark.asyncio
+async def test_skipped_runs_are_counted(scheduler, metrics):
+    label = "machine.jobs:send_dm"
+    scheduler.add_job(
+        "machine.jobs:send_dm",
+        trigger="date",
+        run_date=datetime.now() - timedelta(seconds=10),
+        args=["U123", "hello"],
+        misfire_grace_time=1,
+    )
+    await asyncio.sleep(0.05)
+    assert stats(metrics, "scheduler_runs", job=label, outcome="missed")["count"] == 1
+    assert stats(metrics, "scheduler_run_seconds", job=label) is None
+
+    scheduler.add_job(
+        "machine.jobs:run_plugin_method",
+        trigger="interval",
+        seconds=0.02,
+        args=["tests.test_executors:SlowPlugin", "work"],
+        max_instances=1,
+    )
+    await asyncio.sleep(0.1)
+    label = "tests.test_executors:SlowPlugin.work"
+    assert stats(metrics, "scheduler_runs", job=label, outcome="max_instances")["count"] >= 1
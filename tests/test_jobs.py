@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+import pytest
+
+from machine import jobs
+from machine.slack import MessagingClient
+
+
+class ScheduledPlugin:
+    def __init__(self):
+        self.calls = []
+
+    async def async_job(self, value):
+        self.calls.append(("async", value))
+        return value
+
+    def sync_job(self, value):
+        self.calls.append(("sync", value))
+        return value
+
+
+@pytest.fixture
+def plugin():
+    plugin = ScheduledPlugin()
+    jobs.register_plugin("tests.test_jobs:ScheduledPlugin", plugin)
+    return plugin
+
+
+@pytest.mark.asyncio
+async def test_run_plugin_method(plugin):
+    name = "tests.test_jobs:ScheduledPlugin"
+    assert await jobs.run_plugin_method(name, "async_job", 1) == 1
+    assert await jobs.run_plugin_method(name, "sync_job", value=2) == 2
+    assert plugin.calls == [("async", 1), ("sync", 2)]
+    assert await jobs.run_plugin_method(name, "removed_job") is None
+    assert await jobs.run_plugin_method("tests.test_jobs:Removed", "async_job", 1) is None
+
+
+def test_get_plugin(plugin):
+    assert jobs.get_plugin("tests.test_jobs:ScheduledPlugin") is plugin
+    with pytest.raises(LookupError):
+        jobs.get_plugin("tests.test_jobs:Removed")
+
+
+def test_scheduled_messages_are_stored_by_reference(mocker):
+    add_job = mocker.patch("machine.slack.Scheduler.get_instance").return_value.add_job
+    when = datetime(2030, 1, 1)
+    MessagingClient().send_dm_scheduled(when, "U123", "hello", attachments=None)
+    args, kwargs = add_job.call_args
+    assert args == ("machine.jobs:send_dm",)
+    assert kwargs["args"] == ["U123", "hello"]
+    assert kwargs["kwargs"] == {"attachments": None}
+
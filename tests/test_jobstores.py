@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from machine.jobstores.redis import AsyncRedisJobStore
+from machine.jobstores.sqlite import SQLiteJobStore
+
+
+class FakeTransaction:
+    def __init__(self, redis):
+        self._redis = redis
+        self._commands = []
+
+    def __getattr__(self, item):
+        return lambda *args: self._commands.append((item, args))
+
+    async def execute(self):
+        for command, args in self._commands:
+            getattr(self._redis, command)(*args)
+
+
+class FakeRedis:
+    """Just enough of the aioredis client for the jobstore"""
+
+    def __init__(self):
+        self.hashes = {}
+        self.sorted_sets = {}
+
+    def multi_exec(self):
+        return FakeTransaction(self)
+
+    async def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[field.encode("utf-8")] = value
+
+    def hdel(self, key, field):
+        self.hashes.get(key, {}).pop(field.encode("utf-8"), None)
+
+    def zadd(self, key, score, member):
+        self.sorted_sets.setdefault(key, {})[member] = score
+
+    def zrem(self, key, member):
+        self.sorted_sets.get(key, {}).pop(member, None)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.hashes.pop(key, None)
+            self.sorted_sets.pop(key, None)
+
+
+class FakeStorage:
+    def __init__(self):
+        self.redis = FakeRedis()
+        self.available = True
+
+    async def run_command(self, command):
+        if not self.available:
+            raise ConnectionError()
+        return await command(self.redis)
+
+
+@pytest.fixture
+def storage():
+    return FakeStorage()
+
+
+@pytest.fixture
+def scheduler(storage, event_loop):
+    scheduler = AsyncIOScheduler(event_loop=event_loop, timezone="UTC")
+    scheduler.add_jobstore(AsyncRedisJobStore(storage, refresh_interval=0))
+    return scheduler
+
+
+def add_job(scheduler, job_id):
+    return scheduler.add_job(
+        "machine.jobs:send_dm",
+        trigger="date",
+        run_date=datetime.now() + timedelta(days=1),
+        args=["U123", job_id],
+        id=job_id,
+    )
+
+
+@pytest.mark.asyncio
+async def test_changes_are_written_to_redis(scheduler, storage):
+    scheduler.start(paused=True)
+    store = scheduler._lookup_jobstore("default")
+    add_job(scheduler, "job1")
+    add_job(scheduler, "job2")
+    await store.flush()
+    assert set(storage.redis.hashes["apscheduler.jobs"]) == {b"job1", b"job2"}
+    assert set(storage.redis.sorted_sets["apscheduler.run_times"]) == {"job1", "job2"}
+
+    # Reads are served from memory while the changes are being written
+    scheduler.remove_job("job1")
+    assert [job.id for job in scheduler.get_jobs()] == ["job2"]
+    await store.flush()
+    assert set(storage.redis.hashes["apscheduler.jobs"]) == {b"job2"}
+    assert set(storage.redis.sorted_sets["apscheduler.run_times"]) == {"job2"}
+
+    scheduler.remove_all_jobs()
+    await store.flush()
+    assert storage.redis.hashes == {}
+    scheduler.shutdown(wait=False)
+
+
+@pytest.mark.asyncio
+async def test_failed_writes_are_kept(scheduler, storage):
+    scheduler.start(paused=True)
+    store = scheduler._lookup_jobstore("default")
+    storage.available = False
+    add_job(scheduler, "job1")
+    with pytest.raises(ConnectionError):
+        await store.flush()
+    storage.available = True
+    await store.flush()
+    assert set(storage.redis.hashes["apscheduler.jobs"]) == {b"job1"}
+    scheduler.shutdown(wait=False)
+
+
+@pytest.mark.asyncio
+async def test_refresh_loads_jobs_from_other_processes(scheduler, storage, event_loop):
+    other = AsyncIOScheduler(event_loop=event_loop, timezone="UTC")
+    other.add_jobstore(AsyncRedisJobStore(storage, refresh_interval=0))
+    other.start(paused=True)
+    add_job(other, "remote")
+    await other._lookup_jobstore("default").flush()
+    other.shutdown(wait=False)
+
+    scheduler.start(paused=True)
+    store = scheduler._lookup_jobstore("default")
+    # A local change that has not been written yet is kept
+    add_job(scheduler, "local")
+    assert len(store._pending) == 1
+    await store.refresh()
+    assert sorted(job.id for job in scheduler.get_jobs()) == ["local", "remote"]
+    assert scheduler.get_job("remote").args == ("U123", "remote")
+    scheduler.shutdown(wait=False)
+
+
+@pytest.mark.asyncio
+async def test_jobs_that_cannot_be_restored_are_removed(scheduler, storage):
+    storage.redis.hashes["apscheduler.jobs"] = {b"broken": b"not a pickle"}
+    scheduler.start(paused=True)
+    store = scheduler._lookup_jobstore("default")
+    await store.refresh()
+    assert scheduler.get_jobs() == []
+    await store.flush()
+    assert storage.redis.hashes["apscheduler.jobs"] == {}
+    scheduler.shutdown(wait=False)
+
+
+@pytest.mark.asyncio
+async def test_sqlite_jobs_survive_restarts(tmp_path, event_loop):
+    path = str(tmp_path / "jobs.db")
+    scheduler = AsyncIOScheduler(event_loop=event_loop, timezone="UTC")
+    scheduler.add_jobstore(SQLiteJobStore(path))
+    scheduler.start(paused=True)
+    store = scheduler._lookup_jobstore("default")
+    job = add_job(scheduler, "job1")
+    add_job(scheduler, "job2")
+    scheduler.remove_job("job2")
+    await store.flush()
+    scheduler.shutdown(wait=False)
+
+    with sqlite3.connect(path) as conn:
+        rows = conn.execute("SELECT id, next_run_time FROM apscheduler_jobs").fetchall()
+        plan = conn.execute(
+            "EXPLAIN QUERY PLAN SELECT id FROM apscheduler_jobs WHERE next_run_time <= 0"
+        ).fetchall()
+    assert rows == [("job1", job.next_run_time.timestamp())]
+    assert "ix_apscheduler_jobs_next_run_time" in str(plan)
+
+    restarted = AsyncIOScheduler(event_loop=event_loop, timezone="UTC")
+    restarted.add_jobstore(SQLiteJobStore(path))
+    restarted.start(paused=True)
+    await restarted._lookup_jobstore("default").refresh()
+    assert [job.id for job in restarted.get_jobs()] == ["job1"]
+    assert restarted.get_job("job1").args == ("U123", "job1")
+    restarted.shutdown(wait=False)
+
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+from machine.leader import LeaderElection
+from machine.storage.backends.memory import MemoryStorage
+
+
+@pytest.fixture
+def storage_backend(mocker):
+    storage = MemoryStorage({})
+    backend_get_instance = mocker.patch("machine.leader.Storage.get_instance")
+    backend_get_instance.return_value = storage
+    return storage
+
+
+def election(events, name, ttl=0.06):
+    return LeaderElection(
+        "scheduler-leader",
+        ttl=ttl,
+        on_elected=lambda: events.append(f"{name} elected"),
+        on_demoted=lambda: events.append(f"{name} demoted"),
+    )
+
+
+@pytest.mark.asyncio
+async def test_single_leader_and_failover(storage_backend):
+    events = []
+    first, second = election(events, "first"), election(events, "second")
+    await first.start()
+    await second.start()
+    assert first.is_leader and not second.is_leader
+
+    # The leader keeps its lease for as long as it's alive
+    await asyncio.sleep(0.15)
+    assert first.is_leader and not second.is_leader
+
+    first_term = first.token
+    await first.stop()
+    await asyncio.sleep(0.05)
+    assert second.is_leader
+    assert second.token > first_term
+    assert events == ["first elected", "first demoted", "second elected"]
+    await second.stop()
+
+
+@pytest.mark.asyncio
+async def test_leader_that_loses_its_lease_steps_down(storage_backend):
+    events = []
+    leader = election(events, "leader", ttl=10)
+    await leader.start()
+    # Somebody else took over the lease
+    storage_backend._locks["scheduler-leader"] = ("other", float("inf"))
+    await leader.campaign()
+    assert not leader.is_leader
+    assert events == ["leader elected", "leader demoted"]
+    await leader.stop()
+
+
+@pytest.mark.asyncio
+async def test_leader_steps_down_before_lease_expires(storage_backend, mocker):
+    events = []
+    leader = election(events, "leader", ttl=10)
+    await leader.start()
+    mocker.patch.object(storage_backend, "extend_lock", side_effect=ConnectionError())
+    # The lease is still valid long enough to retry
+    await leader.campaign()
+    assert leader.is_leader
+    mocked_time = mocker.patch("machine.leader.time.monotonic")
+    mocked_time.return_value = leader._lease_expires - 1
+    await leader.campaign()
+    assert not leader.is_leader
+    await leader.stop()
@@ -32,6 +32,21 @@ async def test_delete_values(memory_storage):
     assert memory_storage._storage == {"key1": ("value1", None)}
 
 
+@pytest.mark.asyncio
+async def test_delete_matching(memory_storage, mocker):
+    mocked_dt = mocker.patch("machine.storage.backends.memory.datetime", autospec=True)
+    mocked_dt.utcnow.return_value = datetime(2017, 1, 1, 12, 0, 0, 0)
+    await memory_storage.set("ns:key1", "value1")
+    await memory_storage.set("ns:key2", "value2", expires=15)
+    await memory_storage.set("ns:other", "value3")
+    await memory_storage.set("ms:key1", "value4")
+    mocked_dt.utcnow.return_value = datetime(2017, 1, 1, 12, 0, 20, 0)
+    # Expired keys are removed, but not counted
+    assert await memory_storage.delete_matching("ns:key*") == 1
+    assert list(memory_storage._storage) == ["ns:other", "ms:key1"]
+    assert list(memory_storage._index) == ["ms:key1", "ns:other"]
+
+
 @pytest.mark.asyncio
 async def test_expire_values(memory_storage, mocker):
     assert memory_storage._storage == {}
@@ -53,3 +68,134 @@ async def test_inclusion(memory_storage):
     assert (await memory_storage.has("key1")) == True
     await memory_storage.delete("key1")
     assert (await memory_storage.has("key1")) == False
+
+
+@pytest.mark.asyncio
+async def test_find_keys(memory_storage):
+    await memory_storage.set("Plugin:ns:key1", "1")
+    await memory_storage.set("Plugin:ns:key2", "2")
+    await memory_storage.set("Plugin:ms:key3", "3")
+    await memory_storage.set("Other:ns:key4", "4")
+    assert list(await memory_storage.find_keys("Plugin:ns:*")) == [
+        "Plugin:ns:key1",
+        "Plugin:ns:key2",
+    ]
+    assert list(await memory_storage.find_keys("*:ns:*")) == [
+        "Other:ns:key4",
+        "Plugin:ns:key1",
+        "Plugin:ns:key2",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_find_keys_after_removal(memory_storage, mocker):
+    mocked_dt = mocker.patch("machine.storage.backends.memory.datetime", autospec=True)
+    mocked_dt.utcnow.return_value = datetime(2017, 1, 1, 12, 0, 0, 0)
+    await memory_storage.set("ns:key1", "1")
+    await memory_storage.set("ns:key2", "2", expires=15)
+    await memory_storage.delete("ns:key1")
+    mocked_dt.utcnow.return_value = datetime(2017, 1, 1, 12, 0, 20, 0)
+    assert (await memory_storage.get("ns:key2")) is None
+    assert list(await memory_storage.find_keys("ns:*")) == []
+
+
+@pytest.mark.asyncio
+async def test_namespace_usage(memory_storage):
+    await memory_storage.set("Plugin:key1", b"12345")
+    await memory_storage.set("Plugin:key2", b"123")
+    await memory_storage.set("Other:key3", b"1234567")
+    assert await memory_storage.namespace_usage("Plugin") == {
+        "keys": 2,
+        "bytes": len("Plugin:key1") + 5 + len("Plugin:key2") + 3,
+    }
+
+
+@pytest.mark.asyncio
+async def test_namespace_usage_of_collections(memory_storage):
+    await memory_storage.list_push("Plugin:list", [b"x" * 100] * 10)
+    await memory_storage.set_add("Plugin:set", [b"abc", b"de"])
+    await memory_storage.hash_set("Plugin:hash", "field", b"1234")
+    await memory_storage.sorted_set_add("Plugin:zset", {b"member": 1.5})
+    assert await memory_storage.namespace_usage("Plugin") == {
+        "keys": 4,
+        "bytes": len("Plugin:list") + 1000
+        + len("Plugin:set") + 5
+        + len("Plugin:hash") + len("field") + 4
+        + len("Plugin:zset") + len("member") + 8,
+    }
+
+
+@pytest.mark.asyncio
+async def test_incr(memory_storage, mocker):
+    mocked_dt = mocker.patch("machine.storage.backends.memory.datetime", autospec=True)
+    mocked_dt.utcnow.return_value = datetime(2017, 1, 1, 12, 0, 0, 0)
+    assert await memory_storage.incr("counter", expires=15) == 1
+    mocked_dt.utcnow.return_value = datetime(2017, 1, 1, 12, 0, 10, 0)
+    assert await memory_storage.incr("counter", 5, expires=15) == 6
+    assert await memory_storage.get("counter") == b"6"
+    # The expiration is not extended by subsequent increments
+    mocked_dt.utcnow.return_value = datetime(2017, 1, 1, 12, 0, 20, 0)
+    assert await memory_storage.incr("counter", -1) == -1
+
+
+@pytest.mark.asyncio
+async def test_set_if_absent(memory_storage):
+    assert await memory_storage.set_if_absent("key1", b"value1")
+    assert not await memory_storage.set_if_absent("key1", b"value2")
+    assert await memory_storage.get("key1") == b"value1"
+
+
+@pytest.mark.asyncio
+async def test_compare_and_set(memory_storage):
+    assert await memory_storage.compare_and_set("key1", None, b"value1")
+    assert not await memory_storage.compare_and_set("key1", None, b"value2")
+    assert not await memory_storage.compare_and_set("key1", b"other", b"value2")
+    assert await memory_storage.compare_and_set("key1", b"value1", b"value2")
+    assert await memory_storage.get("key1") == b"value2"
+
+
+@pytest.mark.asyncio
+async def test_ttl(memory_storage, mocker):
+    mocked_dt = mocker.patch("machine.storage.backends.memory.datetime", autospec=True)
+    mocked_dt.utcnow.return_value = datetime(2017, 1, 1, 12, 0, 0, 0)
+    await memory_storage.set("key1", "value1", expires=15)
+    await memory_storage.set("key2", "value2")
+    mocked_dt.utcnow.return_value = datetime(2017, 1, 1, 12, 0, 5, 500)
+    assert await memory_storage.ttl("key1") == 10
+    assert await memory_storage.ttl("key2") is None
+    assert await memory_storage.ttl("key3") is None
+
+    assert await memory_storage.touch("key1", 30)
+    assert await memory_storage.touch("key2", 30)
+    assert not await memory_storage.touch("key3", 30)
+    assert await memory_storage.ttl("key2") == 30
+    mocked_dt.utcnow.return_value = datetime(2017, 1, 1, 12, 0, 30, 0)
+    assert await memory_storage.get_and_touch("key1", 10) == "value1"
+    assert await memory_storage.ttl("key1") == 10
+    assert await memory_storage.get_and_touch("key3", 10) is None
+
+
+@pytest.mark.asyncio
+async def test_scan(memory_storage):
+    for idx in range(5):
+        await memory_storage.set(f"ns:key{idx}", "value")
+    await memory_storage.set("other:key", "value")
+
+    cursor, keys = await memory_storage.scan("ns:*", count=3)
+    assert keys == ["ns:key0", "ns:key1", "ns:key2"]
+    cursor, keys = await memory_storage.scan("ns:*", cursor, count=3)
+    assert (cursor, keys) == (None, ["ns:key3", "ns:key4"])
+
+
+@pytest.mark.asyncio
+async def test_scan_mixed_key_types(memory_storage):
+    await memory_storage.set("ns:key1", "value")
+    await memory_storage.set(b"ns:key2", "value")
+    await memory_storage.set(b"ns:key3", "value", expires=-1)
+    await memory_storage.set(b"ns:key4", "value")
+
+    cursor, keys = await memory_storage.scan(b"ns:*", count=1)
+    # The cursor can be serialized as JSON
+    assert (cursor, keys) == ("ns:key2", [b"ns:key2"])
+    assert await memory_storage.scan(b"ns:*", cursor) == (None, [b"ns:key4"])
+    assert await memory_storage.scan("ns:*") == (None, ["ns:key1"])
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import json
+from unittest import mock
+
+import pytest
+
+from machine.bin.migrate import _build_backend, _parse_setting, main
+from machine.storage.backends.memory import MemoryStorage
+from machine.storage.backends.sqlite import SQLiteStorage
+from machine.storage.migration import migrate
+
+
+@pytest.fixture
+async def source(tmp_path):
+    storage = SQLiteStorage(
+        {"SQLITE_PATH": str(tmp_path / "source.db"), "SQLITE_PURGE_INTERVAL": 0}
+    )
+    await storage.connect()
+    await storage.set_many({f"ns:key{idx}": b"value" for idx in range(25)})
+    await storage.set("ns:expiring", b"value", expires=60)
+    await storage.set("other:key", b"value")
+    return storage
+
+
+@pytest.mark.asyncio
+async def test_migrate(source):
+    target = MemoryStorage({})
+    result = await migrate(source, target, patterns=["ns:*"], batch_size=10)
+
+    assert result["migrated"] == 26
+    assert result["bytes"] == 26 * len(b"value")
+    assert len(target._storage) == 26
+    assert await target.get("ns:key3") == b"value"
+    assert 0 < await target.ttl("ns:expiring") <= 60
+    assert await target.ttl("ns:key3") is None
+    assert not await target.has("other:key")
+
+
+@pytest.mark.asyncio
+async def test_migrate_collections(tmp_path):
+    source = MemoryStorage({})
+    await source.set("ns:key1", b"value")
+    await source.list_push("ns:queue", [b"1", b"2"])
+    await source.hash_set("ns:hash", "field", b"value")
+    target = MemoryStorage({})
+
+    result = await migrate(source, target)
+    assert (result["migrated"], result["skipped"]) == (3, 0)
+    assert await target.list_range("ns:queue") == [b"1", b"2"]
+    assert await target.hash_get_all("ns:hash") == {"field": b"value"}
+
+    # Collections can't be copied to another type of backend
+    target = SQLiteStorage({"SQLITE_PATH": str(tmp_path / "target.db"), "SQLITE_PURGE_INTERVAL": 0})
+    await target.connect()
+    result = await migrate(source, target)
+    assert (result["migrated"], result["skipped"]) == (1, 2)
+    await target.close()
+
+
+def test_main_fails_when_keys_are_skipped(mocker):
+    mocker.patch("machine.bin.migrate.import_settings", return_value=({}, None))
+    mocker.patch("machine.bin.migrate._build_backend")
+    mocker.patch(
+        "machine.bin.migrate._migrate", return_value={"migrated": 1, "skipped": 2}
+    )
+    with pytest.raises(SystemExit) as exc_info:
+        main(["source.Backend", "target.Backend"])
+    assert exc_info.value.code == 1
+
+
+@pytest.mark.asyncio
+async def test_resume_from_checkpoint(source, tmp_path):
+    checkpoint = str(tmp_path / "checkpoint.json")
+    target = MemoryStorage({})
+    set_many = target.set_many
+    target.set_many = mock.AsyncMock(side_effect=[None, None, ConnectionError()])
+
+    with pytest.raises(ConnectionError):
+        await migrate(source, target, batch_size=10, checkpoint=checkpoint)
+    with open(checkpoint) as f:
+        state = json.load(f)
+    assert state["migrated"] == 10
+    assert state["cursor"] is not None
+
+    target.set_many = mock.AsyncMock(wraps=set_many)
+    result = await migrate(source, target, batch_size=10, checkpoint=checkpoint)
+    assert result["migrated"] == 27
+    # The first batch was not copied again
+    copied = sum(len(call.args[0]) for call in target.set_many.await_args_list)
+    assert copied == 17
+    assert not (tmp_path / "checkpoint.json").exists()
+
+
+def test_build_backend():
+    assert _parse_setting("SQLITE_PURGE_INTERVAL=0") == ("SQLITE_PURGE_INTERVAL", 0)
+    assert _parse_setting("REDIS_URL=redis://host:6379") == (
+        "REDIS_URL",
+        "redis://host:6379",
+    )
+    backend = _build_backend(
+        "machine.storage.backends.sqlite.SQLiteStorage",
+        {"SQLITE_PATH": "default.db"},
+        ["SQLITE_PATH=other.db"],
+    )
+    assert isinstance(backend, SQLiteStorage)
+    assert backend._path == "other.db"
@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import json
 import re
+import time
+
 import pytest
 
-from machine import Machine
-from machine.plugins.decorators import required_settings
+from machine import Machine, jobs
+from machine.plugins.base import MachineBasePlugin
+from machine.plugins.decorators import required_settings, schedule
+from machine.singletons import Scheduler
 from machine.utils.collections import CaseInsensitiveDict
+from machine.utils.metrics import registry
 
 
 @pytest.fixture(scope="module")
@@ -96,8 +103,151 @@ def test_plugin_init(settings):
     assert plugin_cls.x == 42
 
 
+def test_plugins_are_available_to_jobs(settings):
+    machine = Machine(settings=settings)
+    actions = machine._plugin_actions
+    plugin_cls = actions["respond_to"][
+        "tests.fake_plugins:FakePlugin.respond_function-hello"
+    ]["class"]
+    assert jobs.get_plugin("tests.fake_plugins:FakePlugin") is plugin_cls
+
+
+def test_register_scheduled_functions(settings):
+    Machine(settings=settings)
+    job = Scheduler.get_instance().get_job("tests.fake_plugins:FakePlugin.scheduled_function")
+    assert job.func_ref == "machine.jobs:run_plugin_method"
+    assert job.args == ("tests.fake_plugins:FakePlugin", "scheduled_function")
+    assert job.trigger.jitter == 30
+    assert job.misfire_grace_time == 60
+
+
+def test_schedule_options(settings, mocker):
+    add_job = mocker.patch("machine.core.Scheduler.get_instance").return_value.add_job
+    machine = Machine(settings=settings)
+
+    @schedule(minute=0, misfire_grace_time=60)
+    def hourly():
+        pass
+
+    machine._register_plugin_actions(
+        "tests.fake_plugins:FakePlugin", hourly.metadata, None, "hourly", hourly, "help"
+    )
+    kwargs = add_job.call_args[1]
+    assert kwargs["minute"] == 0
+    assert kwargs["misfire_grace_time"] == 60
+    assert kwargs["jitter"] is None
+    assert "coalesce" not in kwargs and "max_instances" not in kwargs
+
+    # Jobs without their own jitter are spread by the global setting
+    machine._settings = dict(settings, SCHEDULER_CRON_JITTER=120)
+    machine._register_plugin_actions(
+        "tests.fake_plugins:FakePlugin", hourly.metadata, None, "hourly", hourly, "help"
+    )
+    assert add_job.call_args[1]["jitter"] == 120
+
+
 def test_required_settings(settings_with_required, required_settings_class):
     machine = Machine(settings=settings_with_required)
     missing = machine._check_missing_settings(required_settings_class)
     assert "SETTING_1" not in missing
     assert "SETTING_2" in missing
+
+
+class SlowPlugin(MachineBasePlugin):
+    def __init__(self, settings, client, storage, delay):
+        super().__init__(settings, client, storage)
+        self.delay = delay
+        self.ready = False
+        self.warm = False
+
+    async def init(self, http_app):
+        await asyncio.sleep(self.delay)
+        self.ready = True
+
+    async def warm_up(self):
+        await asyncio.sleep(0.01)
+        self.warm = True
+
+
+class SyncPlugin(MachineBasePlugin):
+    def init(self, http_app):
+        # Synchronous init functions can still run the loop themselves
+        asyncio.get_event_loop().run_until_complete(asyncio.sleep(0))
+        self.ready = True
+
+
+def test_plugins_are_initialized_concurrently(settings):
+    machine = Machine(settings=settings)
+    machine._settings = dict(
+        settings, PLUGIN_INIT_TIMEOUT=1, PLUGIN_INIT_TIMEOUTS={"tests:Stuck": 0.05}
+    )
+    plugins = [
+        ("tests:Slow1", SlowPlugin(settings, None, None, 0.1)),
+        ("tests:Slow2", SlowPlugin(settings, None, None, 0.1)),
+        ("tests:Stuck", SlowPlugin(settings, None, None, 10)),
+        ("tests:Sync", SyncPlugin(settings, None, None)),
+    ]
+    start = time.monotonic()
+    machine._init_plugins(plugins)
+    assert time.monotonic() - start < 0.19
+    assert [instance.ready for _, instance in plugins] == [True, True, False, True]
+
+
+def test_plugins_warm_up_in_the_background(settings, event_loop):
+    machine = Machine(settings=settings, loop=event_loop)
+    plugin = SlowPlugin(settings, None, None, 0)
+    machine._plugins = [("tests:Slow", plugin)] + machine._plugins
+    machine._start_warm_ups()
+    # Plugins that don't warm up get no task
+    assert len(machine._warm_ups) == 1
+    assert not plugin.warm
+    event_loop.run_until_complete(asyncio.wait(machine._warm_ups))
+    assert plugin.warm
+
+
+
+def test_close_continues_after_failures(settings, mocker, event_loop):
+    machine = Machine(settings=settings, loop=event_loop)
+    mocker.patch.object(machine._scheduler, "close", side_effect=ConnectionError())
+    cancel_all = mocker.patch("machine.core.timer_wheel.cancel_all", return_value=0)
+    storage_close = mocker.patch.object(machine._storage, "close")
+    event_loop.run_until_complete(machine.close())
+    assert cancel_all.called
+    # Buffered storage writes are flushed even though the scheduler could not be closed
+    assert storage_close.called
+
+
+def test_jobs_are_refreshed_before_the_leader_runs_them(settings, mocker, event_loop):
+    machine = Machine(settings=settings, loop=event_loop)
+    machine._leader_election = mocker.Mock(is_leader=True)
+    calls = []
+    mocker.patch.object(machine._scheduler, "refresh", side_effect=lambda: calls.append("refresh"))
+    mocker.patch.object(machine._scheduler, "resume", side_effect=lambda: calls.append("resume"))
+    event_loop.run_until_complete(machine._refresh_and_resume_scheduler())
+    assert calls == ["refresh", "resume"]
+
+    # The scheduler stays paused when leadership was lost while the jobs were loaded
+    calls.clear()
+    machine._leader_election.is_leader = False
+    event_loop.run_until_complete(machine._refresh_and_resume_scheduler())
+    assert calls == ["refresh"]
+
+
+def test_storage_metrics(settings, mocker, event_loop):
+    machine = Machine(settings=settings, loop=event_loop)
+    mocker.patch.object(machine._storage, "stats", return_value={"pool": {"utilisation": 0.5}})
+    registry.histogram("storage_seconds", plugin="Plugin", operation="get").observe(0.1)
+    response = event_loop.run_until_complete(machine._storage_metrics(None))
+    metrics = json.loads(response.text)
+    assert metrics["backend"] == {"pool": {"utilisation": 0.5}}
+    labels = {"operation": "get", "plugin": "Plugin"}
+    assert any(
+        metric["name"] == "storage_seconds" and metric["labels"] == labels
+        for metric in metrics["operations"]
+    )
+
+
+def test_leader_election_needs_a_shared_jobstore(settings):
+    settings = CaseInsensitiveDict({**settings, "SCHEDULER_LEADER_ELECTION": True})
+    with pytest.raises(SystemExit):
+        Machine(settings=settings)
@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
+import asyncio
+
+import dill
 import pytest
 
-from machine.storage import PluginStorage
+from machine.storage import CollectionsNotSupported, PluginStorage, StorageQuotaExceeded
 from machine.storage.backends.memory import MemoryStorage
+from machine.storage.backends.sqlite import SQLiteStorage
+from machine.storage.locks import LockTimeout
+from machine.utils.metrics import registry
 
 
 @pytest.fixture
@@ -40,6 +46,18 @@ async def test_retrieve(plugin_storage):
     assert retrieved == "value1"
 
 
+@pytest.mark.asyncio
+async def test_sliding_expiration(plugin_storage):
+    await plugin_storage.set("session", {"user": "U1"}, expires=60)
+    assert 0 < await plugin_storage.ttl("session") <= 60
+    assert await plugin_storage.get("session", refresh_ttl=600) == {"user": "U1"}
+    assert 540 < await plugin_storage.ttl("session") <= 600
+    assert await plugin_storage.touch("session", 3600)
+    assert 3540 < await plugin_storage.ttl("session") <= 3600
+    assert not await plugin_storage.touch("other", 3600)
+    assert await plugin_storage.get("other", refresh_ttl=600) is None
+
+
 @pytest.mark.asyncio
 async def test_shared(plugin_storage, storage_backend):
     await plugin_storage.set("key1", "value1", shared=True)
@@ -60,6 +78,22 @@ async def test_delete(plugin_storage, storage_backend):
     assert expected_key not in storage_backend._storage
 
 
+@pytest.mark.asyncio
+async def test_clear(plugin_storage, storage_backend):
+    await plugin_storage.set("cache:key1", "1")
+    await plugin_storage.set("cache:key2", "2")
+    await plugin_storage.set("config", "3")
+    await plugin_storage.set("cache:key3", "4", shared=True)
+    assert await plugin_storage.clear("cache:*") == 2
+    assert await plugin_storage.has("config")
+    assert await plugin_storage.has("cache:key3", shared=True)
+    assert await plugin_storage.clear() == 1
+    assert list(storage_backend._storage) == ["cache:key3"]
+    with pytest.raises(ValueError):
+        await plugin_storage.clear(shared=True)
+    assert await plugin_storage.clear("cache:*", shared=True) == 1
+
+
 @pytest.mark.asyncio
 async def test_find_keys(plugin_storage, storage_backend):
     await plugin_storage.set("ns:key1", "1")
@@ -78,3 +112,254 @@ async def test_get__raw_keys(plugin_storage, storage_backend):
     await plugin_storage.set("ms:key3", "3")
     for key in await plugin_storage.find_keys("ns:*"):
         assert plugin_storage.has(key)
+
+
+@pytest.mark.asyncio
+async def test_iter_keys(plugin_storage, storage_backend):
+    await plugin_storage.set("ns:key1", "1")
+    await plugin_storage.set("ns:key2", "2")
+    await plugin_storage.set("ms:key3", "3")
+    keys = [key async for key in plugin_storage.iter_keys("ns:*", count=1)]
+    assert keys == [
+        "tests.fake_plugin.FakePlugin:ns:key1",
+        "tests.fake_plugin.FakePlugin:ns:key2",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_iter_items(plugin_storage, storage_backend):
+    await plugin_storage.set("ns:key1", {"a": 1})
+    await plugin_storage.set("ns:key2", [2])
+    await plugin_storage.set("ms:key3", "3")
+    items = [item async for item in plugin_storage.iter_items("ns:*")]
+    assert items == [
+        ("tests.fake_plugin.FakePlugin:ns:key1", {"a": 1}),
+        ("tests.fake_plugin.FakePlugin:ns:key2", [2]),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_iter_items_with_counters(plugin_storage, storage_backend):
+    await plugin_storage.set("ns:key1", {"a": 1})
+    await plugin_storage.incr("ns:key2", 5)
+    await plugin_storage.decr("ns:key3", 2)
+    items = [item async for item in plugin_storage.iter_items("ns:*")]
+    assert items == [
+        ("tests.fake_plugin.FakePlugin:ns:key1", {"a": 1}),
+        ("tests.fake_plugin.FakePlugin:ns:key2", 5),
+        ("tests.fake_plugin.FakePlugin:ns:key3", -2),
+    ]
+    assert await plugin_storage.get("ns:key2") == 5
+
+
+@pytest.mark.asyncio
+async def test_iter_items_skips_collections(plugin_storage, storage_backend):
+    await plugin_storage.set("ns:key1", {"a": 1})
+    await plugin_storage.list_push("ns:list", 1, 2)
+    await plugin_storage.hash_set("ns:hash", "field", "value")
+    items = [item async for item in plugin_storage.iter_items("ns:*")]
+    assert items == [("tests.fake_plugin.FakePlugin:ns:key1", {"a": 1})]
+    with pytest.raises(TypeError):
+        await plugin_storage.get("ns:list")
+
+
+@pytest.mark.asyncio
+async def test_get_usage(plugin_storage, storage_backend):
+    await plugin_storage.set("key1", "value1")
+    await plugin_storage.set("key2", "value2", shared=True)
+    key = "tests.fake_plugin.FakePlugin:key1"
+    usage = await plugin_storage.get_usage()
+    assert usage == {"keys": 1, "bytes": len(key) + len(dill.dumps("value1"))}
+
+
+@pytest.mark.asyncio
+async def test_quota(storage_backend):
+    plugin_storage = PluginStorage("tests.fake_plugin.FakePlugin", quota=200)
+    await plugin_storage.set("key1", "x" * 50)
+    with pytest.raises(StorageQuotaExceeded):
+        await plugin_storage.set("key2", "x" * 150)
+    assert not await plugin_storage.has("key2")
+    # Shared data does not count towards the quota
+    await plugin_storage.set("key2", "x" * 150, shared=True)
+
+
+@pytest.mark.asyncio
+async def test_counters(plugin_storage, storage_backend):
+    assert await plugin_storage.get_counter("karma") == 0
+    assert await plugin_storage.incr("karma") == 1
+    assert await plugin_storage.incr("karma", 10) == 11
+    assert await plugin_storage.decr("karma", 3) == 8
+    assert await plugin_storage.get_counter("karma") == 8
+    assert "tests.fake_plugin.FakePlugin:karma" in storage_backend._storage
+
+
+@pytest.mark.asyncio
+async def test_set_if_absent(plugin_storage):
+    assert await plugin_storage.set_if_absent("key1", {"a": 1})
+    assert not await plugin_storage.set_if_absent("key1", {"a": 2})
+    assert await plugin_storage.get("key1") == {"a": 1}
+
+
+@pytest.mark.asyncio
+async def test_compare_and_set(plugin_storage):
+    assert await plugin_storage.compare_and_set("key1", None, {"a": 1})
+    assert not await plugin_storage.compare_and_set("key1", {"a": 2}, {"a": 3})
+    assert await plugin_storage.compare_and_set("key1", {"a": 1}, {"a": 3})
+    assert await plugin_storage.get("key1") == {"a": 3}
+
+
+@pytest.mark.asyncio
+async def test_lists(plugin_storage, storage_backend):
+    assert await plugin_storage.list_push("queue", {"job": 1}, {"job": 2}) == 2
+    assert await plugin_storage.list_push("queue", {"job": 0}, left=True) == 3
+    assert await plugin_storage.list_range("queue") == [{"job": n} for n in range(3)]
+    assert await plugin_storage.list_range("queue", 1, -2) == [{"job": 1}]
+    assert await plugin_storage.list_pop("queue", left=True) == {"job": 0}
+    assert await plugin_storage.list_pop("queue") == {"job": 2}
+    assert await plugin_storage.list_length("queue") == 1
+    await plugin_storage.list_pop("queue")
+    assert await plugin_storage.list_pop("queue") is None
+    assert not await plugin_storage.has("queue")
+
+
+@pytest.mark.asyncio
+async def test_sets(plugin_storage):
+    assert await plugin_storage.set_add("users", "alice", "bob") == 2
+    assert await plugin_storage.set_add("users", "bob", "carol") == 1
+    assert await plugin_storage.set_contains("users", "carol")
+    assert await plugin_storage.set_remove("users", "carol", "dave") == 1
+    assert sorted(await plugin_storage.set_members("users")) == ["alice", "bob"]
+
+
+@pytest.mark.asyncio
+async def test_hashes(plugin_storage):
+    await plugin_storage.hash_set("profile", "name", "Alice")
+    await plugin_storage.hash_set("profile", "langs", ["python", "rust"])
+    assert await plugin_storage.hash_get("profile", "name") == "Alice"
+    assert await plugin_storage.hash_get("profile", "age") is None
+    assert await plugin_storage.hash_delete("profile", "name", "age") == 1
+    assert await plugin_storage.hash_get_all("profile") == {"langs": ["python", "rust"]}
+
+
+@pytest.mark.asyncio
+async def test_sorted_sets(plugin_storage):
+    assert await plugin_storage.sorted_set_add("karma", {"alice": 5, "bob": 3}) == 2
+    assert await plugin_storage.sorted_set_increment("karma", "carol", 4) == 4
+    assert await plugin_storage.sorted_set_increment("karma", "bob", 3) == 6
+    assert await plugin_storage.sorted_set_range("karma") == [
+        ("carol", 4),
+        ("alice", 5),
+        ("bob", 6),
+    ]
+    assert await plugin_storage.sorted_set_range("karma", 0, 1, reverse=True) == [
+        ("bob", 6),
+        ("alice", 5),
+    ]
+    assert await plugin_storage.sorted_set_rank("karma", "carol") == 0
+    assert await plugin_storage.sorted_set_rank("karma", "carol", reverse=True) == 2
+    assert await plugin_storage.sorted_set_score("karma", "alice") == 5
+    assert await plugin_storage.sorted_set_remove("karma", "alice") == 1
+    assert await plugin_storage.sorted_set_score("karma", "alice") is None
+
+
+@pytest.mark.asyncio
+async def test_collection_type_mismatch(plugin_storage):
+    await plugin_storage.set("key1", "value1")
+    with pytest.raises(TypeError):
+        await plugin_storage.list_push("key1", "value2")
+
+
+@pytest.mark.asyncio
+async def test_lock(plugin_storage, storage_backend):
+    async with plugin_storage.lock("deploy") as lock:
+        assert lock.token == 1
+        key = "tests.fake_plugin.FakePlugin:lock:deploy"
+        assert await storage_backend.acquire_lock(key, "other", 10) is None
+    async with plugin_storage.lock("deploy") as lock:
+        assert lock.token == 2
+    stats = plugin_storage.get_lock_stats()
+    assert stats["acquired"] == 2
+    assert stats["timeouts"] == 0
+
+
+@pytest.mark.asyncio
+async def test_lock_contention(plugin_storage):
+    order = []
+
+    async def worker(name):
+        async with plugin_storage.lock("shared-state", timeout=1):
+            order.append(f"{name} start")
+            await asyncio.sleep(0.02)
+            order.append(f"{name} end")
+
+    await asyncio.gather(worker("a"), worker("b"))
+    assert order in (
+        ["a start", "a end", "b start", "b end"],
+        ["b start", "b end", "a start", "a end"],
+    )
+    assert plugin_storage.get_lock_stats()["wait_seconds_max"] >= 0.02
+
+    async with plugin_storage.lock("shared-state"):
+        with pytest.raises(LockTimeout):
+            await plugin_storage.lock("shared-state", timeout=0.05).acquire()
+    assert plugin_storage.get_lock_stats()["timeouts"] == 1
+
+
+@pytest.mark.asyncio
+async def test_lock_renewal(plugin_storage, storage_backend):
+    key = "tests.fake_plugin.FakePlugin:lock:job"
+    async with plugin_storage.lock("job", ttl=0.06) as lock:
+        await asyncio.sleep(0.15)
+        assert not lock.lost
+        assert await storage_backend.acquire_lock(key, "other", 10) is None
+
+    lock = plugin_storage.lock("job", ttl=0.06)
+    await lock.acquire()
+    # Somebody else takes over the lock after it expired
+    storage_backend._locks[key] = ("other", 0)
+    await asyncio.sleep(0.05)
+    assert lock.lost
+    assert plugin_storage.get_lock_stats()["lost"] == 1
+    await lock.release()
+
+
+@pytest.mark.asyncio
+async def test_instrumentation(plugin_storage):
+    registry.clear()
+    await plugin_storage.set("key1", "value1")
+    await plugin_storage.get("key1")
+    await plugin_storage.get("key1")
+
+    stats = {}
+    for histogram in plugin_storage.get_stats():
+        labels = histogram["labels"]
+        label = labels.get("phase") or labels["direction"]
+        stats[histogram["name"], labels["operation"], label] = histogram
+    assert stats["storage_seconds", "set", "serialize"]["count"] == 1
+    assert stats["storage_seconds", "set", "backend"]["count"] == 1
+    assert stats["storage_seconds", "get", "backend"]["count"] == 2
+    assert stats["storage_seconds", "get", "deserialize"]["count"] == 2
+    value_size = len(dill.dumps("value1"))
+    assert stats["storage_bytes", "set", "written"]["sum"] == value_size
+    assert stats["storage_bytes", "get", "read"]["sum"] == 2 * value_size
+    assert PluginStorage("tests.fake_plugin.OtherPlugin").get_stats() == []
+
+
+@pytest.mark.asyncio
+async def test_slow_operations_are_logged(storage_backend, mocker):
+    logger = mocker.patch("machine.storage.logger")
+    await PluginStorage("tests.fake_plugin.FakePlugin", slow_threshold=10).set("key1", "value1")
+    logger.warning.assert_not_called()
+    await PluginStorage("tests.fake_plugin.FakePlugin", slow_threshold=0).set("key1", "value1")
+    assert logger.warning.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_collections_not_supported(mocker, tmp_path):
+    backend = SQLiteStorage({"SQLITE_PATH": str(tmp_path / "storage.db")})
+    mocker.patch("machine.storage.Storage.get_instance").return_value = backend
+    plugin_storage = PluginStorage("tests.fake_plugin.FakePlugin")
+    with pytest.raises(CollectionsNotSupported, match="SQLiteStorage"):
+        await plugin_storage.list_push("queue", 1)
+    with pytest.raises(CollectionsNotSupported):
+        await plugin_storage.hash_get_all("hash")
@@ -7,7 +7,13 @@ import dill
 import pytest
 
 from machine.storage import PluginStorage
-from machine.storage.backends.redis import RedisStorage
+from machine.storage.backends.redis import (
+    ACQUIRE_LOCK_SCRIPT,
+    EXTEND_LOCK_SCRIPT,
+    RELEASE_LOCK_SCRIPT,
+    RedisStorage,
+)
+from machine.utils.circuit_breaker import CircuitOpenError
 
 from tests.helpers.aio import make_awaitable_result
 from tests.helpers.expect import AsyncExpectMock, expect
@@ -60,6 +66,138 @@ async def test_has(redis_storage, redis_client):
     await redis_storage.has("key1")
 
 
+@pytest.mark.asyncio
+async def test_set_many(redis_storage):
+    pipe = mock.Mock(execute=mock.AsyncMock())
+    redis_storage._redis = mock.Mock(pipeline=mock.Mock(return_value=pipe))
+
+    await redis_storage.set_many({"key1": b"value1", "key2": b"value2"}, expires=42)
+    pipe.set.assert_has_calls(
+        [
+            mock.call("SM:key1", b"value1", expire=42),
+            mock.call("SM:key2", b"value2", expire=42),
+        ]
+    )
+    pipe.execute.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_collections(redis_storage, redis_client):
+    redis_client.rpush.expect("SM:queue", b"1", b"2").returns(2)
+    redis_client.lpop.expect("SM:queue").returns(b"1")
+    redis_client.sadd.expect("SM:users", b"alice").returns(1)
+    redis_client.hgetall.expect("SM:profile").returns({b"name": b"Alice"})
+    redis_client.zadd.expect("SM:karma", 5, b"alice", 3, b"bob").returns(2)
+    redis_client.zrevrange.expect("SM:karma", 0, 0, withscores=True).returns(
+        [(b"alice", 5)]
+    )
+
+    assert await redis_storage.list_push("queue", [b"1", b"2"]) == 2
+    assert await redis_storage.list_pop("queue", left=True) == b"1"
+    assert await redis_storage.set_add("users", [b"alice"]) == 1
+    assert await redis_storage.set_add("users", []) == 0
+    assert await redis_storage.hash_get_all("profile") == {b"name": b"Alice"}
+    assert await redis_storage.sorted_set_add("karma", {b"alice": 5, b"bob": 3}) == 2
+    assert await redis_storage.sorted_set_range("karma", 0, 0, reverse=True) == [
+        (b"alice", 5)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_scan_and_get_many(redis_storage, redis_client):
+    redis_client.scan.expect(cursor=0, match="SM:sc:*", count=None).returns(
+        (42, [b"SM:sc:key1"])
+    )
+    redis_client.scan.expect(cursor=42, match="SM:sc:*", count=None).returns(
+        (0, [b"SM:sc:key2"])
+    )
+    redis_client.mget.expect("SM:sc:key1", "SM:sc:key2").returns([b"1", None])
+
+    assert await redis_storage.scan("sc:*") == (42, [b"SM:sc:key1"])
+    assert await redis_storage.scan("sc:*", 42) == (None, [b"SM:sc:key2"])
+    assert await redis_storage.get_many(["sc:key1", "sc:key2"]) == [b"1", None]
+    assert redis_storage.logical_key(b"SM:sc:key1") == "sc:key1"
+
+
+@pytest.mark.asyncio
+async def test_delete_matching(redis_storage, redis_client):
+    redis_client.scan.expect(cursor=b"0", match="SM:dm:*").returns(
+        (b"7", [b"SM:dm:key1", b"SM:dm:key2"])
+    )
+    redis_client.scan.expect(cursor=b"7", match="SM:dm:*").returns((b"9", []))
+    redis_client.scan.expect(cursor=b"9", match="SM:dm:*").returns((b"", [b"SM:dm:key3"]))
+    redis_client.unlink.expect(b"SM:dm:key1", b"SM:dm:key2").returns(2)
+    redis_client.unlink.expect(b"SM:dm:key3").returns(1)
+
+    assert await redis_storage.delete_matching("dm:*") == 3
+
+
+@pytest.mark.asyncio
+async def test_locks(redis_storage, redis_client):
+    redis_client.eval.expect(
+        ACQUIRE_LOCK_SCRIPT,
+        keys=["SM-lock:plugin:key1", "SM-fence:plugin:key1"],
+        args=["owner1", 1500],
+    ).returns(3)
+    redis_client.eval.expect(
+        EXTEND_LOCK_SCRIPT, keys=["SM-lock:plugin:key1"], args=["owner1", 30000]
+    ).returns(1)
+    redis_client.eval.expect(
+        RELEASE_LOCK_SCRIPT, keys=["SM-lock:plugin:key1"], args=["owner2"]
+    ).returns(0)
+
+    assert await redis_storage.acquire_lock("plugin:key1", "owner1", 1.5) == 3
+    assert await redis_storage.extend_lock("plugin:key1", "owner1", 30)
+    assert not await redis_storage.release_lock(b"plugin:key1", "owner2")
+
+
+@pytest.mark.asyncio
+async def test_dump_and_restore(redis_storage, redis_client):
+    redis_client.dump.expect("SM:queue").returns(b"dumped")
+    redis_client.execute.expect(b"RESTORE", "SM:queue", 60000, b"dumped", b"REPLACE").returns(
+        b"OK"
+    )
+    redis_client.execute.expect(b"RESTORE", "SM:queue", 0, b"dumped", b"REPLACE").returns(b"OK")
+
+    data = await redis_storage.dump("queue")
+    await redis_storage.restore("queue", data, 60)
+    await redis_storage.restore("queue", data)
+
+
+@pytest.mark.asyncio
+async def test_ttl(redis_storage, redis_client):
+    redis_client.ttl.expect("SM:key1").returns(42)
+    redis_client.ttl.expect("SM:key2").returns(-1)
+    redis_client.ttl.expect("SM:key3").returns(-2)
+
+    assert await redis_storage.ttl("key1") == 42
+    assert await redis_storage.ttl("key2") is None
+    assert await redis_storage.ttl("key3") is None
+
+
+@pytest.mark.asyncio
+async def test_touch(redis_storage, redis_client):
+    redis_client.pexpire.expect("SM:key1", 30000).returns(1)
+    redis_client.pexpire.expect("SM:key2", 1500).returns(0)
+    redis_client.execute.expect(b"GETEX", "SM:key1", b"PX", 30000).returns(b"value1")
+
+    assert await redis_storage.touch("key1", 30)
+    assert not await redis_storage.touch("key2", 1.5)
+    assert await redis_storage.get_and_touch("key1", 30) == b"value1"
+
+
+@pytest.mark.asyncio
+async def test_get_and_touch_without_getex(redis_storage, redis_client):
+    redis_client.execute.expect(b"GETEX", "SM:key3", b"PX", 30000).raises(
+        aioredis.ReplyError("ERR unknown command 'GETEX'")
+    )
+    redis_client.get.expect("SM:key3").returns(b"value1")
+    redis_client.pexpire.expect("SM:key3", 30000).returns(1)
+
+    assert await redis_storage.get_and_touch("key3", 30) == b"value1"
+    assert not redis_storage._getex_supported
+
+
 @pytest.mark.asyncio
 async def test_delete(redis_storage, redis_client):
     redis_client.delete.expect("SM:key1").returns(None)
@@ -127,3 +265,166 @@ async def test_plugin_storage_wrapping(plugin_storage, redis_client):
 
     for key in keys:
         assert await plugin_storage.get(key, shared=True) is not None
+
+
+@pytest.mark.asyncio
+async def test_iter_keys(redis_storage, redis_client):
+    redis_client.scan.expect(cursor=b"0", match="SM:it:*", count=2).returns(
+        (42, ["SM:it:key1", "SM:it:key2"])
+    )
+    redis_client.scan.expect(cursor=42, match="SM:it:*", count=2).returns(
+        (0, ["SM:it:key3"])
+    )
+
+    keys = [key async for key in redis_storage.iter_keys("it:*", count=2)]
+    assert keys == ["SM:it:key1", "SM:it:key2", "SM:it:key3"]
+
+
+@pytest.mark.asyncio
+async def test_iter_items(redis_storage, redis_client):
+    redis_client.scan.expect(cursor=b"0", match="SM:items:*").returns(
+        (0, ["SM:items:key1", "SM:items:key2", "SM:items:key3"])
+    )
+    redis_client.mget.expect("SM:items:key1", "SM:items:key2", "SM:items:key3").returns(
+        [b"1", None, b"3"]
+    )
+
+    items = [item async for item in redis_storage.iter_items("items:*")]
+    assert items == [("SM:items:key1", b"1"), ("SM:items:key3", b"3")]
+
+
+@pytest.mark.asyncio
+async def test_namespace_usage(redis_storage, redis_client):
+    redis_client.scan.expect(cursor=b"0", match="SM:Plugin:*").returns(
+        (0, ["SM:Plugin:key1", "SM:Plugin:key2"])
+    )
+    pipe = mock.Mock()
+    pipe.execute.side_effect = [None, None, make_awaitable_result([60, 40])]
+
+    with mock.patch.object(redis_client, "pipeline", mock.Mock(return_value=pipe)):
+        assert await redis_storage.namespace_usage("Plugin") == {"keys": 2, "bytes": 100}
+    pipe.execute.assert_has_calls(
+        [
+            mock.call(b"MEMORY", b"USAGE", "SM:Plugin:key1"),
+            mock.call(b"MEMORY", b"USAGE", "SM:Plugin:key2"),
+            mock.call(),
+        ]
+    )
+
+
+@pytest.mark.asyncio
+async def test_incr(redis_storage, redis_client):
+    redis_client.incrby.expect("SM:counter", 2).returns(2)
+    redis_client.eval.expect(..., keys=["SM:counter"], args=[1, 60]).returns(3)
+
+    assert await redis_storage.incr("counter", 2) == 2
+    assert await redis_storage.incr("counter", expires=60) == 3
+
+
+@pytest.mark.asyncio
+async def test_set_if_absent(redis_storage, redis_client):
+    redis_client.set.expect(
+        "SM:key1", "value1", expire=None, exist=aioredis.Redis.SET_IF_NOT_EXIST
+    ).returns(True)
+
+    assert await redis_storage.set_if_absent("key1", "value1")
+
+
+@pytest.mark.asyncio
+async def test_compare_and_set(redis_storage, redis_client):
+    redis_client.eval.expect(..., keys=["SM:key1"], args=[0, b"", "new", 0]).returns(1)
+    redis_client.eval.expect(
+        ..., keys=["SM:key1"], args=[1, "new", "newer", 10]
+    ).returns(0)
+
+    assert await redis_storage.compare_and_set("key1", None, "new")
+    assert not await redis_storage.compare_and_set("key1", "new", "newer", expires=10)
+
+
+@pytest.fixture
+def resilient_storage():
+    client = AsyncExpectMock()
+    settings = {
+        "REDIS_URL": "redis://nohost:1234",
+        "REDIS_CIRCUIT_BREAKER_THRESHOLD": 2,
+        "REDIS_DEGRADED_MODE": True,
+    }
+    storage = RedisStorage(settings)
+    storage._redis = client
+    client.connection = mock.Mock(size=2, freesize=1)
+    return storage, client
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker(resilient_storage):
+    storage, client = resilient_storage
+    client.delete.expect("SM:key1").raises(ConnectionRefusedError(), always=True)
+
+    for _ in range(2):
+        with pytest.raises(ConnectionRefusedError):
+            await storage.delete("key1")
+
+    # The breaker is open, so Redis isn't even tried
+    with pytest.raises(CircuitOpenError):
+        await storage.delete("key1")
+    assert storage.stats()["circuit_breaker"]["state"] == "open"
+
+
+@pytest.mark.asyncio
+async def test_reply_errors_dont_trip_breaker(resilient_storage):
+    storage, client = resilient_storage
+    client.incrby.expect("SM:key1", 1).raises(
+        aioredis.ReplyError("WRONGTYPE"), always=True
+    )
+
+    for _ in range(3):
+        with pytest.raises(aioredis.ReplyError):
+            await storage.incr("key1")
+    assert storage.stats()["circuit_breaker"]["state"] == "closed"
+
+
+@pytest.mark.asyncio
+async def test_degraded_reads(resilient_storage):
+    storage, client = resilient_storage
+    client.set.expect("SM:key1", "value1", expire=None).returns(True)
+    client.get.expect("SM:key1").raises(ConnectionRefusedError(), always=True)
+    client.get.expect("SM:key2").raises(ConnectionRefusedError(), always=True)
+
+    await storage.set("key1", "value1")
+    assert await storage.get("key1") == "value1"
+    with pytest.raises(ConnectionRefusedError):
+        await storage.get("key2")
+    assert storage.stats()["degraded_reads"] == 1
+
+
+@pytest.mark.asyncio
+async def test_delete_matching_invalidates_degraded_reads(resilient_storage):
+    storage, client = resilient_storage
+    client.set.expect("SM:dm:key1", "value1", expire=None).returns(True)
+    client.scan.expect(cursor=b"0", match="SM:dm:*").returns((b"", [b"SM:dm:key1"]))
+    client.unlink.expect(b"SM:dm:key1").returns(1)
+    client.get.expect("SM:dm:key1").raises(ConnectionRefusedError(), always=True)
+
+    await storage.set("dm:key1", "value1")
+    assert await storage.delete_matching("dm:*") == 1
+    # Redis is down, and the cleared value is not served from the cache
+    with pytest.raises(ConnectionRefusedError):
+        await storage.get("dm:key1")
+
+
+@pytest.mark.asyncio
+async def test_reconnect(resilient_storage, mocker):
+    storage, client = resilient_storage
+    new_client = mock.MagicMock()
+    create_redis_pool = mocker.patch(
+        "machine.storage.backends.redis.aioredis.create_redis_pool"
+    )
+    create_redis_pool.return_value = new_client
+
+    await storage._reconnect()
+    assert storage._redis is new_client
+    assert new_client.connection.wait_stats is storage._pool_wait
+    client.close.assert_called_once()
+    stats = storage.stats()
+    assert stats["reconnects"] == 1
+    assert stats["pool"]["size"] == new_client.connection.size
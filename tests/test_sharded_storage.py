@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from machine.storage.backends.memory import MemoryStorage
+from machine.storage.backends.sharded import ShardedStorage
+
+SHARDS = ["shard1", "shard2", "shard3"]
+
+
+@pytest.fixture
+async def sharded_storage():
+    storage = ShardedStorage(
+        {
+            "STORAGE_SHARDS": SHARDS,
+            "STORAGE_SHARD_BACKEND": "machine.storage.backends.memory.MemoryStorage",
+        }
+    )
+    await storage.connect()
+    return storage
+
+
+def test_needs_shards():
+    with pytest.raises(ValueError):
+        ShardedStorage({"STORAGE_SHARDS": []})
+
+
+@pytest.mark.asyncio
+async def test_keys_are_spread_over_shards(sharded_storage):
+    for idx in range(300):
+        await sharded_storage.set(f"ns:key{idx}", b"value")
+    sizes = [len(shard._storage) for shard in sharded_storage._shards.values()]
+    assert all(isinstance(s, MemoryStorage) for s in sharded_storage._shards.values())
+    assert sum(sizes) == 300
+    assert min(sizes) > 50
+    for idx in range(300):
+        assert await sharded_storage.get(f"ns:key{idx}") == b"value"
+        assert await sharded_storage.has(f"ns:key{idx}")
+
+
+@pytest.mark.asyncio
+async def test_single_key_operations(sharded_storage):
+    assert await sharded_storage.incr("ns:counter", 5) == 5
+    assert await sharded_storage.set_if_absent("ns:key1", b"value1")
+    assert not await sharded_storage.set_if_absent("ns:key1", b"value2")
+    assert await sharded_storage.compare_and_set("ns:key1", b"value1", b"value3")
+    assert await sharded_storage.get("ns:key1") == b"value3"
+    await sharded_storage.set("ns:key2", b"value", expires=60)
+    assert 0 < await sharded_storage.ttl("ns:key2") <= 60
+    await sharded_storage.delete("ns:key1")
+    assert not await sharded_storage.has("ns:key1")
+
+
+@pytest.mark.asyncio
+async def test_fan_out(sharded_storage):
+    await sharded_storage.set_many({f"ns:key{idx}": b"value" for idx in range(50)})
+    await sharded_storage.set("other:key", b"value")
+    expected = {f"ns:key{idx}" for idx in range(50)}
+    assert set(await sharded_storage.find_keys("ns:*")) == expected
+    assert {key async for key in sharded_storage.iter_keys("ns:*", count=7)} == expected
+    items = [item async for item in sharded_storage.iter_items("ns:*")]
+    assert sorted(items) == sorted((key, b"value") for key in expected)
+    usage = await sharded_storage.namespace_usage("ns")
+    assert usage["keys"] == 50
+    assert set(sharded_storage.stats()["shards"]) == set(SHARDS)
+    assert await sharded_storage.delete_matching("ns:*") == 50
+    assert await sharded_storage.find_keys("*") == ["other:key"]
+
+
+@pytest.mark.asyncio
+async def test_add_shard(sharded_storage):
+    for idx in range(300):
+        await sharded_storage.set(f"ns:key{idx}", b"value", expires=60 if idx % 2 else None)
+
+    moved = await sharded_storage.add_shard("shard4")
+    new_shard = sharded_storage._shards["shard4"]
+    assert moved == len(new_shard._storage)
+    # Only the keys that belong to the new shard are moved
+    assert 0 < moved < 150
+
+    for idx in range(300):
+        assert await sharded_storage.get(f"ns:key{idx}") == b"value"
+        ttl = await sharded_storage.ttl(f"ns:key{idx}")
+        assert (ttl is not None) == bool(idx % 2)
+    for name, shard in sharded_storage._shards.items():
+        assert all(sharded_storage._shard_name(key) == name for key in shard._storage)
+
+    assert await sharded_storage.rebalance() == 0
+    with pytest.raises(ValueError):
+        await sharded_storage.add_shard("shard4")
+
+
+@pytest.mark.asyncio
+async def test_collections(sharded_storage):
+    assert await sharded_storage.list_push("ns:queue", [b"1", b"2"]) == 2
+    assert await sharded_storage.sorted_set_increment("ns:karma", b"alice", 2) == 2
+    shard = sharded_storage._shard("ns:queue")
+    assert await shard.list_range("ns:queue") == [b"1", b"2"]
+    assert await sharded_storage.sorted_set_range("ns:karma") == [(b"alice", 2)]
+
+
+@pytest.mark.asyncio
+async def test_rebalance_collections(sharded_storage):
+    for idx in range(100):
+        await sharded_storage.list_push(f"ns:queue{idx}", [b"1", b"2"])
+        await sharded_storage.hash_set(f"ns:hash{idx}", "field", b"value")
+        await sharded_storage.sorted_set_add(f"ns:karma{idx}", {b"alice": 2})
+    await sharded_storage.touch("ns:queue0", 60)
+
+    assert await sharded_storage.add_shard("shard4") > 0
+    for idx in range(100):
+        assert await sharded_storage.list_range(f"ns:queue{idx}") == [b"1", b"2"]
+        assert await sharded_storage.hash_get(f"ns:hash{idx}", "field") == b"value"
+        assert await sharded_storage.sorted_set_range(f"ns:karma{idx}") == [(b"alice", 2)]
+    assert await sharded_storage.ttl("ns:queue0") is not None
+    for name, shard in sharded_storage._shards.items():
+        assert all(sharded_storage._shard_name(key) == name for key in shard._storage)
+
+
+@pytest.mark.asyncio
+async def test_scan_and_get_many(sharded_storage):
+    keys = [f"ns:key{idx}" for idx in range(20)]
+    await sharded_storage.set_many({key: key.encode() for key in keys})
+
+    found, cursor = [], None
+    while True:
+        cursor, page = await sharded_storage.scan("ns:*", cursor, count=4)
+        found.extend(page)
+        if cursor is None:
+            break
+    assert sorted(found) == sorted(keys)
+    assert await sharded_storage.get_many(keys + ["ns:other"]) == [
+        key.encode() for key in keys
+    ] + [None]
+
+
+@pytest.mark.asyncio
+async def test_close_closes_all_shards(sharded_storage, mocker):
+    shards = list(sharded_storage._shards.values())
+    closes = [mocker.patch.object(shard, "close") for shard in shards]
+    closes[0].side_effect = ConnectionError()
+    with pytest.raises(ConnectionError):
+        await sharded_storage.close()
+    assert all(close.called for close in closes)
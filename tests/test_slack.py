@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from slack.errors import SlackApiError
+
+from machine.slack import MessagingClient
+from machine.utils.timer_wheel import TimerWheel
+from tests.fake_plugins import FakePlugin
+
+
+class FakeWebClient:
+    """Stand-in for the Slack web client that records API calls"""
+
+    def __init__(self):
+        self.calls = []
+        self.errors = {}
+
+    async def api_call(self, method, json=None):
+        self.calls.append((method, json))
+        error = self.errors.get(method)
+        if isinstance(error, list):
+            # Fail the first calls only
+            error = error.pop(0) if error else None
+        if error is not None:
+            raise error
+        if method == "im.open":
+            return {"ok": True, "channel": {"id": "D123"}}
+        return {"ok": True}
+
+
+@pytest.fixture
+def web(mocker):
+    web = FakeWebClient()
+    mocker.patch("machine.slack.Slack.get_instance").return_value.web = web
+    return web
+
+
+@pytest.fixture
+def add_job(mocker):
+    return mocker.patch("machine.slack.Scheduler.get_instance").return_value.add_job
+
+
+@pytest.fixture
+def client(mocker):
+    mocker.patch.object(MessagingClient, "schedule_message_threshold", 3600)
+    return MessagingClient()
+
+
+@pytest.mark.asyncio
+async def test_far_future_messages_are_scheduled_by_slack(client, web, add_job):
+    when = datetime.now() + timedelta(days=2)
+    await client.send_scheduled(when, "C123", "hello", attachments=None, ephemeral_user=None)
+    assert web.calls == [
+        (
+            "chat.scheduleMessage",
+            {
+                "channel": "C123",
+                "text": "hello",
+                "blocks": None,
+                "as_user": True,
+                "post_at": int(when.timestamp()),
+            },
+        )
+    ]
+    assert not add_job.called
+
+    await client.send_dm_scheduled(when, "U123", "hello")
+    assert web.calls[1] == ("im.open", {"user": "U123"})
+    assert web.calls[2][0] == "chat.scheduleMessage"
+    assert web.calls[2][1]["channel"] == "D123"
+    assert not add_job.called
+
+
+@pytest.mark.asyncio
+async def test_near_term_messages_are_scheduled_locally(client, web, add_job):
+    when = datetime.now() + timedelta(minutes=5)
+    handle = client.send_scheduled(when, "C123", "hello")
+    assert handle.done() and handle.result() is None
+    assert add_job.call_args[0] == ("machine.slack:MessagingClient.send",)
+    assert add_job.call_args[1]["run_date"] == when
+
+    # Slack can't schedule ephemeral messages
+    later = datetime.now() + timedelta(days=2)
+    client.send_scheduled(later, "C123", "hello", ephemeral_user="U123")
+    assert add_job.call_args[1]["run_date"] == later
+    assert web.calls == []
+
+
+@pytest.mark.asyncio
+async def test_messages_are_scheduled_locally_if_slack_refuses(client, web, add_job):
+    web.errors["chat.scheduleMessage"] = SlackApiError("time_too_far", {"ok": False})
+    when = datetime.now() + timedelta(days=200)
+    await client.send_scheduled(when, "C123", "hello")
+    assert add_job.call_args[1]["args"] == ["C123", "hello"]
+    assert add_job.call_args[1]["run_date"] == when
+
+
+def test_threshold_defaults_to_local_scheduling(web, add_job):
+    when = datetime.now() + timedelta(days=2)
+    MessagingClient().send_dm_scheduled(when, "U123", "hello")
+    assert add_job.call_args[0] == ("machine.jobs:send_dm",)
+    assert web.calls == []
+
+
+@pytest.mark.asyncio
+async def test_short_delays_use_the_timer_wheel(client, web, add_job, mocker):
+    mocker.patch.object(MessagingClient, "timer_wheel_horizon", 60)
+    call_later = mocker.patch("machine.slack.timer_wheel.call_later")
+    when = datetime.now() + timedelta(seconds=30)
+    handle = client.send_scheduled(when, "C123", "hello")
+    delay, callback = call_later.call_args[0]
+    assert 29 < delay <= 30
+    assert not handle.done()
+    await callback()
+    assert handle.done() and handle.result() is None
+    assert web.calls[0][0] == "chat.postMessage"
+    assert not add_job.called
+
+    client.send_dm_scheduled(when, "U123", "hello")
+    await call_later.call_args[0][1]()
+    assert web.calls[1] == ("im.open", {"user": "U123"})
+
+    # Longer delays still go to the scheduler
+    client.send_scheduled(datetime.now() + timedelta(minutes=5), "C123", "hello")
+    assert add_job.called
+
+
+@pytest.mark.asyncio
+async def test_timer_wheel_handles(client, web, mocker):
+    mocker.patch.object(MessagingClient, "timer_wheel_horizon", 60)
+    call_later = mocker.patch("machine.slack.timer_wheel.call_later")
+    log_error = mocker.patch("machine.slack.logger.opt").return_value.error
+    when = datetime.now() + timedelta(seconds=30)
+
+    # Failures are logged, even if the handle is not awaited
+    web.errors["chat.postMessage"] = SlackApiError("channel_not_found", {"ok": False})
+    handle = client.send_scheduled(when, "C123", "hello")
+    await call_later.call_args[0][1]()
+    await asyncio.sleep(0)
+    assert isinstance(handle.exception(), SlackApiError)
+    assert log_error.called
+
+    # Cancelling the handle cancels the timer
+    handle = client.send_scheduled(when, "C123", "hello")
+    handle.cancel()
+    await asyncio.sleep(0)
+    assert call_later.return_value.cancel.called
+
+
+@pytest.mark.asyncio
+async def test_plugins_can_cancel_scheduled_messages(client, web, mocker, event_loop):
+    mocker.patch.object(MessagingClient, "timer_wheel_horizon", 60)
+    wheel = TimerWheel(tick=0.01, loop=event_loop)
+    mocker.patch("machine.slack.timer_wheel", wheel)
+    plugin = FakePlugin({}, client, None)
+    when = datetime.now() + timedelta(seconds=0.05)
+
+    cancelled = plugin.say_scheduled(when, "C123", "cancelled")
+    sent = plugin.send_dm_scheduled(when, "U123", "sent")
+    cancelled.cancel()
+    await asyncio.sleep(0)
+    assert len(wheel) == 1
+    await asyncio.wait_for(sent, 1)
+    assert [call[1]["text"] for call in web.calls if call[0] == "chat.postMessage"] == ["sent"]
+
+
+@pytest.mark.asyncio
+async def test_messages_due_in_the_same_second_are_batched(client, mocker, event_loop):
+    mocker.patch.object(MessagingClient, "batch_scheduled_messages", True)
+    scheduler = AsyncIOScheduler(event_loop=event_loop, timezone="UTC")
+    mocker.patch("machine.slack.Scheduler.get_instance").return_value = scheduler
+    scheduler.start(paused=True)
+    when = datetime.now().replace(microsecond=0) + timedelta(minutes=10)
+
+    client.send_scheduled(when, "C123", "one")
+    client.send_scheduled(when - timedelta(milliseconds=500), "C456", "two", attachments=None)
+    client.send_dm_scheduled(when, "U123", "three")
+    client.send_scheduled(when + timedelta(seconds=1), "C123", "four")
+    # The messages are added to their batch jobs at once, in the next iteration of the loop
+    assert scheduler.get_jobs() == []
+    await asyncio.sleep(0)
+    client.send_scheduled(when, "C123", "five")
+    await asyncio.sleep(0)
+
+    batches = sorted(scheduler.get_jobs(), key=lambda job: job.next_run_time)
+    assert [job.func_ref for job in batches] == ["machine.jobs:send_batch"] * 2
+    assert batches[0].args[0] == [
+        ["channel", "C123", "one", {}],
+        ["channel", "C456", "two", {"attachments": None}],
+        ["dm", "U123", "three", {}],
+        ["channel", "C123", "five", {}],
+    ]
+    assert batches[1].args[0] == [["channel", "C123", "four", {}]]
+    scheduler.shutdown(wait=False)
+
+
+@pytest.mark.asyncio
+async def test_send_batch(client, web, mocker):
+    mocker.patch.object(MessagingClient, "batch_concurrency", 2)
+    rate_limited = SlackApiError(
+        "ratelimited", SimpleNamespace(status_code=429, headers={"Retry-After": "0"})
+    )
+    web.errors["chat.postMessage"] = [rate_limited]
+    web.errors["im.open"] = [SlackApiError("user_not_found", SimpleNamespace(status_code=200))]
+
+    summary = await client.send_batch(
+        [
+            ["channel", "C123", "one", {}],
+            ["dm", "U404", "two", {}],
+            ["channel", "C456", "three", {"attachments": None}],
+        ]
+    )
+    assert summary["total"] == 3
+    assert summary["sent"] == 2
+    assert summary["failed"] == 1
+    assert summary["errors"][0]["target"] == "U404"
+    sent = [payload["channel"] for method, payload in web.calls if method == "chat.postMessage"]
+    # The rate limited message was sent again
+    assert len(sent) == 3 and set(sent) == {"C123", "C456"}
+
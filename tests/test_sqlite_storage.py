@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+from machine.storage.backends.sqlite import SQLiteStorage, NotConnectedError
+
+
+@pytest.fixture
+async def sqlite_storage(tmp_path):
+    storage = SQLiteStorage(
+        {"SQLITE_PATH": str(tmp_path / "storage.db"), "SQLITE_PURGE_INTERVAL": 0}
+    )
+    await storage.connect()
+    return storage
+
+
+@pytest.fixture
+def mocked_time(mocker):
+    mocked = mocker.patch("machine.storage.backends.sqlite.time.time")
+    mocked.return_value = 1000.0
+    return mocked
+
+
+@pytest.mark.asyncio
+async def test_not_connected(tmp_path):
+    storage = SQLiteStorage({"SQLITE_PATH": str(tmp_path / "storage.db")})
+    with pytest.raises(NotConnectedError):
+        await storage.get("key1")
+
+
+@pytest.mark.asyncio
+async def test_store_retrieve_delete(sqlite_storage):
+    assert await sqlite_storage.get("key1") is None
+    await sqlite_storage.set("key1", b"value1")
+    await sqlite_storage.set(b"key2", b"value2")
+    assert await sqlite_storage.get("key1") == b"value1"
+    assert await sqlite_storage.get("key2") == b"value2"
+    assert await sqlite_storage.has("key1")
+    await sqlite_storage.delete("key1")
+    assert not await sqlite_storage.has("key1")
+
+
+@pytest.mark.asyncio
+async def test_journal_mode(sqlite_storage):
+    mode = await sqlite_storage._run(
+        lambda: sqlite_storage._conn.execute("PRAGMA journal_mode").fetchone()[0]
+    )
+    assert mode == "wal"
+
+
+@pytest.mark.asyncio
+async def test_expire_values(sqlite_storage, mocked_time):
+    await sqlite_storage.set("key1", b"value1", expires=15)
+    assert await sqlite_storage.get("key1") == b"value1"
+    mocked_time.return_value = 1020.0
+    assert await sqlite_storage.get("key1") is None
+    assert not await sqlite_storage.has("key1")
+    assert await sqlite_storage._run(sqlite_storage._purge_expired) == 1
+
+
+@pytest.mark.asyncio
+async def test_find_and_iter_keys(sqlite_storage, mocker):
+    await sqlite_storage.set_many(
+        {
+            "Plugin:ns:key1": b"1",
+            "Plugin:ns:key2": b"2",
+            "Plugin:ms:key3": b"3",
+            "Other:ns:key4": b"4",
+        }
+    )
+    assert await sqlite_storage.find_keys("Plugin:ns:*") == [
+        "Plugin:ns:key1",
+        "Plugin:ns:key2",
+    ]
+    assert await sqlite_storage.find_keys("*:ns:key[!2]") == [
+        "Other:ns:key4",
+        "Plugin:ns:key1",
+    ]
+    page = mocker.spy(sqlite_storage, "_page")
+    keys = [key async for key in sqlite_storage.iter_keys("Plugin:*", count=2)]
+    assert keys == ["Plugin:ms:key3", "Plugin:ns:key1", "Plugin:ns:key2"]
+    assert [call.args[-1] for call in page.call_args_list] == ["key", "key"]
+    items = [item async for item in sqlite_storage.iter_items("Plugin:*", count=2)]
+    assert items == [
+        ("Plugin:ms:key3", b"3"),
+        ("Plugin:ns:key1", b"1"),
+        ("Plugin:ns:key2", b"2"),
+    ]
+    assert await sqlite_storage.namespace_usage("Plugin") == {
+        "keys": 3,
+        "bytes": 3 * (len("Plugin:ns:key1") + 1),
+    }
+
+
+@pytest.mark.asyncio
+async def test_atomic_operations(sqlite_storage, mocked_time):
+    assert await sqlite_storage.incr("counter", expires=10) == 1
+    assert await sqlite_storage.incr("counter", 4) == 5
+    mocked_time.return_value = 1011.0
+    assert await sqlite_storage.incr("counter") == 1
+
+    assert await sqlite_storage.set_if_absent("key1", b"value1", expires=10)
+    assert not await sqlite_storage.set_if_absent("key1", b"value2")
+    mocked_time.return_value = 1030.0
+    assert await sqlite_storage.set_if_absent("key1", b"value3")
+
+    assert not await sqlite_storage.compare_and_set("key1", b"value1", b"value4")
+    assert await sqlite_storage.compare_and_set("key1", b"value3", b"value4")
+    assert await sqlite_storage.compare_and_set("key2", None, b"value1")
+    assert await sqlite_storage.get("key1") == b"value4"
+
+
+@pytest.mark.asyncio
+async def test_delete_matching(sqlite_storage, mocked_time):
+    await sqlite_storage.set("ns:key1", b"value1")
+    await sqlite_storage.set("ns:key2", b"value2", expires=15)
+    await sqlite_storage.set("ns:other", b"value3")
+    await sqlite_storage.set("ms:key1", b"value4")
+    mocked_time.return_value = 1020.0
+    assert await sqlite_storage.delete_matching("ns:key*") == 1
+    assert await sqlite_storage.find_keys("*") == ["ms:key1", "ns:other"]
+    assert await sqlite_storage.delete_matching("ns:key*") == 0
+
+
+@pytest.mark.asyncio
+async def test_ttl(sqlite_storage, mocked_time):
+    await sqlite_storage.set("key1", b"value1", expires=15)
+    await sqlite_storage.set("key2", b"value2")
+    mocked_time.return_value = 1005.5
+    assert await sqlite_storage.ttl("key1") == 10
+    assert await sqlite_storage.ttl("key2") is None
+    assert await sqlite_storage.ttl("key3") is None
+    mocked_time.return_value = 1016.0
+    assert await sqlite_storage.ttl("key1") is None
+
+    assert not await sqlite_storage.touch("key1", 30)
+    assert await sqlite_storage.touch("key2", 30)
+    assert await sqlite_storage.ttl("key2") == 30
+    assert await sqlite_storage.get_and_touch("key2", 60) == b"value2"
+    assert await sqlite_storage.ttl("key2") == 60
+    assert await sqlite_storage.get_and_touch("key1", 60) is None
+
+
+@pytest.mark.asyncio
+async def test_scan_and_get_many(sqlite_storage):
+    await sqlite_storage.set_many({f"ns:key{idx}": b"value" for idx in range(5)})
+
+    cursor, keys = await sqlite_storage.scan("ns:*", count=3)
+    assert (cursor, keys) == ("ns:key2", ["ns:key0", "ns:key1", "ns:key2"])
+    cursor, keys = await sqlite_storage.scan("ns:*", cursor, count=3)
+    assert (cursor, keys) == (None, ["ns:key3", "ns:key4"])
+    assert await sqlite_storage.get_many(["ns:key1", "ns:key9"]) == [b"value", None]
+
+
+@pytest.mark.asyncio
+async def test_locks(sqlite_storage, mocked_time):
+    await sqlite_storage.set("ns:key1", b"value1")
+    assert await sqlite_storage.acquire_lock("ns:key1", "owner1", 10) == 1
+    assert await sqlite_storage.acquire_lock("ns:key1", "owner2", 10) is None
+    assert await sqlite_storage.extend_lock("ns:key1", "owner1", 20)
+    assert not await sqlite_storage.release_lock("ns:key1", "owner2")
+    # Locks are kept apart from the data
+    assert await sqlite_storage.find_keys("ns:*") == ["ns:key1"]
+    assert await sqlite_storage.delete_matching("ns:*") == 1
+    assert await sqlite_storage.acquire_lock("ns:key1", "owner2", 10) is None
+
+    assert await sqlite_storage.release_lock("ns:key1", "owner1")
+    assert await sqlite_storage.acquire_lock("ns:key1", "owner2", 10) == 2
+    # An expired lock can be taken over
+    mocked_time.return_value = 1011.0
+    assert not await sqlite_storage.extend_lock("ns:key1", "owner2", 10)
+    assert await sqlite_storage.acquire_lock("ns:key1", "owner1", 10) == 3
+
+
+@pytest.mark.asyncio
+async def test_close(tmp_path):
+    storage = SQLiteStorage({"SQLITE_PATH": str(tmp_path / "storage.db")})
+    await storage.connect()
+    await storage.set("key1", b"value1")
+    purger = storage._purger
+    await storage.close()
+    await asyncio.sleep(0)
+    assert purger.cancelled()
+    with pytest.raises(NotConnectedError):
+        await storage.get("key1")
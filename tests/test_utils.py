@@ -1,4 +1,18 @@
-from machine.utils.collections import CaseInsensitiveDict
+import asyncio
+
+import pytest
+
+from machine.utils.aio import RateLimiter, merge
+from machine.utils.circuit_breaker import CircuitBreaker
+from machine.utils.collections import (
+    CaseInsensitiveDict,
+    HashRing,
+    SortedKeyIndex,
+    SortedSet,
+    glob_prefix,
+)
+from machine.utils.metrics import Histogram, MetricsRegistry
+from machine.utils.timer_wheel import TimerWheel
 from tests.singletons import FakeSingleton
 
 
@@ -12,3 +26,212 @@ def test_CaseInsensitiveDict():
     d = CaseInsensitiveDict({'foo': 'bar'})
     assert 'foo' in d
     assert 'FoO' in d
+
+
+def test_SortedKeyIndex():
+    index = SortedKeyIndex(['b:2', 'a:1', 'b:1', b'b:3'])
+    assert len(index) == 4
+    assert list(index.prefixed('b:')) == ['b:1', 'b:2']
+    assert list(index.prefixed(b'b:')) == [b'b:3']
+    index.remove('b:1')
+    index.add('b:2')
+    assert 'b:1' not in index
+    assert list(index.prefixed('b')) == ['b:2']
+    index.remove_many(['a:1', b'b:3', 'c:1'])
+    assert list(index) == ['b:2']
+
+
+def test_SortedKeyIndex_buckets():
+    # A small load splits the keys over many buckets
+    index = SortedKeyIndex(['k{:02}'.format(i) for i in range(50, 0, -1)], load=2)
+    assert list(index) == ['k{:02}'.format(i) for i in range(1, 51)]
+    assert list(index.prefixed('k2')) == ['k{}'.format(i) for i in range(20, 30)]
+    assert list(index.after('k47')) == ['k48', 'k49', 'k50']
+    assert list(index.after('k48', inclusive=True)) == ['k48', 'k49', 'k50']
+    assert list(index.prefixed('k2', start='k27')) == ['k28', 'k29']
+    assert list(index.prefixed('k2', start='k1')) == list(index.prefixed('k2'))
+    assert list(index.prefixed('k2', start='k3')) == []
+    index.remove_many(list(index.prefixed('k1')) + ['k30', 'k99'])
+    index.remove('k05')
+    assert len(index) == 38
+    assert list(index)[:5] == ['k01', 'k02', 'k03', 'k04', 'k06']
+    assert list(index.prefixed('k3')) == ['k{}'.format(i) for i in range(31, 40)]
+    assert 'k15' not in index and 'k50' in index
+
+
+def test_glob_prefix():
+    assert glob_prefix('Plugin:ns:*') == 'Plugin:ns:'
+    assert glob_prefix('Plugin:k?y') == 'Plugin:k'
+    assert glob_prefix('[ab]*') == ''
+    assert glob_prefix('exact') == 'exact'
+    assert glob_prefix(b'Plugin:*') == b'Plugin:'
+
+
+def test_SortedSet():
+    scores = SortedSet({"b": 2, "a": 2, "c": 1})
+    assert list(scores) == ["c", "a", "b"]
+    assert not scores.add("c", 3)
+    assert scores.add("d", 0)
+    assert list(scores) == ["d", "a", "b", "c"]
+    assert scores.rank("b") == 2
+    assert scores.rank("e") is None
+    assert scores.score("c") == 3
+    assert scores.range(1, 3) == [("a", 2), ("b", 2)]
+    assert scores.range(0, 2, reverse=True) == [("c", 3), ("b", 2)]
+    assert scores.discard("a")
+    assert not scores.discard("a")
+    assert "a" not in scores
+    assert len(scores) == 3
+
+
+def test_HashRing():
+    ring = HashRing(["a", "b", "c"], vnodes=64)
+    assert ring.nodes == {"a", "b", "c"}
+    keys = [f"key{idx}" for idx in range(1000)]
+    before = {key: ring.get(key) for key in keys}
+    assert set(before.values()) == {"a", "b", "c"}
+    assert HashRing(["c", "a", "b"], vnodes=64).get("key1") == before["key1"]
+
+    # Adding a node only moves keys to the new node
+    ring.add("d")
+    after = {key: ring.get(key) for key in keys}
+    moved = [key for key in keys if before[key] != after[key]]
+    assert all(after[key] == "d" for key in moved)
+    assert 100 < len(moved) < 400
+
+    ring.remove("d")
+    assert {key: ring.get(key) for key in keys} == before
+    with pytest.raises(LookupError):
+        HashRing().get("key1")
+
+
+@pytest.mark.asyncio
+async def test_merge():
+    async def numbers(start):
+        for idx in range(start, start + 3):
+            yield idx
+
+    merged = [n async for n in merge([numbers(0), numbers(10)])]
+    assert sorted(merged) == [0, 1, 2, 10, 11, 12]
+
+    async def failing():
+        yield 1
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        [n async for n in merge([numbers(0), failing()])]
+
+
+def test_CircuitBreaker(mocker):
+    mocked_time = mocker.patch("machine.utils.circuit_breaker.time.monotonic")
+    mocked_time.return_value = 100.0
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+    mocked_time.return_value = 110.0
+    assert breaker.state == 'half-open'
+    assert breaker.allow()
+    # Only one call probes the service, the others keep failing fast
+    assert not breaker.allow()
+    assert breaker.state == 'half-open'
+    # Until the probe is given up on
+    mocked_time.return_value = 120.0
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert breaker.times_opened == 2
+    mocked_time.return_value = 130.0
+    breaker.record_success()
+    assert breaker.state == 'closed'
+
+
+def test_Histogram():
+    histogram = Histogram(buckets=(1, 2, 4, 8))
+    assert histogram.percentile(50) == 0
+    for value in (0.5, 1.5, 1.5, 3, 10):
+        histogram.observe(value)
+    assert histogram.counts == [1, 2, 1, 0, 1]
+    assert histogram.percentile(20) == 1
+    assert 1 < histogram.percentile(50) <= 2
+    assert histogram.percentile(100) == 10
+    snapshot = histogram.snapshot()
+    assert snapshot["count"] == 5
+    assert snapshot["sum"] == 16.5
+    assert snapshot["max"] == 10
+
+
+def test_MetricsRegistry():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("storage_seconds", plugin="a", operation="get")
+    assert registry.histogram("storage_seconds", operation="get", plugin="a") is histogram
+    histogram.observe(0.1)
+    registry.histogram("other_seconds").observe(1)
+    snapshot = registry.snapshot("storage_")
+    assert len(snapshot) == 1
+    assert snapshot[0]["labels"] == {"plugin": "a", "operation": "get"}
+    assert snapshot[0]["count"] == 1
+    counter = registry.counter("storage_errors", plugin="a")
+    assert registry.counter("storage_errors", plugin="a") is counter
+    counter.inc()
+    counter.inc(2)
+    assert [metric["name"] for metric in registry.snapshot("storage_")] == [
+        "storage_errors",
+        "storage_seconds",
+    ]
+    assert registry.snapshot("storage_errors")[0]["count"] == 3
+    registry.clear()
+    assert registry.snapshot() == []
+
+
+@pytest.mark.asyncio
+async def test_TimerWheel(event_loop):
+    wheel = TimerWheel(tick=0.01, wheel_size=4, levels=3, loop=event_loop)
+    assert wheel.horizon == pytest.approx(0.64)
+    fired = []
+    # Timers further ahead than the first wheel are spread over it when they get close
+    for delay in (0.3, 0.02, 0.1, 0.05):
+        wheel.call_later(delay, lambda d=delay: fired.append((d, event_loop.time() - start)))
+    start = event_loop.time()
+    cancelled = wheel.call_later(0.04, fired.append, "cancelled")
+    assert len(wheel) == 5
+    cancelled.cancel()
+    assert len(wheel) == 4
+
+    await asyncio.sleep(0.4)
+    assert [delay for delay, _ in fired] == [0.02, 0.05, 0.1, 0.3]
+    for delay, elapsed in fired:
+        assert delay <= elapsed + 0.001
+    assert len(wheel) == 0
+
+    with pytest.raises(ValueError):
+        wheel.call_later(1, fired.append, "too far")
+
+
+@pytest.mark.asyncio
+async def test_TimerWheel_coroutines_and_cancel_all(event_loop):
+    wheel = TimerWheel(tick=0.01, loop=event_loop)
+    ran = []
+
+    async def job(value):
+        ran.append(value)
+
+    wheel.call_later(0.01, job, 1)
+    wheel.call_later(10, job, 2)
+    await asyncio.sleep(0.05)
+    assert ran == [1]
+    assert wheel.cancel_all() == 1
+    assert len(wheel) == 0
+
+
+@pytest.mark.asyncio
+async def test_RateLimiter(event_loop):
+    limiter = RateLimiter(rate=100, burst=2)
+    start = event_loop.time()
+    await asyncio.gather(*(limiter.acquire() for _ in range(6)))
+    # The first two go through at once, the others at 100 per second
+    assert event_loop.time() - start >= 0.035
+
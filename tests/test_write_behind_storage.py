@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+import pytest
+
+from machine.storage.backends.memory import MemoryStorage
+from machine.storage.backends.write_behind import WriteBehindStorage
+
+
+@pytest.fixture
+async def backend():
+    backend = MemoryStorage({})
+    backend.set_many = mock.AsyncMock(wraps=backend.set_many)
+    return backend
+
+
+@pytest.fixture
+async def storage(backend):
+    storage = WriteBehindStorage(
+        backend,
+        {
+            "STORAGE_WRITE_BEHIND": ["stats:*", "other:counter"],
+            "STORAGE_WRITE_BEHIND_INTERVAL": 0,
+            "STORAGE_WRITE_BEHIND_MAX_KEYS": 3,
+        },
+    )
+    await storage.connect()
+    return storage
+
+
+@pytest.mark.asyncio
+async def test_writes_are_buffered(storage, backend):
+    await storage.set("stats:key1", b"value1")
+    await storage.set("stats:key1", b"value2", expires=60)
+    await storage.set("other:key", b"value3")
+
+    assert await backend.get("stats:key1") is None
+    assert await backend.get("other:key") == b"value3"
+    # Reads see the buffered writes
+    assert await storage.get("stats:key1") == b"value2"
+    assert await storage.has("stats:key1")
+    assert await storage.ttl("stats:key1") == 60
+
+    await storage.flush()
+    assert await backend.get("stats:key1") == b"value2"
+    assert 0 < await backend.ttl("stats:key1") <= 60
+    assert storage.stats()["write_behind"] == {
+        "buffered": 0,
+        "flushes": 1,
+        "flushed_keys": 1,
+    }
+
+
+@pytest.mark.asyncio
+async def test_buffered_expiration(storage, backend, mocker):
+    mocked_time = mocker.patch("machine.storage.backends.write_behind.time.monotonic")
+    mocked_time.return_value = 1000.0
+    await storage.set("stats:key1", b"value1", expires=60)
+    await storage.set("stats:key2", b"value2", expires=10)
+
+    # The time spent in the buffer counts towards the expiration
+    mocked_time.return_value = 1020.0
+    assert await storage.ttl("stats:key1") == 40
+    assert await storage.get("stats:key2") is None
+    assert not await storage.has("stats:key2")
+
+    set_many = mocker.spy(backend, "set_many")
+    await storage.flush()
+    assert set_many.call_args[0] == ({"stats:key1": b"value1"}, 40)
+    assert not await backend.has("stats:key2")
+
+
+@pytest.mark.asyncio
+async def test_flush_on_size(storage, backend):
+    await storage.set_many({"stats:key1": b"1", "stats:key2": b"2", "other:key": b"3"})
+    assert await backend.get("other:key") == b"3"
+    assert await backend.get("stats:key1") is None
+    await storage.set("stats:key3", b"3")
+    assert await backend.get("stats:key1") == b"1"
+    assert await backend.get("stats:key3") == b"3"
+    backend.set_many.assert_any_await(
+        {"stats:key1": b"1", "stats:key2": b"2", "stats:key3": b"3"}, None
+    )
+
+
+@pytest.mark.asyncio
+async def test_buffered_deletes(storage, backend):
+    await backend.set("stats:key1", b"value1")
+    await storage.set("stats:key2", b"value2")
+    await storage.delete("stats:key1")
+    await storage.delete("stats:key2")
+    assert not await storage.has("stats:key1")
+    assert await storage.get("stats:key2") is None
+    assert await backend.has("stats:key1")
+
+    await storage.flush()
+    assert not await backend.has("stats:key1")
+    assert not await backend.has("stats:key2")
+
+
+@pytest.mark.asyncio
+async def test_atomic_operations_and_searches_flush(storage, backend):
+    await storage.set("other:counter", b"5")
+    assert await storage.incr("other:counter") == 6
+    await storage.set("stats:key1", b"value1")
+    assert await storage.find_keys("stats:*") == ["stats:key1"]
+    assert [item async for item in storage.iter_items("stats:*")] == [
+        ("stats:key1", b"value1")
+    ]
+    await storage.set("stats:key2", b"value2")
+    assert await storage.delete_matching("stats:*") == 2
+    assert not await backend.has("stats:key2")
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_is_retried(storage, backend):
+    await storage.set("stats:key1", b"value1")
+    backend.set_many.side_effect = ConnectionError()
+    with pytest.raises(ConnectionError):
+        await storage.flush()
+    assert await storage.get("stats:key1") == b"value1"
+
+    backend.set_many.side_effect = None
+    await storage.close()
+    assert await backend.get("stats:key1") == b"value1"
+
+
+def test_backend_methods_are_exposed(backend):
+    storage = WriteBehindStorage(backend, {"STORAGE_WRITE_BEHIND": ["stats:*"]})
+    assert storage._index is backend._index
+
+
+@pytest.mark.asyncio
+async def test_collections_flush_pending_writes(storage, backend):
+    await storage.set("stats:queue", b"value")
+    await storage.delete("stats:queue")
+    assert await storage.list_push("stats:queue", [b"1"]) == 1
+    assert await backend.list_range("stats:queue") == [b"1"]